@@ -4,11 +4,24 @@ import json
 import time
 import re
 import uuid
-from datetime import datetime, timedelta, date
+import asyncio
+import functools
+import hashlib
+import bisect
+import heapq
+import pickle
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, date, time as dtime
 from zoneinfo import ZoneInfo
-from typing import Optional, Tuple, List
+from typing import Optional, Tuple, List, Dict
 
 import gspread
+from gspread.utils import rowcol_to_a1, ValueInputOption
 from google.oauth2.service_account import Credentials
 from dotenv import load_dotenv
 
@@ -18,9 +31,9 @@ from telegram import (
 )
 from telegram.ext import (
     Application, CommandHandler, ContextTypes, CallbackQueryHandler,
-    MessageHandler, TypeHandler, filters
+    MessageHandler, TypeHandler, BaseUpdateProcessor, BasePersistence, PersistenceInput, filters
 )
-from telegram.error import Forbidden, BadRequest, TelegramError
+from telegram.error import Forbidden, BadRequest, TelegramError, RetryAfter, NetworkError
 
 # ===================== ENV & CONFIG =====================
 from dotenv import load_dotenv
@@ -54,9 +67,86 @@ WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "").rstrip("/")
 DEFAULT_DAYS_AHEAD = int(os.getenv("DEFAULT_DAYS_AHEAD", "10"))
 
 TIME_STEP_MIN = 30              # Крок зміни часу (кнопки + / -)
+
+# Скільки пунктів показувати на одній сторінці списків (зміни на дату, мої записи, відпрацьовані)
+LIST_PAGE_SIZE = int(os.getenv("LIST_PAGE_SIZE", "10"))
 REMIND_HOUR_BEFORE = 18         # Нагадування за день о 18:00
 MORNING_REMIND_HOUR = 8         # Нагадування в день зміни
 
+# Скільки одночасних звернень до Google Sheets дозволено (розмір пулу потоків)
+SHEETS_MAX_WORKERS = int(os.getenv("SHEETS_MAX_WORKERS", "4"))
+
+# Паралельна обробка апдейтів від різних користувачів (0 — по одному, як раніше)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "0"))
+
+# Кеші Requests/Stores: після STALE віддаємо старий знімок і оновлюємо у фоні,
+# після MAX_AGE — чекаємо свіже читання (жорстке протермінування)
+REQ_CACHE_STALE_SEC     = int(os.getenv("REQ_CACHE_STALE_SEC", "20"))
+REQ_CACHE_MAX_AGE_SEC   = int(os.getenv("REQ_CACHE_MAX_AGE_SEC", "300"))
+STORE_CACHE_STALE_SEC   = int(os.getenv("STORE_CACHE_STALE_SEC", "60"))
+STORE_CACHE_MAX_AGE_SEC = int(os.getenv("STORE_CACHE_MAX_AGE_SEC", "3600"))
+
+# Скільки готових inline-клавіатур (міста/магазини/календарі) тримати в LRU-кеші
+KEYBOARD_CACHE_SIZE = int(os.getenv("KEYBOARD_CACHE_SIZE", "256"))
+
+# Інкрементальне оновлення Requests: між повними читаннями (раз на REQ_FULL_SYNC_SEC)
+# перечитуються лише нові рядки в кінці аркуша і рядки з датою від сьогодні
+REQ_INCREMENTAL_SYNC = os.getenv("REQ_INCREMENTAL_SYNC", "1").strip() == "1"
+REQ_FULL_SYNC_SEC    = int(os.getenv("REQ_FULL_SYNC_SEC", "900"))
+REQ_SYNC_MAX_RANGES  = 100   # більше діапазонів — простіше прочитати весь аркуш
+REQ_SYNC_RUN_GAP     = 3     # сусідні рядки з розривом до N зливаються в один діапазон
+
+# Локальне SQLite-дзеркало Requests/Stores/Attendance/JobQueue: бот читає й пише в нього,
+# а зміни йдуть у Google Sheets пачками раз на MIRROR_PUSH_SEC. Attendance перечитується
+# з таблиці не частіше ніж раз на ATTENDANCE_PULL_SEC.
+LOCAL_DB_PATH       = os.getenv("LOCAL_DB_PATH", "bot_mirror.sqlite3")
+MIRROR_PUSH_SEC     = int(os.getenv("MIRROR_PUSH_SEC", "2"))
+ATTENDANCE_PULL_SEC = int(os.getenv("ATTENDANCE_PULL_SEC", "300"))
+
+# Щоночі виконані/протерміновані задачі старші за RETENTION днів переносяться з JobQueue
+# в аркуш архіву (порожня назва — просто видаляються)
+JOBQUEUE_RETENTION_DAYS = int(os.getenv("JOBQUEUE_RETENTION_DAYS", "7"))
+JOBQUEUE_ARCHIVE_SHEET  = os.getenv("JOBQUEUE_ARCHIVE_SHEET", "JobQueueArchive").strip()
+JOBQUEUE_COMPACT_HOUR   = 4
+
+# Нагадування групуються в кошики по BUCKET секунд і розсилаються пачками
+# по BATCH_SIZE з паузою між пачками (щоб не впертися в ліміти Telegram)
+REMINDER_BUCKET_SEC      = int(os.getenv("REMINDER_BUCKET_SEC", "30"))
+REMINDER_BATCH_SIZE      = int(os.getenv("REMINDER_BATCH_SIZE", "20"))
+REMINDER_BATCH_PAUSE_SEC = float(os.getenv("REMINDER_BATCH_PAUSE_SEC", "1.0"))
+# Нагадування, яке не вдалося доставити, повторюється через RETRY*номер спроби сек;
+# після MAX_RETRIES невдалих розсилок воно позначається в JobQueue як "failed"
+REMINDER_RETRY_SEC       = int(os.getenv("REMINDER_RETRY_SEC", "300"))
+REMINDER_MAX_RETRIES     = int(os.getenv("REMINDER_MAX_RETRIES", "3"))
+
+# Черга вихідних повідомлень: загальний ліміт (повідомлень/сек), мінімальний інтервал
+# між повідомленнями в один чат (для груп/каналів — окремий), к-сть спроб і період логування метрик
+OUTBOX_GLOBAL_RATE            = float(os.getenv("OUTBOX_GLOBAL_RATE", "25"))
+OUTBOX_CHAT_INTERVAL_SEC      = float(os.getenv("OUTBOX_CHAT_INTERVAL_SEC", "1.0"))
+OUTBOX_GROUP_INTERVAL_SEC     = float(os.getenv("OUTBOX_GROUP_INTERVAL_SEC", "3.0"))
+OUTBOX_MAX_ATTEMPTS           = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_METRICS_SEC            = int(os.getenv("OUTBOX_METRICS_SEC", "300"))
+
+# Як часто логувати час обробки callback-маршрутів (сек)
+CALLBACK_METRICS_SEC = int(os.getenv("CALLBACK_METRICS_SEC", "300"))
+
+# HR-канал: 1 — збирати нові записи в дайджест (вікно WINDOW сек або MAX записів),
+# 0 — кожен запис окремим повідомленням. Зміни на сьогодні завжди йдуть одразу.
+HR_DIGEST_MODE       = os.getenv("HR_DIGEST_MODE", "0").strip() == "1"
+HR_DIGEST_WINDOW_SEC = int(os.getenv("HR_DIGEST_WINDOW_SEC", "300"))
+HR_DIGEST_MAX        = int(os.getenv("HR_DIGEST_MAX", "20"))
+
+# Локальне збереження user_data/chat_data (телефон, ПІБ, незавершені дії) між перезапусками.
+# На Railway шлях має вказувати на підключений volume, інакше файл зникне з редеплоєм.
+PERSISTENCE_PATH      = os.getenv("PERSISTENCE_PATH", "bot_state.sqlite3")
+PERSISTENCE_FLUSH_SEC = int(os.getenv("PERSISTENCE_FLUSH_SEC", "10"))
+
+# Скільки живуть короткі токени в callback_data (кнопки старших повідомлень
+# після цього відповідають "кнопка застаріла"); копія — в окремому файлі
+# CALLBACK_TOKENS_PATH, щоб не змагатися за блокування з PERSISTENCE_PATH
+CALLBACK_TOKEN_TTL_SEC = int(os.getenv("CALLBACK_TOKEN_TTL_SEC", str(14 * 24 * 3600)))
+CALLBACK_TOKENS_PATH   = os.getenv("CALLBACK_TOKENS_PATH", "bot_tokens.sqlite3")
+
 KYIV_TZ = ZoneInfo("Europe/Kyiv")
 
 def now_kyiv():
@@ -110,6 +200,457 @@ except gspread.WorksheetNotFound:
 
 # <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
 
+# ===================== Async-доступ до Google Sheets =====================
+# gspread синхронний: кожен HTTP-виклик блокував би event loop webhook-сервера,
+# тож усі звернення з хендлерів і джоб ідуть через обмежений пул потоків.
+_SHEETS_POOL = ThreadPoolExecutor(max_workers=SHEETS_MAX_WORKERS, thread_name_prefix="sheets")
+
+async def sheets_call(func, *args, **kwargs):
+    """Виконує синхронний виклик gspread у пулі потоків, не блокуючи event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_SHEETS_POOL, functools.partial(func, *args, **kwargs))
+
+class KeyedLocks:
+    """
+    Набір asyncio.Lock за ключем. Лок живе, поки його хтось тримає або чекає,
+    тож словник не росте з кожним новим користувачем.
+    """
+
+    def __init__(self):
+        self._locks = {}  # key -> [Lock, кількість власників/очікувачів]
+
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._locks.pop(key, None)
+
+_ATTENDANCE_WS = None
+
+async def get_attendance_ws(create: bool = False):
+    """Повертає аркуш Attendance (з кешем об'єкта). create=True — створює, якщо немає."""
+    global _ATTENDANCE_WS
+    if _ATTENDANCE_WS is not None:
+        return _ATTENDANCE_WS
+    try:
+        _ATTENDANCE_WS = await sheets_call(ss.worksheet, "Attendance")
+    except gspread.WorksheetNotFound:
+        if not create:
+            raise
+        _ATTENDANCE_WS = await sheets_call(ss.add_worksheet, "Attendance", rows=1000, cols=10)
+    return _ATTENDANCE_WS
+
+# ===================== Локальне дзеркало (SQLite) =====================
+def _trim_cells(cells) -> List[str]:
+    cells = ["" if c is None else str(c) for c in cells]
+    while cells and cells[-1] == "":
+        cells.pop()
+    return cells
+
+def _apply_updates(cells: List[str], updates: Dict[int, str]) -> List[str]:
+    cells = list(cells)
+    for col, value in updates.items():
+        while len(cells) < col:
+            cells.append("")
+        cells[col - 1] = value
+    return _trim_cells(cells)
+
+def records_from_values(values: List[List[str]]) -> List[dict]:
+    """Як get_all_records(): перший рядок — заголовки, решта — словники."""
+    if not values:
+        return []
+    header = values[0]
+    return [dict(zip(header, list(r) + [""] * (len(header) - len(r)))) for r in values[1:]]
+
+class LocalMirror:
+    """
+    SQLite-дзеркало аркушів — основне джерело для читань і записів бота.
+    - mirror_rows:   поточні значення рядка (cells), останні відомі значення
+                     в таблиці (remote) і версія рядка
+    - mirror_outbox: наші зміни, які ще не записані в Google Sheets
+    Записи бота одразу лягають у cells + outbox і фоново скидаються пачками
+    (mirror_push); ручні правки HR підтягуються через merge() при читанні таблиці.
+    Конфлікт — коли HR змінив у таблиці ту саму клітинку, яку ми ще не записали:
+    перемагає значення з таблиці, наша зміна цієї клітинки відкидається.
+    Методи синхронні; з event loop їх викликають лише через mirror_call(),
+    який виконує їх у єдиному потоці дзеркала.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.RLock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mirror")
+        self.conflicts = 0
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS mirror_rows ("
+                " sheet TEXT NOT NULL, row_idx INTEGER NOT NULL, cells TEXT NOT NULL,"
+                " remote TEXT, version INTEGER NOT NULL DEFAULT 1,"
+                " PRIMARY KEY (sheet, row_idx))"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS mirror_outbox ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT, sheet TEXT NOT NULL, row_idx INTEGER NOT NULL,"
+                " updates TEXT NOT NULL, raw INTEGER NOT NULL, base_version INTEGER NOT NULL)"
+            )
+
+    def has(self, sheet: str) -> bool:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT 1 FROM mirror_rows WHERE sheet = ? LIMIT 1", (sheet,)
+            ).fetchone() is not None
+
+    def values(self, sheet: str) -> Dict[int, List[str]]:
+        """row_idx -> значення (лише непорожні рядки)."""
+        with self._lock:
+            return {
+                row_idx: json.loads(cells)
+                for row_idx, cells in self._conn.execute(
+                    "SELECT row_idx, cells FROM mirror_rows WHERE sheet = ? ORDER BY row_idx", (sheet,)
+                )
+            }
+
+    def table(self, sheet: str) -> List[List[str]]:
+        """Як get_all_values(): рядки з 1-го по останній, пропуски — порожні списки."""
+        rows = self.values(sheet)
+        return [rows.get(i, []) for i in range(1, max(rows, default=0) + 1)]
+
+    def last_row(self, sheet: str) -> int:
+        with self._lock:
+            found = self._conn.execute("SELECT MAX(row_idx) FROM mirror_rows WHERE sheet = ?", (sheet,)).fetchone()
+        return found[0] or 0
+
+    def row(self, sheet: str, row_idx: int) -> Optional[List[str]]:
+        with self._lock:
+            found = self._conn.execute(
+                "SELECT cells FROM mirror_rows WHERE sheet = ? AND row_idx = ?", (sheet, row_idx)
+            ).fetchone()
+        return json.loads(found[0]) if found else None
+
+    def rows(self, sheet: str, row_ids: List[int]) -> Dict[int, List[str]]:
+        """row_idx -> значення для вказаних рядків (порожніх у відповіді немає)."""
+        found: Dict[int, List[str]] = {}
+        ids = sorted(set(row_ids))
+        with self._lock:
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                for row_idx, cells in self._conn.execute(
+                    f"SELECT row_idx, cells FROM mirror_rows WHERE sheet = ? AND row_idx IN ({','.join('?' * len(chunk))})",
+                    (sheet, *chunk),
+                ):
+                    found[row_idx] = json.loads(cells)
+        return found
+
+    def write(self, sheet: str, row_idx: int, updates: Dict[int, object], raw: bool) -> int:
+        """Локальний запис + черга в таблицю. Повертає нову версію рядка."""
+        updates = {int(col): "" if v is None else str(v) for col, v in updates.items()}
+        with self._lock, self._conn:
+            found = self._conn.execute(
+                "SELECT cells, version FROM mirror_rows WHERE sheet = ? AND row_idx = ?", (sheet, row_idx)
+            ).fetchone()
+            cells, version = (json.loads(found[0]), found[1]) if found else ([], 0)
+            self._conn.execute(
+                "INSERT INTO mirror_rows (sheet, row_idx, cells, remote, version) VALUES (?, ?, ?, NULL, ?)"
+                " ON CONFLICT (sheet, row_idx) DO UPDATE SET cells = excluded.cells, version = excluded.version",
+                (sheet, row_idx, json.dumps(_apply_updates(cells, updates)), version + 1),
+            )
+            self._conn.execute(
+                "INSERT INTO mirror_outbox (sheet, row_idx, updates, raw, base_version) VALUES (?, ?, ?, ?, ?)",
+                (sheet, row_idx, json.dumps(updates), int(raw), version),
+            )
+        return version + 1
+
+    def pending(self, sheet: str) -> List[Tuple[int, int, Dict[int, str], bool]]:
+        """Незаписані зміни аркуша у порядку створення: (id, row_idx, updates, raw)."""
+        with self._lock:
+            return [
+                (entry_id, row_idx, {int(c): v for c, v in json.loads(updates).items()}, bool(raw))
+                for entry_id, row_idx, updates, raw in self._conn.execute(
+                    "SELECT id, row_idx, updates, raw FROM mirror_outbox WHERE sheet = ? ORDER BY id", (sheet,)
+                )
+            ]
+
+    def ack(self, sheet: str, entries):
+        """Зміни записані в таблицю: прибираємо з outbox і оновлюємо remote."""
+        with self._lock, self._conn:
+            for entry_id, row_idx, updates, _ in entries:
+                found = self._conn.execute(
+                    "SELECT remote FROM mirror_rows WHERE sheet = ? AND row_idx = ?", (sheet, row_idx)
+                ).fetchone()
+                if found is None:
+                    continue
+                remote = json.loads(found[0]) if found[0] is not None else []
+                self._conn.execute(
+                    "UPDATE mirror_rows SET remote = ? WHERE sheet = ? AND row_idx = ?",
+                    (json.dumps(_apply_updates(remote, updates)), sheet, row_idx),
+                )
+            self._conn.executemany("DELETE FROM mirror_outbox WHERE id = ?", [(e[0],) for e in entries])
+
+    def merge(self, sheet: str, remote_rows: Dict[int, List[str]], complete: bool) -> int:
+        """
+        Накладає свіжо прочитані з таблиці рядки. complete=True — прочитано весь
+        аркуш (рядків, яких немає в remote_rows, у таблиці вже немає).
+        Повертає кількість конфліктів.
+        """
+        conflicts = 0
+        with self._lock, self._conn:
+            known = {
+                row_idx: (json.loads(remote) if remote is not None else None, version)
+                for row_idx, remote, version in self._conn.execute(
+                    "SELECT row_idx, remote, version FROM mirror_rows WHERE sheet = ?", (sheet,)
+                )
+            }
+            pending: Dict[int, list] = {}
+            for entry_id, row_idx, updates, base_version in self._conn.execute(
+                "SELECT id, row_idx, updates, base_version FROM mirror_outbox WHERE sheet = ? ORDER BY id", (sheet,)
+            ):
+                pending.setdefault(row_idx, []).append(
+                    (entry_id, {int(c): v for c, v in json.loads(updates).items()}, base_version)
+                )
+
+            targets = set(remote_rows)
+            if complete:
+                targets |= {row_idx for row_idx, (remote, _) in known.items() if remote}
+
+            for row_idx in targets:
+                new_remote = _trim_cells(remote_rows.get(row_idx, []))
+                if row_idx not in known:
+                    if new_remote:
+                        self._conn.execute(
+                            "INSERT INTO mirror_rows (sheet, row_idx, cells, remote, version) VALUES (?, ?, ?, ?, 1)",
+                            (sheet, row_idx, json.dumps(new_remote), json.dumps(new_remote)),
+                        )
+                    continue
+                old_remote, version = known[row_idx]
+                old_remote = old_remote or []
+                if new_remote == old_remote:
+                    continue
+
+                # рядок змінили в таблиці: беремо її значення і накладаємо наші незаписані зміни,
+                # крім клітинок, які змінились і там (конфлікт — перемагає таблиця)
+                width = max(len(old_remote), len(new_remote))
+                changed = {
+                    c for c in range(1, width + 1)
+                    if (old_remote[c - 1] if c <= len(old_remote) else "") !=
+                       (new_remote[c - 1] if c <= len(new_remote) else "")
+                }
+                merged = new_remote
+                for entry_id, updates, base_version in pending.get(row_idx, []):
+                    lost = changed & set(updates)
+                    if lost:
+                        conflicts += 1
+                        print(f"[debug] mirror conflict: {sheet} row {row_idx} cols {sorted(lost)} "
+                              f"(our write on v{base_version}, now v{version + 1}) — keeping sheet values", flush=True)
+                        updates = {c: v for c, v in updates.items() if c not in lost}
+                        if updates:
+                            self._conn.execute(
+                                "UPDATE mirror_outbox SET updates = ? WHERE id = ?", (json.dumps(updates), entry_id)
+                            )
+                        else:
+                            self._conn.execute("DELETE FROM mirror_outbox WHERE id = ?", (entry_id,))
+                    merged = _apply_updates(merged, updates)
+                self._conn.execute(
+                    "UPDATE mirror_rows SET cells = ?, remote = ?, version = ? WHERE sheet = ? AND row_idx = ?",
+                    (json.dumps(merged), json.dumps(new_remote), version + 1, sheet, row_idx),
+                )
+        self.conflicts += conflicts
+        return conflicts
+
+    def renumber(self, sheet: str, values: List[List[str]], moved: Dict[int, int]):
+        """
+        Аркуш переписано заново (компакція JobQueue): дзеркало = нові значення таблиці,
+        незаписані зміни переносяться за moved (старий рядок -> новий), решта відкидається.
+        """
+        with self._lock, self._conn:
+            entries = self._conn.execute(
+                "SELECT row_idx, updates, raw, base_version FROM mirror_outbox WHERE sheet = ? ORDER BY id", (sheet,)
+            ).fetchall()
+            self._conn.execute("DELETE FROM mirror_rows WHERE sheet = ?", (sheet,))
+            self._conn.execute("DELETE FROM mirror_outbox WHERE sheet = ?", (sheet,))
+            rows = {i: _trim_cells(cells) for i, cells in enumerate(values, start=1)}
+            remote = dict(rows)
+            for row_idx, updates, raw, base_version in entries:
+                if row_idx not in moved:
+                    continue
+                new_row = moved[row_idx]
+                rows[new_row] = _apply_updates(rows.get(new_row, []), {int(c): v for c, v in json.loads(updates).items()})
+                self._conn.execute(
+                    "INSERT INTO mirror_outbox (sheet, row_idx, updates, raw, base_version) VALUES (?, ?, ?, ?, ?)",
+                    (sheet, new_row, updates, raw, base_version),
+                )
+            self._conn.executemany(
+                "INSERT INTO mirror_rows (sheet, row_idx, cells, remote, version) VALUES (?, ?, ?, ?, 1)",
+                [
+                    (sheet, i, json.dumps(cells), json.dumps(remote[i]) if i in remote else None)
+                    for i, cells in rows.items() if cells or i in remote
+                ],
+            )
+
+MIRROR = LocalMirror(LOCAL_DB_PATH)
+
+async def mirror_call(func, *args):
+    """
+    Виконує звернення до дзеркала в його єдиному потоці: SQLite-коміти і лок
+    дзеркала (який merge тримає на весь аркуш) ніколи не блокують event loop.
+    Виклики виконуються строго в порядку надходження.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(MIRROR.executor, functools.partial(func, *args))
+
+# Аркуші, куди бот пише (Stores — лише читання)
+MIRROR_SHEETS = ("Requests", "Attendance", "JobQueue")
+
+# Запис у таблицю і читання одного аркуша не перетинаються
+_MIRROR_SHEET_LOCKS = KeyedLocks()
+_MIRROR_PULLED: Dict[str, float] = {}
+
+def mirror_sheet_lock(sheet: str):
+    return _MIRROR_SHEET_LOCKS.hold(sheet)
+
+async def _mirror_ws(sheet: str, create: bool = False):
+    if sheet == "Requests":
+        return requests_ws
+    if sheet == "Stores":
+        return stores_ws
+    if sheet == "JobQueue":
+        return jobqueue_ws
+    if sheet == "Attendance":
+        return await get_attendance_ws(create=create)
+    raise KeyError(sheet)
+
+def _push_entries(ws, entries):
+    """Синхронно: незаписані зміни аркуша — batch_update на кожну серію з однаковим режимом вводу."""
+    last_row = max(e[1] for e in entries)
+    if last_row > ws.row_count:
+        ws.add_rows(max(last_row - ws.row_count, 100))
+    series = []
+    for _, row_idx, updates, raw in entries:
+        if not series or series[-1][0] != raw:
+            series.append((raw, {}))
+        series[-1][1].setdefault(row_idx, {}).update(updates)
+    for raw, rows in series:
+        payload = []
+        for row_idx, updates in sorted(rows.items()):
+            payload.extend(row_patch_payload(row_idx, updates))
+        ws.batch_update(payload, value_input_option=ValueInputOption.raw if raw else ValueInputOption.user_entered)
+
+async def _mirror_push_locked(sheet: str) -> int:
+    entries = await mirror_call(MIRROR.pending, sheet)
+    if not entries:
+        return 0
+    ws = await _mirror_ws(sheet, create=True)
+    await sheets_call(_push_entries, ws, entries)
+    await mirror_call(MIRROR.ack, sheet, entries)
+    return len(entries)
+
+async def mirror_push(sheets=MIRROR_SHEETS) -> int:
+    """Скидає незаписані зміни з дзеркала в Google Sheets; помилки лише логуються."""
+    total = 0
+    for sheet in sheets:
+        try:
+            async with mirror_sheet_lock(sheet):
+                n = await _mirror_push_locked(sheet)
+        except Exception as e:
+            print(f"[debug] mirror push {sheet} error: {e}", flush=True)
+            continue
+        if n:
+            print(f"[debug] mirror push {sheet}: {n} changes", flush=True)
+        total += n
+    return total
+
+async def mirror_pull(sheet: str, max_age: float = 0) -> int:
+    """Перечитує аркуш у дзеркало (max_age — не частіше ніж раз на стільки секунд)."""
+    if max_age and time.time() - _MIRROR_PULLED.get(sheet, 0.0) < max_age:
+        return 0
+    ws = await _mirror_ws(sheet)
+    async with mirror_sheet_lock(sheet):
+        values = await sheets_call(ws.get_all_values)
+        conflicts = await mirror_call(MIRROR.merge, sheet, dict(enumerate(values, start=1)), True)
+    if sheet == "Attendance":
+        # рядки, дописані в таблицю вручну, не мають отримати наші нові записи.
+        # Лише зсув уперед: видані, але ще не записані номери не повертаються
+        ATTENDANCE_ROWS.observe_tail(len(values))
+    _MIRROR_PULLED[sheet] = time.time()
+    return conflicts
+
+def _row_runs(rows: List[int], gap: int = 0) -> List[Tuple[int, int]]:
+    """Відсортовані номери рядків -> діапазони (перший, останній) з розривом не більше gap."""
+    runs = []
+    for r in rows:
+        if runs and r - runs[-1][1] <= gap + 1:
+            runs[-1][1] = r
+        else:
+            runs.append([r, r])
+    return [(a, b) for a, b in runs]
+
+def _requests_sync_spans(runs: List[Tuple[int, int]], tail_start: int,
+                         row_count: int) -> List[Tuple[int, Optional[int]]]:
+    """
+    Діапазони для часткового читання Requests, обрізані сіткою аркуша (row_count):
+    запит за її межі batch_get відхиляє ("exceeds grid limits"). Кінець None —
+    відкритий хвіст; якщо дані доходять до краю сітки, хвоста немає.
+    """
+    spans: List[Tuple[int, Optional[int]]] = [(a, min(b, row_count)) for a, b in runs if a <= row_count]
+    if tail_start <= row_count:
+        spans.append((tail_start, None))
+    return spans
+
+async def mirror_pull_requests() -> Optional[Dict[int, List[str]]]:
+    """
+    Оновлює дзеркало Requests. Зазвичай читає лише хвіст аркуша (нові рядки)
+    і рядки з датою від сьогодні одним batch_get; весь аркуш — раз на
+    REQ_FULL_SYNC_SEC (звірка ручних правок в історії), при першому запуску
+    або коли актуальних рядків забагато.
+    Після часткового читання повертає row_idx -> значення з дзеркала для
+    прочитаних рядків ([] — рядок очищено); після повного — None.
+    """
+    snap = _REQ_CACHE["value"]
+    if (not REQ_INCREMENTAL_SYNC or snap is None or
+            time.time() - _MIRROR_PULLED.get("Requests", 0.0) >= REQ_FULL_SYNC_SEC):
+        await mirror_pull("Requests")
+        return None
+
+    window = sorted(snap.active)
+    runs = _row_runs(window, REQ_SYNC_RUN_GAP)
+    if len(runs) > REQ_SYNC_MAX_RANGES:
+        await mirror_pull("Requests")
+        return None
+
+    last_col = rowcol_to_a1(1, COL_WORKER_STORE)[:-1]
+    async with mirror_sheet_lock("Requests"):
+        tail_start = await mirror_call(MIRROR.last_row, "Requests") + 1
+        spans = _requests_sync_spans(runs, tail_start, requests_ws.row_count)
+        ranges = [f"A{a}:{last_col}{b or ''}" for a, b in spans]
+        results = await sheets_call(requests_ws.batch_get, ranges) if ranges else []
+
+        fetched: Dict[int, List[str]] = {}
+        for (start, _), values in zip(spans, results):
+            for i, cells in enumerate(values):
+                fetched[start + i] = cells
+        # порожні рядки в кінці діапазону API не повертає, а рядків за межами
+        # сітки вже немає — такі рядки вікна очистили
+        for start, end in runs:
+            for row_idx in range(start, end + 1):
+                fetched.setdefault(row_idx, [])
+        await mirror_call(MIRROR.merge, "Requests", fetched, False)
+        # після злиття в дзеркалі — значення таблиці разом з нашими незаписаними змінами
+        merged = await mirror_call(MIRROR.rows, "Requests", list(fetched))
+
+    print(f"[debug] Requests incremental sync: {len(fetched)} rows in {len(ranges)} ranges", flush=True)
+    return {row_idx: merged.get(row_idx, []) for row_idx in fetched}
+
+async def job_mirror_push(context: ContextTypes.DEFAULT_TYPE):
+    await mirror_push()
+
 # -------------------- Колонки Requests (1-based) --------------------
 # A:ID(формула)
 COL_STORE       = 2   # B №_магазину
@@ -142,35 +683,246 @@ REQUEST_TYPE_WANT = "Хочу у відрядження"
 RECORD_STATE_ACTIVE    = "Активний"
 RECORD_STATE_CANCELLED = "Скасовано"
 # ===================== Кеші =====================
-_REQ_CACHE = {"ts": 0.0, "rows": []}
-_STORE_CACHE = {"ts": 0.0, "rows": []}
+# stale-while-revalidate: читачі одразу отримують останній знімок, а оновлення
+# йде у фоні. Одночасні оновлення зливаються в одне читання ("inflight").
+_REQ_CACHE = {
+    "name": "Requests", "ts": 0.0, "value": None, "gen": 0, "inflight": None,
+    "stale_sec": REQ_CACHE_STALE_SEC, "max_age_sec": REQ_CACHE_MAX_AGE_SEC,
+}
+_STORE_CACHE = {
+    "name": "Stores", "ts": 0.0, "value": None, "gen": 0, "inflight": None,
+    "stale_sec": STORE_CACHE_STALE_SEC, "max_age_sec": STORE_CACHE_MAX_AGE_SEC,
+}
+
+async def _cache_reload(cache: dict, loader):
+    try:
+        value = await loader()
+        cache["value"] = value
+        cache["ts"] = time.time()
+        cache["gen"] += 1
+        return value
+    finally:
+        cache["inflight"] = None
+
+async def _cache_refresh(cache: dict, loader):
+    """Оновлює кеш; якщо оновлення вже йде — чекає саме його (single-flight)."""
+    task = cache["inflight"]
+    if task is None:
+        task = asyncio.get_running_loop().create_task(_cache_reload(cache, loader))
+        cache["inflight"] = task
+    # shield: скасування одного з очікувачів не скасовує спільне читання
+    return await asyncio.shield(task)
+
+def _cache_refresh_in_background(cache: dict, loader):
+    if cache["inflight"] is not None:
+        return
 
-def get_requests_records(ttl_sec: int = 20):
-    now = time.time()
-    if (now - _REQ_CACHE["ts"]) < ttl_sec and _REQ_CACHE["rows"]:
-        return _REQ_CACHE["rows"], True
-    rows = requests_ws.get_all_records()
-    _REQ_CACHE["rows"] = rows
-    _REQ_CACHE["ts"] = now
-    return rows, False
-
-def get_stores_records(ttl_sec: int = 60):
+    def _log_error(task):
+        if not task.cancelled() and task.exception():
+            print(f"[debug] {cache['name']} background refresh error: {task.exception()}", flush=True)
+
+    task = asyncio.get_running_loop().create_task(_cache_reload(cache, loader))
+    task.add_done_callback(_log_error)
+    cache["inflight"] = task
+
+async def _cache_get(cache: dict, loader, force: bool = False):
+    age = time.time() - cache["ts"]
+    if force or cache["value"] is None or age >= cache["max_age_sec"]:
+        return await _cache_refresh(cache, loader)
+    if age >= cache["stale_sec"]:
+        _cache_refresh_in_background(cache, loader)
+    return cache["value"]
+
+# Наші власні записи в Requests за останні хвилини: (час, row_idx, {колонка: значення}).
+# Якщо знімок почали будувати до запису, після нього записи накладаються повторно.
+_REQ_LOCAL_WRITES: List[Tuple[float, int, Dict[int, str]]] = []
+REQ_LOCAL_WRITES_KEEP_SEC = 300
+
+async def _reload_requests() -> "RequestsSnapshot":
+    """
+    Після часткової синхронізації перерозбирає лише прочитані рядки, що змінились,
+    і точково оновлює поточний знімок; після повної — будує знімок заново.
+    """
+    started = time.time()
+    stores, _ = await safe_store_directory()
+    fresh = await mirror_pull_requests()
+    snap = _REQ_CACHE["value"]
+    if fresh is not None and snap is not None and snap.stores.same_cities(stores):
+        snap.stores = stores
+        changed = {row_idx: cells for row_idx, cells in fresh.items() if not snap.has_cells(row_idx, cells)}
+        parsed = await asyncio.to_thread(_parse_request_rows, changed, stores)
+        for row_idx, row in parsed.items():
+            snap.put(row_idx, row)
+        print(f"[debug] Requests snapshot patched: {len(parsed)} of {len(fresh)} rows", flush=True)
+    else:
+        values = await mirror_call(MIRROR.values, "Requests")
+        snap = await asyncio.to_thread(_build_requests_snapshot, values, stores)
+
+    _REQ_LOCAL_WRITES[:] = [w for w in _REQ_LOCAL_WRITES if w[0] >= started - REQ_LOCAL_WRITES_KEEP_SEC]
+    for ts, row_idx, updates in _REQ_LOCAL_WRITES:
+        if ts >= started:
+            snap.apply(row_idx, updates)
+    REQUESTS_ROWS.observe_tail(snap.tail_row)
+    return snap
+
+def requests_cache_apply(row_idx: int, updates: Dict[int, str]):
+    """
+    Write-through: накладає наш щойно записаний у Requests рядок на кешований знімок,
+    щоб наступне читання бачило зміни без перебудови знімка.
+    """
+    updates = {col: "" if v is None else str(v) for col, v in updates.items()}
+    _REQ_LOCAL_WRITES.append((time.time(), row_idx, updates))
+    snap = _REQ_CACHE["value"]
+    if snap is not None:
+        snap.apply(row_idx, updates)
+        _REQ_CACHE["gen"] += 1
+
+def row_patch_payload(row_idx: int, updates: Dict[int, object]) -> List[dict]:
+    """
+    {колонка: значення} -> payload для batch_update: сусідні колонки зливаються
+    в один діапазон, пропуски (формули, чужі колонки) не зачіпаються.
+    """
+    runs, run = [], []
+    for col in sorted(updates):
+        if run and col != run[-1] + 1:
+            runs.append(run)
+            run = []
+        run.append(col)
+    if run:
+        runs.append(run)
+    return [
+        {
+            'range': f"{rowcol_to_a1(row_idx, cols[0])}:{rowcol_to_a1(row_idx, cols[-1])}",
+            'values': [[updates[c] for c in cols]],
+        }
+        for cols in runs
+    ]
+
+async def requests_patch_row(row_idx: int, updates: Dict[int, object], raw: bool = False):
+    """
+    Записує зміни рядка Requests у локальне дзеркало і кешований знімок;
+    у таблицю вони підуть найближчим mirror_push разом з іншими змінами.
+    raw=False — як update_cell (USER_ENTERED), raw=True — значення як є.
+    """
+    await mirror_call(MIRROR.write, "Requests", row_idx, updates, raw)
+    requests_cache_apply(row_idx, updates)
+
+# Локи рядків Requests: read-modify-write одного рядка (бронювання, підтвердження)
+# виконується під локом цього рядка; бронювання різних рядків ідуть паралельно.
+_REQ_ROW_LOCKS = KeyedLocks()
+
+def requests_row_lock(row_idx: int):
+    return _REQ_ROW_LOCKS.hold(row_idx)
+
+async def read_request_row(row_idx: int) -> List[str]:
+    """Поточні значення рядка Requests з дзеркала (доповнені до COL_WORKER_STORE)."""
+    row = await mirror_call(MIRROR.row, "Requests", row_idx)
+    if row is None:
+        # рядка ще немає в дзеркалі (додали в таблицю після останнього читання)
+        row = await sheets_call(requests_ws.row_values, row_idx)
+        await mirror_call(MIRROR.merge, "Requests", {row_idx: row}, False)
+    row = list(row)
+    while len(row) < COL_WORKER_STORE:
+        row.append("")
+    return row
+
+async def commit_booking(row_idx: int, tg_id: str, emp_name: str, worker_phone: str):
+    """
+    Атомарне бронювання місця: під локом рядка перечитує його з дзеркала
+    і лише тоді дописує працівника, тож два одночасні "book:" на останнє
+    місце не призведуть до перебронювання.
+    Повертає (результат, рядок, новий статус), результат:
+    "already" | "full" | "need_name" | "ok".
+    """
+    async with requests_row_lock(row_idx):
+        row = await read_request_row(row_idx)
+
+        needed_s = (row[COL_NEED-1] or "").strip().replace(",", ".")
+        needed = int(float(needed_s)) if needed_s.replace(".", "", 1).isdigit() else 1
+        booked_raw = (row[COL_BOOKED-1] or "").strip()
+        booked_ids = [x.strip() for x in booked_raw.split(",") if x.strip().isdigit()]
+
+        if tg_id in booked_ids:
+            return "already", row, ""
+        if len(booked_ids) >= needed:
+            return "full", row, ""
+        if not emp_name:
+            return "need_name", row, ""
+
+        booked_ids.append(tg_id)
+        new_status = f"{STATUS_WAIT} ({len(booked_ids)}/{needed})"
+
+        phones_raw = (row[COL_BOOKED_PH-1] or "")
+        phone_list = [x.strip() for x in phones_raw.split(",") if x.strip()]
+        if worker_phone:
+            phone_list.append(worker_phone)
+
+        names_raw = (row[COL_BOOKED_NAME-1] or "")
+        name_list = [x.strip() for x in names_raw.split(",") if x.strip()]
+        name_list.append(emp_name)
+
+        await requests_patch_row(row_idx, {
+            COL_BOOKED: ", ".join(booked_ids),
+            COL_STATUS: new_status,
+            COL_BOOKED_PH: ", ".join(phone_list),
+            COL_BOOKED_NAME: ", ".join(name_list),
+        })
+        return "ok", row, new_status
+
+async def _reload_stores() -> "StoreDirectory":
+    await mirror_pull("Stores")
+    return await mirror_call(_build_store_directory)
+
+async def mirror_warm_start():
+    """
+    Якщо в дзеркалі вже є дані — одразу віддаємо знімки з нього, а таблиця
+    дочитується фоном при першому ж зверненні (кеш позначено як stale).
+    """
+    if not (await mirror_call(MIRROR.has, "Stores") and await mirror_call(MIRROR.has, "Requests")):
+        return
+    stores = await mirror_call(_build_store_directory)
+    values = await mirror_call(MIRROR.values, "Requests")
+    snap = await asyncio.to_thread(_build_requests_snapshot, values, stores)
+    for cache, value in ((_STORE_CACHE, stores), (_REQ_CACHE, snap)):
+        cache["value"] = value
+        cache["ts"] = time.time() - cache["stale_sec"]
+        cache["gen"] += 1
+    print(f">>> Warm start from local mirror: {len(snap.by_row)} requests", flush=True)
+
+async def get_requests_snapshot(force: bool = False) -> "RequestsSnapshot":
+    """Знімок Requests з кешу; force=True — дочекатися свіжого читання таблиці."""
+    return await _cache_get(_REQ_CACHE, _reload_requests, force)
+
+async def get_store_directory(force: bool = False) -> "StoreDirectory":
+    return await _cache_get(_STORE_CACHE, _reload_stores, force)
+
+async def job_roll_active_window(context: ContextTypes.DEFAULT_TYPE):
+    """Опівночі (Київ) прибирає вчорашні зміни з активного вікна знімка Requests."""
+    snap = _REQ_CACHE["value"]
+    if snap is None:
+        return
+    expired = snap.roll_forward(today_kyiv())
+    _REQ_CACHE["gen"] += 1
+    print(f"[debug] Requests active window -> {snap.active_from}: {expired} expired, {len(snap.active)} active", flush=True)
+
+async def job_refresh_caches(context: ContextTypes.DEFAULT_TYPE):
+    """Періодично оновлює протерміновані кеші, щоб користувачі не чекали на Sheets."""
     now = time.time()
-    if (now - _STORE_CACHE["ts"]) < ttl_sec and _STORE_CACHE["rows"]:
-        return _STORE_CACHE["rows"], True
-    rows = stores_ws.get_all_records()
-    _STORE_CACHE["rows"] = rows
-    _STORE_CACHE["ts"] = now
-    return rows, False
-
-def safe_stores_records():
+    for cache, loader in ((_STORE_CACHE, _reload_stores), (_REQ_CACHE, _reload_requests)):
+        if now - cache["ts"] < cache["stale_sec"]:
+            continue
+        try:
+            await _cache_refresh(cache, loader)
+        except Exception as e:
+            print(f"[debug] {cache['name']} refresh error: {e}", flush=True)
+
+async def safe_store_directory():
     try:
-        rows, _ = get_stores_records(ttl_sec=60)
-        return rows, ""
+        return await get_store_directory(), ""
     except Exception as e:
-        return [], str(e)
+        return StoreDirectory([]), str(e)
 
-def is_active_need_request(r: dict) -> bool:
+def is_active_need_request(request_type: str, record_state: str) -> bool:
     """
     Для поточної логіки бронювання беремо тільки:
     - Потреба у відрядженні
@@ -178,9 +930,6 @@ def is_active_need_request(r: dict) -> bool:
 
     Старі рядки без нових колонок теж пропускаємо, щоб нічого не поламати.
     """
-    request_type = str(r.get("Тип_запиту", "")).strip()
-    record_state = str(r.get("Статус_запису", "")).strip()
-
     if request_type and request_type != REQUEST_TYPE_NEED:
         return False
 
@@ -189,52 +938,557 @@ def is_active_need_request(r: dict) -> bool:
 
     return True
 
-def get_next_requests_row() -> int:
+def _store_key(store_num) -> str:
+    """№_магазину для пошуку — точний збіг, як у таблиці ("054" і "54" — різні магазини)."""
+    return str(store_num).strip()
+
+def _parse_needed(needed_s: str) -> int:
+    """Кількість працівників з колонки "Потрібно" (мінімум 1)."""
+    s = str(needed_s).strip().replace(",", ".")
+    if s.isdigit():
+        needed = int(s)
+    elif s.replace(".", "", 1).isdigit():
+        needed = max(1, int(float(s)))
+    else:
+        needed = 1
+    return max(1, needed)
+
+# ===================== Довідник магазинів =====================
+@dataclass(frozen=True)
+class StoreInfo:
+    num: str
+    city: str
+    oblast: str
+    address: str
+    tm_name: str
+    tm_phone: str
+
+class StoreDirectory:
     """
-    Шукає наступний вільний рядок у Requests не тільки по колонці магазину,
-    бо для заявки "Хочу у відрядження" магазин може бути пустим.
+    Довідник Stores, зібраний один раз на кожне оновлення кешу:
+    пошук по №_магазину за O(1), магазини по місту, міста по регіонах.
+    """
+
+    def __init__(self, rows: List[dict]):
+        self.by_num: Dict[str, StoreInfo] = {}
+        self.by_city: Dict[str, List[StoreInfo]] = {}
+        oblast_by_city: Dict[str, str] = {}
+
+        for r in rows:
+            info = StoreInfo(
+                num=str(r.get("№_магазину", "")).strip(),
+                city=str(r.get("Місто", "")).strip(),
+                oblast=str(r.get("Область", "")).strip(),
+                address=str(r.get("Адреса", "")).strip(),
+                tm_name=str(r.get("ПІБ_ТМ", "")).strip(),
+                tm_phone=str(r.get("Телефон_ТМ", "")).strip(),
+            )
+            self.by_num.setdefault(_store_key(info.num), info)  # як і раніше — перший рядок
+            if info.city:
+                self.by_city.setdefault(info.city, []).append(info)
+            oblast_by_city[info.city] = info.oblast.lower()
+
+        def is_kyiv_area(city: str) -> bool:
+            return ("київ" in city.lower()) or (oblast_by_city.get(city, "") == "київська")
+
+        cities_all = sorted(self.by_city)
+        self.region_cities: Dict[str, List[str]] = {
+            "kyiv": [c for c in cities_all if is_kyiv_area(c)],
+            "other": [c for c in cities_all if not is_kyiv_area(c)],
+        }
+
+    def __bool__(self) -> bool:
+        return bool(self.by_num)
+
+    def get(self, store_num) -> Optional[StoreInfo]:
+        return self.by_num.get(_store_key(store_num))
+
+    def same_cities(self, other: "StoreDirectory") -> bool:
+        """Чи однаково обидва довідники визначають місто магазину (для розбору Requests)."""
+        return other is self or (
+            {n: s.city for n, s in self.by_num.items()} == {n: s.city for n, s in other.by_num.items()}
+        )
+
+    def city_of(self, store_num) -> str:
+        info = self.get(store_num)
+        return info.city if info else ""
+
+    def address_of(self, store_num) -> str:
+        info = self.get(store_num)
+        return info.address if info else ""
+
+    def stores_in(self, city: str) -> List[StoreInfo]:
+        return self.by_city.get(city, [])
+
+    def cities_in_region(self, region: str) -> List[str]:
+        return self.region_cities["kyiv" if region == "kyiv" else "other"]
+
+def _build_store_directory() -> StoreDirectory:
+    """Будує довідник з дзеркала Stores."""
+    return StoreDirectory(records_from_values(MIRROR.table("Stores")))
+
+# ===================== Знімок Requests =====================
+@dataclass(eq=False)
+class RequestRow:
+    """Один рядок Requests, розібраний один раз при завантаженні знімка."""
+    row_idx: int
+    cells: List[str]
+    store: str
+    city: str
+    date_s: str
+    date_obj: Optional[date]
+    time_from: str
+    time_to: str
+    needed: int
+    booked_ids: List[str]
+    status: str
+    note: str
+    created_tg: str
+    request_type: str
+    record_state: str
+    worker_store: str
+    active_need: bool     # "Потреба у відрядженні" + "Активний"
+    status_open: bool     # статус дозволяє показувати зміну у списках
+
+    @property
+    def free(self) -> int:
+        return max(0, self.needed - len(self.booked_ids))
+
+    @property
+    def bookable(self) -> bool:
+        """Зміну можна забронювати: відкритий статус і є вільні місця."""
+        return self.status_open and self.free > 0
+
+def _parse_request_row(row_idx: int, cells: List[str], stores: StoreDirectory) -> RequestRow:
+    cells = [str(c) for c in cells]
+    while len(cells) < COL_WORKER_STORE:
+        cells.append("")
+
+    def cell(col: int) -> str:
+        return cells[col - 1].strip()
+
+    store = cell(COL_STORE)
+    request_type = cell(COL_REQUEST_TYPE)
+    record_state = cell(COL_RECORD_STATE)
+    status = cell(COL_STATUS)
+    status_raw = status.lower()
+    date_s = cell(COL_DATE)
+
+    return RequestRow(
+        row_idx=row_idx,
+        cells=cells,
+        store=store,
+        city=cell(COL_CITY) or stores.city_of(store),
+        date_s=date_s,
+        date_obj=parse_date_flexible(date_s),
+        time_from=cell(COL_TIME_FROM),
+        time_to=cell(COL_TIME_TO),
+        needed=_parse_needed(cell(COL_NEED)),
+        booked_ids=[x.strip() for x in cell(COL_BOOKED).split(",") if x.strip().isdigit()],
+        status=status,
+        note=cell(COL_NOTE),
+        created_tg=cell(COL_CREATED_TG),
+        request_type=request_type,
+        record_state=record_state,
+        worker_store=cell(COL_WORKER_STORE),
+        active_need=is_active_need_request(request_type, record_state),
+        status_open=(
+            status_raw == "" or
+            "pending" in status_raw or
+            "очіку" in status_raw or
+            "підтвер" in status_raw or
+            "confirm" in status_raw
+        ),
+    )
+
+class RequestsSnapshot:
+    """
+    Розібраний знімок аркуша Requests з індексами:
+    - by_row:       row_idx -> RequestRow (усі рядки, включно з історією)
+    - active:       row_idx -> RequestRow лише з датою від active_from (сьогодні) —
+                    "активне вікно", по якому працюють бронювання і "Мої записи"
+    - by_city_date: (місто, дата) -> активні "Потреба у відрядженні" у порядку таблиці
+    - by_creator:   TG_ID автора -> його рядки з активного вікна
+    - free_by_city: місто -> {дата: вільних місць} по bookable-змінах з by_city_date
+    Списки в індексах впорядковані за row_idx. Знімок можна точково оновлювати
+    через apply() після наших власних записів; вікно зсуває roll_forward() опівночі.
+    """
+
+    def __init__(self, rows: List[RequestRow], stores: StoreDirectory, tail_row: int = 1,
+                 active_from: Optional[date] = None):
+        self.stores = stores
+        self.tail_row = tail_row  # останній рядок з даними (для RowAllocator)
+        self.active_from = active_from or today_kyiv()
+        self.by_row: Dict[int, RequestRow] = {}
+        self.active: Dict[int, RequestRow] = {}
+        self.by_city_date: Dict[Tuple[str, date], List[RequestRow]] = {}
+        self.by_creator: Dict[str, List[RequestRow]] = {}
+        self.free_by_city: Dict[str, Dict[date, int]] = {}
+        for r in rows:
+            self._index(r)
+
+    def _in_window(self, r: RequestRow) -> bool:
+        return r.date_obj is not None and r.date_obj >= self.active_from
+
+    def _index_keys(self, r: RequestRow):
+        keys = []
+        if not self._in_window(r):
+            return keys
+        if r.created_tg:
+            keys.append((self.by_creator, r.created_tg))
+        if r.active_need and r.store and r.city and r.date_obj:
+            keys.append((self.by_city_date, (r.city, r.date_obj)))
+        return keys
+
+    def _index(self, r: RequestRow):
+        self.by_row[r.row_idx] = r
+        if self._in_window(r):
+            self.active[r.row_idx] = r
+        for index, key in self._index_keys(r):
+            bisect.insort(index.setdefault(key, []), r, key=lambda x: x.row_idx)
+            if index is self.by_city_date:
+                self._count_free(r, 1)
+
+    def _count_free(self, r: RequestRow, sign: int):
+        if not r.bookable:
+            return
+        days = self.free_by_city.setdefault(r.city, {})
+        n = days.get(r.date_obj, 0) + sign * r.free
+        if n > 0:
+            days[r.date_obj] = n
+        else:
+            days.pop(r.date_obj, None)
+            if not days:
+                self.free_by_city.pop(r.city, None)
+
+    def _unindex(self, r: RequestRow):
+        if self.active.get(r.row_idx) is r:
+            del self.active[r.row_idx]
+        for index, key in self._index_keys(r):
+            lst = index.get(key, [])
+            lst[:] = [x for x in lst if x is not r]
+            if not lst:
+                index.pop(key, None)
+            if index is self.by_city_date:
+                self._count_free(r, -1)
+
+    def apply(self, row_idx: int, updates: Dict[int, str]):
+        """Оновлює (або додає) рядок: updates — {номер колонки (1-based): значення}."""
+        old = self.by_row.get(row_idx)
+        cells = list(old.cells) if old else []
+        for col, value in updates.items():
+            while len(cells) < col:
+                cells.append("")
+            cells[col - 1] = value
+        self.put(row_idx, _parse_request_row(row_idx, cells, self.stores))
+
+    def put(self, row_idx: int, row: Optional[RequestRow]):
+        """Замінює рядок уже розібраним; None — рядок очищено в таблиці."""
+        old = self.by_row.pop(row_idx, None)
+        if old:
+            self._unindex(old)
+        if row is not None:
+            self._index(row)
+            if _has_tail_data(row.cells):
+                self.tail_row = max(self.tail_row, row_idx)
+
+    def has_cells(self, row_idx: int, cells: List[str]) -> bool:
+        """Чи збігається рядок знімка зі значеннями cells (тоді перерозбирати не треба)."""
+        old = self.by_row.get(row_idx)
+        if old is None:
+            return not any(str(c).strip() for c in cells)
+        padded = [str(c) for c in cells] + [""] * (COL_WORKER_STORE - len(cells))
+        return old.cells == padded
+
+    def roll_forward(self, today: date) -> int:
+        """Прибирає з активного вікна рядки з датою до today. Повертає їх кількість."""
+        if today <= self.active_from:
+            return 0
+        expired = [r for r in self.active.values() if r.date_obj < today]
+        for r in expired:
+            self._unindex(r)  # ключі рахуються ще за старим active_from
+        self.active_from = today
+        return len(expired)
+
+    def need_rows(self, city: str, d: date) -> List[RequestRow]:
+        return self.by_city_date.get((city, d), [])
+
+def _build_requests_snapshot(values: Dict[int, List[str]], stores: StoreDirectory) -> RequestsSnapshot:
+    """Будує знімок з рядків дзеркала Requests (MIRROR.values)."""
+    rows = []
+    tail_row = 1
+    for row_idx, cells in values.items():
+        if row_idx < 2 or not any(str(c).strip() for c in cells):  # без заголовка
+            continue
+        rows.append(_parse_request_row(row_idx, cells, stores))
+        if _has_tail_data(cells):
+            tail_row = row_idx
+    return RequestsSnapshot(rows, stores, tail_row)
+
+def _parse_request_rows(rows: Dict[int, List[str]], stores: StoreDirectory) -> Dict[int, Optional[RequestRow]]:
+    """Розбирає окремі рядки для RequestsSnapshot.put(); порожні -> None."""
+    return {
+        row_idx: _parse_request_row(row_idx, cells, stores) if any(str(c).strip() for c in cells) else None
+        for row_idx, cells in rows.items()
+    }
+
+# ===================== Видача нових рядків =====================
+class RowAllocator:
+    """
+    Тримає в пам'яті кінець даних аркуша і видає номери нових рядків під локом,
+    тож одночасні створення ніколи не отримають той самий рядок.
+    Таблицю перечитує (probe) лише при першому виклику або після invalidate();
+    mirrored=True — враховує й наші ще не записані в таблицю рядки з дзеркала.
     """
-    lengths = [
-        len(requests_ws.col_values(COL_STORE)),
-        len(requests_ws.col_values(COL_DATE)),
-        len(requests_ws.col_values(COL_CREATED_TG)),
-        len(requests_ws.col_values(COL_REQUEST_TYPE)),
-    ]
-    return max(lengths) + 1
 
+    def __init__(self, name: str, probe, mirrored: bool = False):
+        self.name = name
+        self._probe = probe        # синхронна функція: номер останнього зайнятого рядка
+        self._mirrored = mirrored  # name — назва аркуша в дзеркалі
+        self._next_row: Optional[int] = None
+        self._lock = asyncio.Lock()
+
+    async def allocate(self) -> int:
+        async with self._lock:
+            if self._next_row is None:
+                last_row = await sheets_call(self._probe)
+                if self._mirrored:
+                    last_row = max(last_row, await mirror_call(MIRROR.last_row, self.name))
+                self._next_row = last_row + 1
+                print(f"[debug] {self.name}: next free row resynced = {self._next_row}", flush=True)
+            row = self._next_row
+            self._next_row += 1
+            return row
+
+    def observe_tail(self, last_row: int):
+        """Свіжі дані з таблиці: якщо хтось дописав рядки вручну — зсуваємо хвіст."""
+        if self._next_row is not None and last_row + 1 > self._next_row:
+            self._next_row = last_row + 1
+
+    def invalidate(self):
+        """Наступна видача перечитає кінець даних із таблиці."""
+        self._next_row = None
+
+    def reset(self, last_row: int):
+        """Кінець даних відомий напевно (щойно прочитали весь аркуш)."""
+        self._next_row = last_row + 1
+
+# Для "Хочу у відрядження" магазин може бути пустим, тому кінець даних
+# визначаємо не лише по колонці магазину
+_REQUESTS_TAIL_COLS = (COL_STORE, COL_DATE, COL_CREATED_TG, COL_REQUEST_TYPE)
+
+def _has_tail_data(cells: List[str]) -> bool:
+    return any(col <= len(cells) and cells[col - 1] != "" for col in _REQUESTS_TAIL_COLS)
+
+def _probe_requests_tail() -> int:
+    cols = requests_ws.batch_get([
+        f"{rowcol_to_a1(1, col)[:-1]}:{rowcol_to_a1(1, col)[:-1]}" for col in _REQUESTS_TAIL_COLS
+    ])
+    return max(len(c) for c in cols)
+
+def _probe_attendance_tail() -> int:
+    return len(_ATTENDANCE_WS.col_values(1))
+
+# у дзеркалі можуть бути наші ще не записані в таблицю рядки
+REQUESTS_ROWS = RowAllocator("Requests", _probe_requests_tail, mirrored=True)
+ATTENDANCE_ROWS = RowAllocator("Attendance", _probe_attendance_tail, mirrored=True)
+
+async def requests_append_row(updates: Dict[int, object]) -> int:
+    """Створює новий рядок Requests одним записом; повертає його номер."""
+    row_idx = await REQUESTS_ROWS.allocate()
+    try:
+        await requests_patch_row(row_idx, updates, raw=True)
+    except Exception:
+        REQUESTS_ROWS.invalidate()
+        raise
+    return row_idx
 
-def save_want_trip_request(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    next_row = get_next_requests_row()
 
+async def save_want_trip_request(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     trip_date = context.user_data.get("trip_date", "")
     try:
         trip_date_str = datetime.strptime(trip_date, "%Y-%m-%d").strftime("%d.%m.%Y")
     except Exception:
         trip_date_str = str(trip_date)
 
-    payload = [
-        {'range': f'D{next_row}:F{next_row}', 'values': [[
-            trip_date_str,
-            context.user_data.get("trip_time_from", ""),
-            context.user_data.get("trip_time_to", "")
-        ]]},
-        {'range': f'I{next_row}:J{next_row}', 'values': [[
-            "",
-            context.user_data.get("trip_comment", "")
-        ]]},
-        {'range': f'K{next_row}:L{next_row}', 'values': [[
-            str(context.user_data.get("creator_tg") or update.effective_user.id),
-            str(context.user_data.get("creator_phone") or "")
-        ]]},
-        {'range': f'R{next_row}:T{next_row}', 'values': [[
-            REQUEST_TYPE_WANT,
-            RECORD_STATE_ACTIVE,
-            context.user_data.get("worker_store", "")
-        ]]},
-    ]
+    return await requests_append_row({
+        COL_DATE: trip_date_str,
+        COL_TIME_FROM: context.user_data.get("trip_time_from", ""),
+        COL_TIME_TO: context.user_data.get("trip_time_to", ""),
+        COL_STATUS: "",
+        COL_NOTE: context.user_data.get("trip_comment", ""),
+        COL_CREATED_TG: str(context.user_data.get("creator_tg") or update.effective_user.id),
+        COL_CREATED_PH: str(context.user_data.get("creator_phone") or ""),
+        COL_REQUEST_TYPE: REQUEST_TYPE_WANT,
+        COL_RECORD_STATE: RECORD_STATE_ACTIVE,
+        COL_WORKER_STORE: context.user_data.get("worker_store", ""),
+    })
+
+# ===================== Черга вихідних повідомлень =====================
+# Пріоритети: менше — раніше
+PRIO_HIGH   = 0  # нагадування, запити/підтвердження керівника
+PRIO_NORMAL = 1  # HR-канал
+PRIO_LOW    = 2  # службові меню
+
+@dataclass(order=True)
+class _OutMessage:
+    priority: int
+    seq: int
+    chat_key: str = field(compare=False)
+    kwargs: dict = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    queued_at: float = field(compare=False)
+    attempts: int = field(default=0, compare=False)
+
+class OutboundQueue:
+    """
+    Єдина точка відправки фонових повідомлень: пріоритетна черга з загальним
+    і по-чатовим лімітом, повтором після RetryAfter/мережевих збоїв і метриками.
+    send_message() не блокує: повертає future з Message (або None, якщо не вдалося).
+    """
+
+    def __init__(self, global_rate: float, chat_interval: float, group_interval: float, max_attempts: int):
+        self.global_interval = 1.0 / global_rate if global_rate > 0 else 0.0
+        self.chat_interval = chat_interval
+        self.group_interval = group_interval
+        self.max_attempts = max_attempts
+        self.bot = None
+        self._heap: List[_OutMessage] = []
+        self._seq = 0
+        self._chat_ready: Dict[str, float] = {}  # чат -> коли можна слати наступне
+        self._next_send = 0.0                     # загальний ліміт / пауза після flood
+        self._wakeup = asyncio.Event()
+        self._worker: Optional[asyncio.Task] = None
+        self._inflight = set()
+        self.metrics = {
+            "queued": 0, "sent": 0, "failed": 0, "retried": 0, "retry_after": 0,
+            "max_depth": 0, "latency_sum": 0.0,
+        }
+
+    def __len__(self):
+        return len(self._heap)
+
+    def send_message(self, chat_id, text: str, priority: int = PRIO_NORMAL, **kwargs) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        self._push(_OutMessage(
+            priority, self._seq, str(chat_id),
+            {"chat_id": chat_id, "text": text, **kwargs}, fut, time.monotonic(),
+        ))
+        self.metrics["queued"] += 1
+        self.metrics["max_depth"] = max(self.metrics["max_depth"], len(self._heap))
+        return fut
+
+    def _push(self, msg: _OutMessage):
+        heapq.heappush(self._heap, msg)
+        self._wakeup.set()
+
+    def _interval_for(self, chat_key: str) -> float:
+        return self.group_interval if chat_key.startswith("-") else self.chat_interval
+
+    def _pop_ready(self, now: float) -> Tuple[Optional[_OutMessage], Optional[float]]:
+        """Найпріоритетніше повідомлення, чий чат уже можна слати; інакше — коли з'явиться."""
+        skipped, found, wake_at = [], None, None
+        while self._heap:
+            msg = heapq.heappop(self._heap)
+            ready_at = self._chat_ready.get(msg.chat_key, 0.0)
+            if ready_at <= now:
+                found = msg
+                break
+            skipped.append(msg)
+            wake_at = ready_at if wake_at is None else min(wake_at, ready_at)
+        for msg in skipped:
+            heapq.heappush(self._heap, msg)
+        return found, wake_at
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            if now < self._next_send:
+                await asyncio.sleep(self._next_send - now)
+                continue
+            msg, wake_at = self._pop_ready(now)
+            if msg is None:
+                self._wakeup.clear()
+                timeout = None if wake_at is None else max(0.0, wake_at - now)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self._chat_ready[msg.chat_key] = now + self._interval_for(msg.chat_key)
+            self._next_send = now + self.global_interval
+            task = asyncio.create_task(self._deliver(msg))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _deliver(self, msg: _OutMessage):
+        msg.attempts += 1
+        try:
+            result = await self.bot.send_message(**msg.kwargs)
+        except RetryAfter as e:
+            # flood control: пауза для всіх відправок, повідомлення — назад у чергу
+            delay = float(e.retry_after)
+            self.metrics["retry_after"] += 1
+            self._next_send = max(self._next_send, time.monotonic() + delay)
+            self._retry(msg, delay, e)
+        except (BadRequest, Forbidden) as e:
+            # BadRequest у PTB — підклас NetworkError, тому ловимо його раніше:
+            # невалідний текст/розмітка, "chat not found" — повтор не допоможе
+            self._fail(msg, e)
+        except NetworkError as e:  # у т.ч. TimedOut
+            self._retry(msg, min(2 ** msg.attempts, 60), e)
+        except Exception as e:  # інші помилки API — повтор теж не допоможе
+            self._fail(msg, e)
+        else:
+            self.metrics["sent"] += 1
+            self.metrics["latency_sum"] += time.monotonic() - msg.queued_at
+            if not msg.future.done():
+                msg.future.set_result(result)
+
+    def _retry(self, msg: _OutMessage, delay: float, err: Exception):
+        if msg.attempts >= self.max_attempts:
+            self._fail(msg, err)
+            return
+        self.metrics["retried"] += 1
+        self._chat_ready[msg.chat_key] = max(self._chat_ready.get(msg.chat_key, 0.0), time.monotonic() + delay)
+        self._push(msg)
+
+    def _fail(self, msg: _OutMessage, err: Exception):
+        self.metrics["failed"] += 1
+        print(f"[debug] outbox: send to {msg.chat_key} failed after {msg.attempts} attempt(s): {err}", flush=True)
+        if not msg.future.done():
+            msg.future.set_result(None)
+
+    def start(self, bot):
+        self.bot = bot
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self, drain_timeout: float = 10.0):
+        """Дочікується відправки черги (не довше drain_timeout) і зупиняє воркер."""
+        deadline = time.monotonic() + drain_timeout
+        while (self._heap or self._inflight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        if self._heap:
+            print(f"[debug] outbox: {len(self._heap)} messages not sent on shutdown", flush=True)
+
+    def metrics_line(self) -> str:
+        m = self.metrics
+        avg = m["latency_sum"] / m["sent"] if m["sent"] else 0.0
+        return (
+            f"queued={m['queued']} sent={m['sent']} failed={m['failed']} retried={m['retried']} "
+            f"retry_after={m['retry_after']} depth={len(self._heap)} max_depth={m['max_depth']} "
+            f"avg_latency={avg:.2f}s"
+        )
 
-    requests_ws.batch_update(payload)
-    return next_row
+OUTBOX = OutboundQueue(OUTBOX_GLOBAL_RATE, OUTBOX_CHAT_INTERVAL_SEC, OUTBOX_GROUP_INTERVAL_SEC, OUTBOX_MAX_ATTEMPTS)
+
+async def job_log_outbox_metrics(context: ContextTypes.DEFAULT_TYPE):
+    print(f"[debug] outbox metrics: {OUTBOX.metrics_line()}", flush=True)
 
 async def send_hr_channel_notification(
     context: ContextTypes.DEFAULT_TYPE,
@@ -261,81 +1515,159 @@ async def send_hr_channel_notification(
             f"Коментар: {note or '—'}"
         )
 
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("Перейти в бот", url=f"https://t.me/{BOT_USERNAME}")]
-        ])
+        # зміни на сьогодні — завжди одразу, решта може йти дайджестом
+        urgent = parse_date_flexible(date_str) == today_kyiv()
+        if HR_DIGEST_MODE and not urgent:
+            await hr_digest_add({
+                "type": request_type, "date": date_str, "time_from": time_from, "time_to": time_to,
+                "store": store if request_type != REQUEST_TYPE_WANT else worker_store, "note": note,
+            })
+            return
 
-        await context.bot.send_message(
-            chat_id=HR_CHANNEL_CHAT_ID,
-            text=text,
-            reply_markup=kb
-        )
+        OUTBOX.send_message(HR_CHANNEL_CHAT_ID, text, PRIO_NORMAL, reply_markup=hr_channel_keyboard())
     except Exception as e:
         print(f"[debug] HR channel notify error: {e}", flush=True)
 
-def get_my_created_records(tg_id: int):
-    rows = requests_ws.get_all_values()
-    today = today_kyiv()
-    result = []
+def hr_channel_keyboard():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("Перейти в бот", url=f"https://t.me/{BOT_USERNAME}")]
+    ])
 
-    for row_idx, row in enumerate(rows[1:], start=2):  # без заголовка
-        while len(row) < COL_WORKER_STORE:
-            row.append("")
+# ===================== HR-дайджест =====================
+# Записи, що чекають на спільне повідомлення в HR-канал
+_HR_DIGEST: List[dict] = []
+_HR_DIGEST_FIRST_TS = 0.0
 
-        created_tg = str(row[COL_CREATED_TG - 1]).strip()
-        if created_tg != str(tg_id):
-            continue
+async def hr_digest_add(item: dict):
+    global _HR_DIGEST_FIRST_TS
+    if not _HR_DIGEST:
+        _HR_DIGEST_FIRST_TS = time.time()
+    _HR_DIGEST.append(item)
+    if len(_HR_DIGEST) >= HR_DIGEST_MAX:
+        await hr_digest_flush()
 
-        record_state = str(row[COL_RECORD_STATE - 1]).strip()
-        if record_state and record_state != RECORD_STATE_ACTIVE:
-            continue
+TELEGRAM_TEXT_LIMIT = 4096
 
-        date_s = str(row[COL_DATE - 1]).strip()
-        d = parse_date_flexible(date_s)
-        if not d or d < today:
-            continue
+def split_lines_to_messages(lines: List[str], limit: int = TELEGRAM_TEXT_LIMIT) -> List[str]:
+    """
+    Складає рядки в тексти до limit символів, розриваючи лише між рядками.
+    Рядок, довший за limit, ріжеться на шматки — нічого не губиться.
+    """
+    parts, cur, size = [], [], 0
+    for line in lines:
+        pieces = [line[i:i + limit] for i in range(0, len(line), limit)] or [""]
+        for piece in pieces:
+            extra = len(piece) + (1 if cur else 0)
+            if cur and size + extra > limit:
+                parts.append("\n".join(cur))
+                cur, size, extra = [], 0, len(piece)
+            cur.append(piece)
+            size += extra
+    if cur:
+        parts.append("\n".join(cur))
+    return parts
+
+async def hr_digest_flush():
+    """
+    Повідомлення на кожну пару (тип, місто) з усіма накопиченими записами;
+    якщо записи не вміщаються в ліміт Telegram — кілька повідомлень, розбитих між рядками.
+    """
+    if not _HR_DIGEST:
+        return
+    items = list(_HR_DIGEST)
+    _HR_DIGEST.clear()
+
+    stores, _ = await safe_store_directory()
+    groups: Dict[Tuple[str, str], List[dict]] = {}
+    for it in items:
+        city = stores.city_of(it["store"]) or "—"
+        groups.setdefault((it["type"], city), []).append(it)
+
+    sent = 0
+    for (request_type, city), group in sorted(groups.items()):
+        tt_label = "ТТ працівника" if request_type == REQUEST_TYPE_WANT else "ТТ"
+        lines = []
+        for it in sorted(group, key=lambda x: (parse_date_flexible(x["date"]) or date.max, x["time_from"])):
+            line = f"• {it['date']} {it['time_from']}–{it['time_to']}, {tt_label} {it['store'] or '—'}"
+            if it["note"]:
+                line += f" — {it['note']}"
+            lines.append(line)
+
+        # запас під заголовок, який додається до кожної частини
+        chunks = split_lines_to_messages(lines, TELEGRAM_TEXT_LIMIT - 300)
+        for i, chunk in enumerate(chunks, start=1):
+            title = f"🔔 Нові записи: {len(group)}"
+            if len(chunks) > 1:
+                title += f" (частина {i}/{len(chunks)})"
+            header = f"{title}\nТип: {request_type}\nМісто: {city}\n\n"
+            OUTBOX.send_message(HR_CHANNEL_CHAT_ID, header + chunk, PRIO_NORMAL,
+                                reply_markup=hr_channel_keyboard())
+            sent += 1
+    print(f"[debug] HR digest sent: {len(items)} records in {sent} messages", flush=True)
+
+async def job_hr_digest(context: ContextTypes.DEFAULT_TYPE):
+    if _HR_DIGEST and time.time() - _HR_DIGEST_FIRST_TS >= HR_DIGEST_WINDOW_SEC:
+        try:
+            await hr_digest_flush()
+        except Exception as e:
+            print(f"[debug] HR digest error: {e}", flush=True)
 
-        request_type = str(row[COL_REQUEST_TYPE - 1]).strip()
-        store = str(row[COL_STORE - 1]).strip()
-        worker_store = str(row[COL_WORKER_STORE - 1]).strip()
-        time_from = str(row[COL_TIME_FROM - 1]).strip()
-        time_to = str(row[COL_TIME_TO - 1]).strip()
-        note = str(row[COL_NOTE - 1]).strip()
+def _my_created_record(r: RequestRow, today: date) -> Optional[dict]:
+    """Рядок знімка -> запис для "Створені мною записи" (None, якщо неактивний)."""
+    if r.record_state and r.record_state != RECORD_STATE_ACTIVE:
+        return None
 
-        if not request_type:
-            request_type = REQUEST_TYPE_NEED if store else REQUEST_TYPE_WANT
+    # by_creator містить лише активне вікно; перевірка дати — на випадок,
+    # якщо нічний зсув вікна ще не відпрацював
+    d = r.date_obj
+    if not d or d < today:
+        return None
 
-        result.append({
-            "row_idx": row_idx,
-            "date_obj": d,
-            "date_str": d.strftime("%d.%m.%Y"),
-            "request_type": request_type,
-            "store": store,
-            "worker_store": worker_store,
-            "time_from": time_from,
-            "time_to": time_to,
-            "note": note,
-        })
+    request_type = r.request_type
+    if not request_type:
+        request_type = REQUEST_TYPE_NEED if r.store else REQUEST_TYPE_WANT
+
+    return {
+        "row_idx": r.row_idx,
+        "date_obj": d,
+        "date_str": d.strftime("%d.%m.%Y"),
+        "request_type": request_type,
+        "store": r.store,
+        "worker_store": r.worker_store,
+        "time_from": r.time_from,
+        "time_to": r.time_to,
+        "note": r.note,
+    }
 
+async def get_my_created_records(tg_id: int):
+    # наші власні створення/зміни вже накладені на знімок (write-through),
+    # тож свіже читання таблиці не потрібне
+    snap = await get_requests_snapshot()
+    today = today_kyiv()
+    result = [
+        rec for rec in (_my_created_record(r, today) for r in snap.by_creator.get(str(tg_id), []))
+        if rec
+    ]
     result.sort(key=lambda x: (x["date_obj"], x["time_from"], x["row_idx"]))
     return result
 
+async def find_my_created_record(tg_id: int, row_idx: int) -> Optional[dict]:
+    """Один активний запис автора за номером рядка — O(1) по знімку, без читання таблиці."""
+    snap = await get_requests_snapshot()
+    r = snap.active.get(row_idx)
+    if r is None or r.created_tg != str(tg_id):
+        return None
+    return _my_created_record(r, today_kyiv())
+
 
 # ===================== Утиліти =====================
-def get_store_meta(store_num: str) -> Tuple[str, str, str, str, str]:
+async def get_store_meta(store_num: str) -> Tuple[str, str, str, str, str]:
     """Повертає (місто, область, адреса, ПІБ_ТМ, Телефон_ТМ) по №_магазину."""
-    rows, _ = safe_stores_records()
-    s = str(store_num).strip()
-    for r in rows:
-        if str(r.get("№_магазину","")).strip() == s:
-            return (
-                str(r.get("Місто","")).strip(),
-                str(r.get("Область","")).strip(),
-                str(r.get("Адреса","")).strip(),
-                str(r.get("ПІБ_ТМ","")).strip(),
-                str(r.get("Телефон_ТМ","")).strip(),
-            )
-    return "", "", "", "", ""
+    stores, _ = await safe_store_directory()
+    info = stores.get(store_num)
+    if not info:
+        return "", "", "", "", ""
+    return info.city, info.oblast, info.address, info.tm_name, info.tm_phone
 
 def parse_date_flexible(s: str) -> Optional[date]:
     s = (s or "").strip()
@@ -346,10 +1678,130 @@ def parse_date_flexible(s: str) -> Optional[date]:
             continue
     return None
 
-def jobqueue_add(job_type: str, chat_id: int, row_idx: int, when_dt: datetime, text: str):
-    """Додає задачу в Google Sheets JobQueue"""
+# ===================== JobQueue: індекс і відкладений запис =====================
+# Колонки JobQueue: id | type | chat_id | row_idx | when | text | done
+JOBQUEUE_HEADER = ["id", "type", "chat_id", "row_idx", "when", "text", "done"]
+JQ_COL_DONE = 7
+
+# job_id -> рядок у JobQueue (лише невиконані задачі); наповнюється в jobqueue_load_all
+_JOBQUEUE_INDEX: Dict[str, int] = {}
+
+JOBQUEUE_ROWS = RowAllocator("JobQueue", lambda: len(jobqueue_ws.col_values(1)))
+
+# Зміни JobQueue йдуть у локальне дзеркало і пишуться в таблицю пачкою.
+# Після старту (jobqueue_load_all) індекс _JOBQUEUE_INDEX змінюється лише разом
+# із записом у дзеркало, в потоці дзеркала (mirror_call), — тож компакція
+# не розійдеться з позначками "done".
+def _jobqueue_put(job_id: str, row_idx: int, cells: List[str]):
+    MIRROR.write("JobQueue", row_idx, dict(zip(range(1, 8), cells)), raw=True)
+    _JOBQUEUE_INDEX[job_id] = row_idx
+
+def _jobqueue_set_done(job_id: str, done: str) -> bool:
+    row_idx = _JOBQUEUE_INDEX.pop(job_id, None)
+    if row_idx is None:
+        return False
+    MIRROR.write("JobQueue", row_idx, {JQ_COL_DONE: done}, raw=True)
+    return True
+
+def _jobqueue_renumber(keep: List[List[str]], old_len: int, moved: Dict[int, int]) -> int:
+    """
+    Після перезапису аркуша: переносить дзеркало й індекс на нову нумерацію.
+    Нові задачі (рядки за old_len), що з'явились під час запису, — у кінець.
+    Повертає останній зайнятий рядок.
+    """
+    tail = len(keep) + 1
+    for old_row in sorted({e[1] for e in MIRROR.pending("JobQueue")}):
+        if old_row > old_len:
+            tail += 1
+            moved[old_row] = tail
+    MIRROR.renumber("JobQueue", [JOBQUEUE_HEADER] + keep, moved)
+    for job_id, old_row in list(_JOBQUEUE_INDEX.items()):
+        if old_row in moved:
+            _JOBQUEUE_INDEX[job_id] = moved[old_row]
+        else:
+            _JOBQUEUE_INDEX.pop(job_id)
+    return tail
+
+async def jobqueue_flush():
+    """Скидає незаписані зміни JobQueue з дзеркала в таблицю."""
+    await mirror_push(("JobQueue",))
+
+def _jobqueue_is_stale(cells: List[str], cutoff: datetime) -> bool:
+    """Виконана або давно протермінована задача, яку вже можна прибрати з JobQueue."""
+    r = dict(zip(JOBQUEUE_HEADER, cells))
+    try:
+        when_dt = datetime.fromisoformat(r.get("when", ""))
+    except ValueError:
+        return r.get("done", "no") in ("yes", "failed")
+    if when_dt.tzinfo is None:
+        when_dt = when_dt.replace(tzinfo=KYIV_TZ)
+    return when_dt < cutoff
+
+def _jobqueue_rewrite(keep: List[List[str]], old_len: int, archived: List[List[str]]):
+    """
+    Синхронно: дописує архів і переписує JobQueue лише живими рядками.
+    Архів ідемпотентний за id задачі: якщо минулого разу перезапис JobQueue
+    впав уже після архівації, ті самі рядки вдруге не дописуються.
+    """
+    if archived and JOBQUEUE_ARCHIVE_SHEET:
+        try:
+            archive_ws = ss.worksheet(JOBQUEUE_ARCHIVE_SHEET)
+        except gspread.WorksheetNotFound:
+            archive_ws = ss.add_worksheet(JOBQUEUE_ARCHIVE_SHEET, rows=1000, cols=7)
+            archive_ws.append_row(JOBQUEUE_HEADER)
+        known_ids = set(archive_ws.col_values(1))
+        fresh = [cells for cells in archived if not cells or cells[0] not in known_ids]
+        if fresh:
+            archive_ws.append_rows(fresh)
+    rows = [JOBQUEUE_HEADER] + keep
+    jobqueue_ws.update(f"A1:{rowcol_to_a1(len(rows), len(JOBQUEUE_HEADER))}", rows)
+    if old_len > len(rows):
+        jobqueue_ws.batch_clear([f"A{len(rows) + 1}:{rowcol_to_a1(old_len, len(JOBQUEUE_HEADER))}"])
+
+async def jobqueue_compact() -> int:
+    """
+    Переносить виконані та протерміновані задачі в архів одним пакетом і
+    перенумеровує живі рядки в індексі. Повертає кількість прибраних рядків.
+    """
+    async with mirror_sheet_lock("JobQueue"):
+        await _mirror_push_locked("JobQueue")
+        values = await sheets_call(jobqueue_ws.get_all_values)
+        old_len = len(values)
+        cutoff = now_kyiv() - timedelta(days=JOBQUEUE_RETENTION_DAYS)
+
+        keep, archived, moved = [], [], {}  # moved: старий рядок -> новий
+        for old_row, cells in enumerate(values[1:], start=2):
+            if not any(cells):
+                continue
+            if _jobqueue_is_stale(cells, cutoff):
+                archived.append(cells)
+            else:
+                keep.append(cells)
+                moved[old_row] = len(keep) + 1
+        if not archived:
+            return 0
+
+        await sheets_call(_jobqueue_rewrite, keep, old_len, archived)
+
+        # Поки йшов запис, могли з'явитись нові задачі (рядки за old_len) і позначки
+        # "done" за старими номерами — переносимо їх у нову нумерацію.
+        tail = await mirror_call(_jobqueue_renumber, keep, old_len, moved)
+        JOBQUEUE_ROWS.reset(tail)
+
+    print(f"[debug] JobQueue compacted: {len(archived)} rows archived, {len(keep)} kept", flush=True)
+    return len(archived)
+
+async def job_compact_jobqueue(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await jobqueue_compact()
+    except Exception as e:
+        print(f"[debug] JobQueue compaction error: {e}", flush=True)
+
+async def jobqueue_add(job_type: str, chat_id: int, row_idx: int, when_dt: datetime, text: str):
+    """Додає задачу в JobQueue (запис у таблицю — з найближчим flush)"""
     new_id = str(uuid.uuid4())
-    jobqueue_ws.append_row([
+    jq_row = await JOBQUEUE_ROWS.allocate()
+    await mirror_call(_jobqueue_put, new_id, jq_row, [
         new_id,
         job_type,
         str(chat_id),
@@ -360,51 +1812,141 @@ def jobqueue_add(job_type: str, chat_id: int, row_idx: int, when_dt: datetime, t
     ])
     return new_id
 
-def jobqueue_mark_done(job_id: str):
-    """Позначає задачу виконаною"""
-    rows = jobqueue_ws.get_all_values()
-    for idx, r in enumerate(rows, start=1):
-        if r and r[0] == job_id:
-            jobqueue_ws.update_cell(idx, 7, "yes")
-            return
+async def jobqueue_mark_done(job_id: str, done: str = "yes"):
+    """Позначає задачу виконаною ("yes") або остаточно невдалою ("failed")."""
+    if not await mirror_call(_jobqueue_set_done, job_id, done):
+        print(f"[debug] JobQueue: unknown job {job_id}", flush=True)
 
-async def jobqueue_runner(context: ContextTypes.DEFAULT_TYPE):
-    """Виконується при настанні події run_once"""
-    data = context.job.data
-    job_id = data.get("job_id")
+def send_reminder(data: dict) -> List[asyncio.Future]:
+    """
+    Ставить у чергу одне нагадування (для arrival — ще й кнопку підтвердження).
+    Повертає future відправок: задачу можна вважати виконаною лише після них.
+    """
     job_type = data.get("type")
     chat_id = data.get("chat_id")
     row_idx = data.get("row_idx")
     text = data.get("text")
+    futures = []
 
     # 1 — шлемо
-    if chat_id:
-        try:
-            await context.bot.send_message(chat_id=chat_id, text=text)
-        except Exception:
-            pass
+    if chat_id and text:
+        futures.append(OUTBOX.send_message(chat_id, text, PRIO_HIGH))
 
     # 2 — спец. випадок arrival
-    if job_type == "arrival":
+    if chat_id and job_type == "arrival":
         kb = InlineKeyboardMarkup([
             [InlineKeyboardButton("✅ Я прибув(ла)", callback_data=f"arrived:{row_idx}")]
         ])
-        try:
-            await context.bot.send_message(chat_id=chat_id, text="Будь ласка, підтвердьте прибуття:", reply_markup=kb)
-        except Exception:
-            pass
+        futures.append(OUTBOX.send_message(chat_id, "Будь ласка, підтвердьте прибуття:", PRIO_HIGH, reply_markup=kb))
+
+    return futures
+
+# ===================== Планувальник нагадувань =====================
+class ReminderScheduler:
+    """
+    Невиконані нагадування лежать у кошиках по REMINDER_BUCKET_SEC секунд.
+    Одна повторювана джоба будиться раз на кошик і розсилає все, що настало,
+    пачками з паузою між ними — замість окремого таймера run_once на кожне нагадування.
+    "done" у JobQueue ставиться лише після фактичної доставки; недоставлене
+    повертається в кошики, а при зупинці бота лишається невиконаним у JobQueue.
+    """
 
-    # 3 — позначаємо виконаною
-    jobqueue_mark_done(job_id)
+    def __init__(self, bucket_sec: int, batch_size: int, batch_pause_sec: float):
+        self.bucket_sec = max(1, bucket_sec)
+        self.batch_size = max(1, batch_size)
+        self.batch_pause_sec = batch_pause_sec
+        self._buckets: Dict[int, List[dict]] = {}  # номер кошика -> нагадування
+        self._heap: List[int] = []                  # номери кошиків (min-heap)
+        self._running = False
+        self._settling = set()                      # задачі, що чекають на доставку
+
+    def __len__(self):
+        return sum(len(items) for items in self._buckets.values())
+
+    def add(self, when_dt: datetime, data: dict):
+        # округляємо вгору: нагадування не надсилається раніше свого часу
+        key = -int(-when_dt.timestamp() // self.bucket_sec)
+        items = self._buckets.get(key)
+        if items is None:
+            items = self._buckets[key] = []
+            heapq.heappush(self._heap, key)
+        items.append(data)
+
+    def pop_due(self, now_ts: float) -> List[dict]:
+        due = []
+        while self._heap and self._heap[0] * self.bucket_sec <= now_ts:
+            due.extend(self._buckets.pop(heapq.heappop(self._heap)))
+        return due
+
+    async def dispatch_due(self):
+        if self._running:  # попередня розсилка ще йде
+            return
+        self._running = True
+        try:
+            due = self.pop_due(time.time())
+            if not due:
+                return
+            for i in range(0, len(due), self.batch_size):
+                if i:
+                    await asyncio.sleep(self.batch_pause_sec)
+                for data in due[i:i + self.batch_size]:
+                    task = asyncio.create_task(self._settle(data, send_reminder(data)))
+                    self._settling.add(task)
+                    task.add_done_callback(self._settling.discard)
+            print(f"[debug] reminders dispatched: {len(due)}", flush=True)
+        finally:
+            self._running = False
+
+    async def _settle(self, data: dict, futures: List[asyncio.Future]):
+        """Чекає на відправку нагадування; "done" — лише якщо всі повідомлення дійшли."""
+        # return_exceptions: скасований future — це невдача, а не скасування нас самих;
+        # якщо ж скасовують цю задачу (зупинка бота), задача лишається в JobQueue
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        if all(r is not None and not isinstance(r, BaseException) for r in results):
+            await jobqueue_mark_done(data["job_id"])
+            return
 
-def jobqueue_load_all(app):
+        attempts = data.get("attempts", 0) + 1
+        if attempts >= REMINDER_MAX_RETRIES:
+            print(f"[debug] reminder {data['job_id']} failed after {attempts} dispatch(es)", flush=True)
+            await jobqueue_mark_done(data["job_id"], done="failed")
+            return
+        data["attempts"] = attempts
+        self.add(datetime.now(KYIV_TZ) + timedelta(seconds=REMINDER_RETRY_SEC * attempts), data)
+
+REMINDERS = ReminderScheduler(REMINDER_BUCKET_SEC, REMINDER_BATCH_SIZE, REMINDER_BATCH_PAUSE_SEC)
+
+async def job_dispatch_reminders(context: ContextTypes.DEFAULT_TYPE):
+    await REMINDERS.dispatch_due()
+
+async def schedule_reminder(job_type: str, chat_id: int, row_idx: int, when_dt: datetime, text: str):
+    """Зберігає нагадування в JobQueue і ставить його в планувальник."""
+    job_id = await jobqueue_add(job_type, chat_id, row_idx, when_dt, text)
+    REMINDERS.add(when_dt, {
+        "job_id": job_id,
+        "type": job_type,
+        "chat_id": chat_id,
+        "row_idx": row_idx,
+        "text": text,
+    })
+    return job_id
+
+async def jobqueue_load_all():
     """Перечитує всі задачі з таблиці при запуску бота
-       і запускає їх у job_queue повторно."""
-    rows = jobqueue_ws.get_all_records()
+       і повертає їх у планувальник нагадувань."""
+    # дзеркало вже містить і незаписані зміни з попереднього запуску
+    await mirror_pull("JobQueue")
+    values = await mirror_call(MIRROR.values, "JobQueue")
+    if 1 not in values:
+        await mirror_call(MIRROR.write, "JobQueue", 1, dict(zip(range(1, 8), JOBQUEUE_HEADER)), True)
+    JOBQUEUE_ROWS.reset(max(values, default=1))
     now = now_kyiv()
 
-    for r in rows:
-        if r.get("done", "no") == "yes":
+    for jq_row, cells in values.items():
+        if jq_row < 2:  # без заголовка
+            continue
+        r = dict(zip(JOBQUEUE_HEADER, cells))
+        if r.get("done", "no") in ("yes", "failed"):
             continue
 
         try:
@@ -417,78 +1959,98 @@ def jobqueue_load_all(app):
         except Exception:
             continue
 
-        delay = (when_dt - now).total_seconds()
-        if delay < 0:
-            delay = 2
-
-        app.job_queue.run_once(
-            jobqueue_runner,
-            when=delay,
-            data={
-                "job_id": job_id,
-                "type": job_type,
-                "chat_id": chat_id,
-                "row_idx": row_idx,
-                "text": text
-            },
-            name=f"job_{job_id}"
-        )
+        _JOBQUEUE_INDEX[job_id] = jq_row
+        # протерміновані (бот був вимкнений) — на найближчий тік
+        REMINDERS.add(max(when_dt, now), {
+            "job_id": job_id,
+            "type": job_type,
+            "chat_id": chat_id,
+            "row_idx": row_idx,
+            "text": text
+        })
 
 # ===================== Клавіатури: регіон/місто/магазини =====================
+class KeyboardCache:
+    """
+    LRU готових InlineKeyboardMarkup. У ключ входить gen знімка Stores/Requests,
+    тож після оновлення даних старі клавіатури просто перестають збігатися і витісняються.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = max(1, maxsize)
+        self._data: "OrderedDict[tuple, InlineKeyboardMarkup]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple, build):
+        kb = self._data.get(key)
+        if kb is not None:
+            self._data.move_to_end(key)
+            self.hits += 1
+            return kb
+
+        self.misses += 1
+        kb = build()
+        # None ("немає даних") не кешуємо — наступний виклик перевірить ще раз
+        if kb is not None:
+            self._data[key] = kb
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return kb
+
+KEYBOARDS = KeyboardCache(KEYBOARD_CACHE_SIZE)
+
 def build_region_keyboard():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("Київ і область", callback_data="region:kyiv")],
         [InlineKeyboardButton("Інші міста", callback_data="region:other")]
     ])
 
-def build_cities_keyboard_region(region: str):
-    rows, _ = safe_stores_records()
-    if not rows:
+async def build_cities_keyboard_region(region: str):
+    stores, _ = await safe_store_directory()
+    if not stores:
         return None
+    return KEYBOARDS.get(
+        ("cities", region, _STORE_CACHE["gen"]),
+        lambda: _cities_keyboard(stores, region),
+    )
 
-    cities_all = sorted({str(r.get("Місто", "")).strip() for r in rows if str(r.get("Місто", "")).strip()})
-    oblast_map = {
-        str(r.get("Місто", "")).strip(): str(r.get("Область", "")).strip().lower()
-        for r in rows
-    }
-
-    def is_kyiv_area(city: str) -> bool:
-        c = city.lower()
-        return ("київ" in c) or (oblast_map.get(city, "") == "київська")
-
-    if region == "kyiv":
-        cities = [c for c in cities_all if is_kyiv_area(c)]
-    else:
-        cities = [c for c in cities_all if not is_kyiv_area(c)]
-
+def _cities_keyboard(stores: "StoreDirectory", region: str):
+    cities = stores.cities_in_region(region)
     if not cities:
         return None
 
+    # довгі назви міст не влазять у 64 байти callback_data — передаємо токени,
+    # видані разом на всю клавіатуру
+    tokens = CALLBACK_TOKENS.issue_many([{"city": city} for city in cities], stable=True)
+
     # 2 колонки
     buttons, row = [], []
-    for i, city in enumerate(cities, 1):
-        row.append(InlineKeyboardButton(city, callback_data=f"pickcity:{city}"))
+    for i, (city, token) in enumerate(zip(cities, tokens), 1):
+        row.append(InlineKeyboardButton(city, callback_data=f"pickcity:#{token}"))
         if i % 2 == 0:
             buttons.append(row); row = []
     if row: buttons.append(row)
     return InlineKeyboardMarkup(buttons)
 
-def build_stores_keyboard(city: str):
-    rows, _ = safe_stores_records()
+async def build_stores_keyboard(city: str):
+    directory, _ = await safe_store_directory()
+    return KEYBOARDS.get(
+        ("stores", city, _STORE_CACHE["gen"]),
+        lambda: _stores_keyboard(directory, city),
+    )
 
-    stores = [
-        (str(r.get("№_магазину","")).strip(), str(r.get("Адреса","")).strip())
-        for r in rows if str(r.get("Місто","")).strip() == city
-    ]
+def _stores_keyboard(directory: "StoreDirectory", city: str):
+    stores = directory.stores_in(city)
     if not stores:
         return None
 
     buttons = []
     row = []
 
-    for i, (num, addr) in enumerate(stores, start=1):
-        label = f"{num} • {addr.split(',')[0]}"
-        row.append(InlineKeyboardButton(label, callback_data=f"pickstore:{num}"))
+    for i, info in enumerate(stores, start=1):
+        label = f"{info.num} • {info.address.split(',')[0]}"
+        row.append(InlineKeyboardButton(label, callback_data=f"pickstore:{info.num}"))
         if i % 2 == 0:
             buttons.append(row)
             row = []
@@ -498,118 +2060,82 @@ def build_stores_keyboard(city: str):
 
     return InlineKeyboardMarkup(buttons)
 
-# ===================== Список змін по місту (без сьогодні, сортовані) =====================
-def build_shifts_keyboard_by_city(city: str, days_ahead: Optional[int] = None):
-    try:
-        limit = int(os.getenv("DEFAULT_DAYS_AHEAD", "10")) if days_ahead is None else int(days_ahead)
-    except Exception:
-        limit = 10
+# ===================== Пагінація списків =====================
+# Курсор у callback_data: pg:<view>:n:<row_idx> — сторінка після рядка,
+# pg:<view>:p:<row_idx> — сторінка перед ним. Список передається як пари
+# (ключ сортування, елемент), де ключ закінчується на row_idx (тож унікальний).
+
+def parse_page_cursor(data: str) -> Tuple[str, Optional[Tuple[str, int]]]:
+    """pg:<view>:<n|p>:<row_idx> -> (view, (напрям, row_idx)); битий курсор — перша сторінка."""
+    parts = data.split(":")
+    view = parts[1] if len(parts) > 1 else ""
+    if len(parts) == 4 and parts[2] in ("n", "p") and parts[3].isdigit():
+        return view, (parts[2], int(parts[3]))
+    return view, None
+
+def paginate(keyed: list, cursor: Optional[Tuple[str, int]], cursor_key=None,
+             size: int = LIST_PAGE_SIZE) -> Tuple[list, int]:
+    """
+    Сторінка з відсортованого keyed відносно курсора. cursor_key(row_idx) дає ключ
+    рядка-курсора, навіть якщо він уже зник зі списку (заброньовано/скасовано).
+    Повертає (сторінка, індекс її першого елемента).
+    """
+    size = max(1, size)
+    start = 0
+    if cursor is not None:
+        direction, row_idx = cursor
+        ck = cursor_key(row_idx) if cursor_key else None
+        if ck is None:
+            ck = next((k for k, _ in keyed if k[-1] == row_idx), None)
+        if ck is not None:
+            pos = bisect.bisect_right(keyed, ck, key=lambda x: x[0]) if direction == "n" \
+                else bisect.bisect_left(keyed, ck, key=lambda x: x[0])
+            start = pos if direction == "n" else max(0, pos - size)
+    if start >= len(keyed):
+        start = max(0, len(keyed) - size)
+    return keyed[start:start + size], start
+
+def page_nav_row(view: str, page: list, start: int, total: int) -> List[InlineKeyboardButton]:
+    """Кнопки «назад / n–m з N / далі»; порожньо, якщо все вміщається на одну сторінку."""
+    if not page or (start == 0 and len(page) >= total):
+        return []
+    row = []
+    if start > 0:
+        row.append(InlineKeyboardButton("⬅️", callback_data=f"pg:{view}:p:{page[0][0][-1]}"))
+    row.append(InlineKeyboardButton(f"{start + 1}–{start + len(page)} з {total}", callback_data="noop"))
+    if start + len(page) < total:
+        row.append(InlineKeyboardButton("➡️", callback_data=f"pg:{view}:n:{page[-1][0][-1]}"))
+    return row
 
-    today = today_kyiv()
-    start_day = today + timedelta(days=1)   # показуємо з завтрашнього дня
-    last_day  = today + timedelta(days=limit)
+# ===================== Календар / час =====================
+def _month_days(year: int, month: int):
+    import calendar
+    first_weekday, days_count = calendar.monthrange(year, month)
+    return first_weekday, days_count  # Пн=0 ... Нд=6
 
-    stores_rows, _ = safe_stores_records()
-    addr_map = {str(s.get("№_магазину","")).strip(): str(s.get("Адреса","")).strip() for s in stores_rows}
-    city_map = {str(s.get("№_магазину","")).strip(): str(s.get("Місто","")).strip() for s in stores_rows}
+def build_calendar(year: int = None, month: int = None):
+    today = today_kyiv()
+    if year is None: year = today.year
+    if month is None: month = today.month
+    # календар створення не залежить від даних — лише від місяця
+    return KEYBOARDS.get(("calendar", year, month), lambda: _calendar_keyboard(year, month))
 
-    rows, _ = get_requests_records(ttl_sec=15)
-    items: List[Tuple[int, date, str]] = []  # (row_idx, date, label)
+def _calendar_keyboard(year: int, month: int):
+    first_wd, days = _month_days(year, month)
 
-    for idx, r in enumerate(rows, start=2):
-        if not is_active_need_request(r):
-            continue
-            
-        store = str(r.get("№_магазину","")).strip()
-        if not store:
-            continue
+    row1 = [
+        InlineKeyboardButton("«", callback_data=f"calnav:{year}:{month}:prev"),
+        InlineKeyboardButton(f"{year}-{month:02d}", callback_data="noop"),
+        InlineKeyboardButton("»", callback_data=f"calnav:{year}:{month}:next"),
+    ]
+    wk = ["Пн","Вт","Ср","Чт","Пт","Сб","Нд"]
+    row2 = [InlineKeyboardButton(x, callback_data="noop") for x in wk]
 
-        r_city = (str(r.get("Місто","")).strip() or city_map.get(store, ""))
-        if r_city != city:
-            continue
-
-        status_raw = (str(r.get("Статус","")).strip() or "").lower()
-        status_ok = (
-            status_raw == "" or
-            "pending" in status_raw or
-            "очіку" in status_raw or
-            "підтвер" in status_raw or
-            "confirm" in status_raw
-        )
-        if not status_ok:
-            continue
-
-        needed_s = str(r.get("Потрібно","")).strip().replace(",", ".")
-        if needed_s.isdigit():
-            needed = int(needed_s)
-        elif needed_s.replace(".", "", 1).isdigit():
-            needed = max(1, int(float(needed_s)))
-        else:
-            needed = 1
-        if needed < 1:
-            needed = 1
-
-        booked_raw = str(r.get("Заброньовано","")).strip()
-        booked_ids = [x.strip() for x in booked_raw.split(",") if x.strip().isdigit()]
-        free = max(0, needed - len(booked_ids))
-        if free <= 0:
-            continue
-
-        date_s = str(r.get("Дата","")).strip()
-        d = parse_date_flexible(date_s)
-        if not d or not (start_day <= d <= last_day):
-            continue
-
-        t_start = str(r.get("Час_початку","")).strip()
-        t_end   = str(r.get("Час_закінчення","")).strip()
-
-        full_addr = addr_map.get(store, "").strip()
-        short_addr = (full_addr.split(",")[0] if full_addr else "")
-        if len(short_addr) > 22:
-            short_addr = short_addr[:22]
-
-        label = f"{d.strftime('%d.%m')} {t_start}-{t_end} • ТТ {store}"
-        if short_addr:
-            label += f" • {short_addr}"
-        label += f" • {len(booked_ids)}/{needed}"
-
-        items.append((idx, d, label))
-
-    if not items:
-        return None
-
-    # сортуємо за датою зростання
-    items.sort(key=lambda x: x[1])
-    buttons = [[InlineKeyboardButton(text[:64], callback_data=f"book:{row_idx}")]
-               for (row_idx, _, text) in items[:50]]
-    return InlineKeyboardMarkup(buttons)
-
-# ===================== Календар / час =====================
-def _month_days(year: int, month: int):
-    import calendar
-    first_weekday, days_count = calendar.monthrange(year, month)
-    return first_weekday, days_count  # Пн=0 ... Нд=6
-
-def build_calendar(year: int = None, month: int = None):
-    today = today_kyiv()
-    if year is None: year = today.year
-    if month is None: month = today.month
-
-    first_wd, days = _month_days(year, month)
-
-    row1 = [
-        InlineKeyboardButton("«", callback_data=f"calnav:{year}:{month}:prev"),
-        InlineKeyboardButton(f"{year}-{month:02d}", callback_data="noop"),
-        InlineKeyboardButton("»", callback_data=f"calnav:{year}:{month}:next"),
-    ]
-    wk = ["Пн","Вт","Ср","Чт","Пт","Сб","Нд"]
-    row2 = [InlineKeyboardButton(x, callback_data="noop") for x in wk]
-
-    buttons = [row1, row2]
-    row = []
-    pad = (first_wd - 0) % 7
-    for _ in range(pad):
-        row.append(InlineKeyboardButton(" ", callback_data="noop"))
+    buttons = [row1, row2]
+    row = []
+    pad = (first_wd - 0) % 7
+    for _ in range(pad):
+        row.append(InlineKeyboardButton(" ", callback_data="noop"))
 
     for d in range(1, days+1):
         row.append(InlineKeyboardButton(str(d), callback_data=f"calpick:{year}-{month:02d}-{d:02d}"))
@@ -620,37 +2146,18 @@ def build_calendar(year: int = None, month: int = None):
 
 # ===================== Календар для бронювання з виділенням змін =====================
 
-def build_booking_calendar(city: str, year: int = None, month: int = None):
+async def build_booking_calendar(city: str, year: int = None, month: int = None):
     today = today_kyiv()
     if year is None: year = today.year
     if month is None: month = today.month
 
-    # --- отримуємо список доступних дат у цьому місті ---
-    rows, _ = get_requests_records(ttl_sec=20)
-    stores, _ = safe_stores_records()
-
-    city_map = {str(s.get("№_магазину","")).strip(): str(s.get("Місто","")).strip() for s in stores}
-
-    available_dates = set()
-    for r in rows:
-        if not is_active_need_request(r):
-            continue
-            
-        store = str(r.get("№_магазину","")).strip()
-        r_city = (str(r.get("Місто","")).strip() or city_map.get(store, ""))
-
-        if r_city != city:
-            continue
-
-        status_raw = (str(r.get("Статус","")).strip() or "").lower()
-        if not ("pending" in status_raw or "очіку" in status_raw or "confirm" in status_raw):
-            continue
-
-        date_s = str(r.get("Дата","")).strip()
-        d = parse_date_flexible(date_s)
-        if d:
-            available_dates.add(d)
+    snap = await get_requests_snapshot()
+    return KEYBOARDS.get(
+        ("booking_calendar", city, year, month, today, _REQ_CACHE["gen"]),
+        lambda: _booking_calendar_keyboard(snap, city, year, month, today),
+    )
 
+def _booking_calendar_keyboard(snap: "RequestsSnapshot", city: str, year: int, month: int, today: date):
     first_wd, days = _month_days(year, month)
 
     row1 = [
@@ -668,20 +2175,22 @@ def build_booking_calendar(city: str, year: int = None, month: int = None):
     for _ in range(pad):
         row.append(InlineKeyboardButton(" ", callback_data="noop"))
 
+    free_days = snap.free_by_city.get(city, {})
     for d in range(1, days+1):
         cur = date(year, month, d)
+        free = free_days.get(cur, 0)
 
         # минулі дні → неактивні
         if cur < today:
             row.append(InlineKeyboardButton(" ", callback_data="noop"))
 
-        # дні зі змінами → ⭐
-        elif cur in available_dates:
-            row.append(InlineKeyboardButton(f"{d}⭐", callback_data=f"bookdate:{cur}"))
+        # дні з вільними місцями → ⭐ і кількість місць
+        elif free > 0:
+            row.append(InlineKeyboardButton(f"{d}⭐{free}", callback_data=f"bookdate:{cur}"))
 
-        # інші майбутні → активні, але потім перевіримо (варіант B)
+        # без вільних місць — лише число, без переходу
         else:
-            row.append(InlineKeyboardButton(str(d), callback_data=f"bookdate:{cur}"))
+            row.append(InlineKeyboardButton(str(d), callback_data="noop"))
 
         if len(row) == 7:
             buttons.append(row); row = []
@@ -704,7 +2213,28 @@ def _dec_time(h: int, m: int, step: int = TIME_STEP_MIN):
     total %= (24*60)
     return total//60, total%60
 
+# Усі стани пікера часу (24*60/TIME_STEP_MIN на кожен префікс) будуються один раз
+_TIME_PICKERS: Dict[Tuple[str, str, int, int], InlineKeyboardMarkup] = {}
+TIME_PICKER_PREFIXES = (
+    ("tstart", "Початок"), ("tend", "Кінець"),
+    ("trip_from", "Час з"), ("trip_to", "Час по"),
+    ("edit_time_from", "Час з"), ("edit_time_to", "Час по"),
+)
+
+def precompute_time_pickers():
+    for prefix, label in TIME_PICKER_PREFIXES:
+        for total in range(0, 24 * 60, TIME_STEP_MIN):
+            build_time_picker(prefix, total // 60, total % 60, label=label)
+
 def build_time_picker(prefix, h, m, label="Час"):
+    key = (prefix, label, h, m)
+    kb = _TIME_PICKERS.get(key)
+    if kb is None:
+        # час із запису може бути не кратним кроку — такі стани добудовуються за потреби
+        kb = _TIME_PICKERS[key] = _time_picker_keyboard(prefix, h, m, label)
+    return kb
+
+def _time_picker_keyboard(prefix, h, m, label):
     t = f"{h:02d}:{m:02d}"
 
     # 0.5 частини
@@ -725,7 +2255,7 @@ def _parse_hm(hh: str, mm: str) -> Tuple[int,int]:
 
 # ===================== Команди =====================
 # ===================== START =====================
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE, force_menu_keyboard: bool = True):
     tg_id = update.effective_user.id
     context.user_data["creator_tg"] = tg_id
 
@@ -743,11 +2273,16 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=inline_kb
     )
 
-    # Стабільна кнопка під клавіатурою
-    await update.message.reply_text(
-        "Меню доступне внизу 👇",
-        reply_markup=stable_menu_keyboard()
-    )
+    # Стабільна кнопка під клавіатурою — на /start завжди: прапорець у chat_data
+    # не знає, чи клавіатура ще є на пристрої (новий телефон, очищений чат)
+    if force_menu_keyboard:
+        await update.message.reply_text(
+            "Меню доступне внизу 👇",
+            reply_markup=stable_menu_keyboard()
+        )
+        set_menu_keyboard_shown(context, True)
+    else:
+        await ensure_menu_keyboard(update, context)
 
 # ===================== On start button =====================
 async def on_start_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -755,7 +2290,9 @@ async def on_start_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def on_menu_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await start(update, context)
+    # користувач натиснув "🏠 Меню" — отже клавіатура точно на екрані
+    set_menu_keyboard_shown(context, True)
+    await start(update, context, force_menu_keyboard=False)
 
 
 async def ping(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -776,6 +2313,7 @@ async def on_contact_create(update: Update, context: ContextTypes.DEFAULT_TYPE):
     print(f"[debug] on_contact_create: phone={phone}  user_id={update.effective_user.id}")
 
     await update.message.reply_text("Дякую! ✅ Телефон збережено.", reply_markup=ReplyKeyboardRemove())
+    set_menu_keyboard_shown(context, False)
 
     # --- Якщо чекали телефон для сторінки "Мої відпрацьовані" ---
     if context.user_data.pop("await_mydone_phone", False):
@@ -830,7 +2368,7 @@ async def handle_create_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
             await update.message.reply_text("Вкажіть номер ТТ цифрами, наприклад: 054")
             return
 
-        requests_ws.update_cell(row_idx, COL_WORKER_STORE, new_worker_store)
+        await requests_patch_row(row_idx, {COL_WORKER_STORE: new_worker_store})
 
         context.user_data.pop("await", None)
         context.user_data.pop("edit_row_idx", None)
@@ -839,10 +2377,7 @@ async def handle_create_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
             f"✅ ТТ працівника оновлено: {new_worker_store}"
         )
 
-        await update.message.reply_text(
-            "Меню доступне внизу 👇",
-            reply_markup=stable_menu_keyboard()
-        )
+        await ensure_menu_keyboard(update, context)
         return    
 
     if step == "edit_note":
@@ -855,7 +2390,7 @@ async def handle_create_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
         new_note = "" if txt in ("-", "—") else txt
 
-        requests_ws.update_cell(row_idx, COL_NOTE, new_note)
+        await requests_patch_row(row_idx, {COL_NOTE: new_note})
 
         context.user_data.pop("await", None)
         context.user_data.pop("edit_row_idx", None)
@@ -864,17 +2399,14 @@ async def handle_create_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
             "✅ Коментар оновлено."
         )
 
-        await update.message.reply_text(
-            "Меню доступне внизу 👇",
-            reply_markup=stable_menu_keyboard()
-        )
+        await ensure_menu_keyboard(update, context)
         return  
   
     if step == "trip_comment":
         context.user_data["trip_comment"] = txt
         context.user_data.pop("await", None)
 
-        save_want_trip_request(update, context)
+        await save_want_trip_request(update, context)
 
         await send_hr_channel_notification(
             context=context,
@@ -894,10 +2426,7 @@ async def handle_create_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
             f"Коментар: {context.user_data.get('trip_comment', '')}"
         )
 
-        await update.message.reply_text(
-            "Меню доступне внизу 👇",
-            reply_markup=stable_menu_keyboard()
-        )
+        await ensure_menu_keyboard(update, context)
         return
     
     if step == "worker_store":
@@ -969,22 +2498,19 @@ async def handle_create_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
         creator_tg    = context.user_data.get("creator_tg") or update.effective_user.id
         creator_phone = context.user_data.get("creator_phone") or ""
 
-        next_row = get_next_requests_row()
-
         try:
             d_obj = datetime.strptime(d, "%Y-%m-%d")
             d_str = d_obj.strftime("%d.%m.%Y")
         except Exception:
             d_str = str(d)
 
-        payload = [
-            {'range': f'B{next_row}:B{next_row}', 'values': [[store]]},
-            {'range': f'D{next_row}:G{next_row}', 'values': [[d_str, ts, te, needed]]},
-            {'range': f'I{next_row}:J{next_row}', 'values': [[STATUS_PENDING, note]]},
-            {'range': f'K{next_row}:L{next_row}', 'values': [[str(creator_tg), str(creator_phone)]]},
-            {'range': f'R{next_row}:T{next_row}', 'values': [[REQUEST_TYPE_NEED, RECORD_STATE_ACTIVE, ""]]},
-        ]
-        requests_ws.batch_update(payload)
+        await requests_append_row({
+            COL_STORE: store,
+            COL_DATE: d_str, COL_TIME_FROM: ts, COL_TIME_TO: te, COL_NEED: needed,
+            COL_STATUS: STATUS_PENDING, COL_NOTE: note,
+            COL_CREATED_TG: str(creator_tg), COL_CREATED_PH: str(creator_phone),
+            COL_REQUEST_TYPE: REQUEST_TYPE_NEED, COL_RECORD_STATE: RECORD_STATE_ACTIVE, COL_WORKER_STORE: "",
+        })
 
         await send_hr_channel_notification(
             context=context,
@@ -1002,24 +2528,20 @@ async def handle_create_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text(
             "✅ Зміну створено. Вона з’явиться у списку доступних для бронювання."
         )
-        await update.message.reply_text(
-            "Меню доступне внизу 👇",
-            reply_markup=stable_menu_keyboard()
-        )        
+        await ensure_menu_keyboard(update, context)        
         return 
 
    
 # ===================== Допоміжні дії =====================
-async def show_my_attendance(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def show_my_attendance(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                             cursor: Optional[Tuple[str, int]] = None):
     phone = context.user_data.get("creator_phone","")
     phone_digits = re.sub(r"\D","", phone)
     try:
-        ws = ss.worksheet("Attendance")
-        rows = ws.get_all_records()
-    except Exception:
-        rows = []
-
-    mine = [r for r in rows if re.sub(r"\D","", str(r.get("Телефон_працівника",""))) == phone_digits]
+        await mirror_pull("Attendance", max_age=ATTENDANCE_PULL_SEC)
+    except Exception as e:
+        print(f"[debug] Attendance pull error: {e}", flush=True)
+    rows = records_from_values(await mirror_call(MIRROR.table, "Attendance"))
 
     def _dt_of(r):
         s = str(r.get("Дата","")).strip()
@@ -1030,73 +2552,56 @@ async def show_my_attendance(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 pass
         return datetime.min
 
-    mine.sort(key=_dt_of, reverse=True)
+    # нові зверху; ключ (-дата, номер рядка у таблиці) — для курсора сторінок
+    mine = sorted(
+        ((-_dt_of(r).toordinal(), row_idx), r)
+        for row_idx, r in enumerate(rows, start=2)
+        if re.sub(r"\D","", str(r.get("Телефон_працівника",""))) == phone_digits
+    )
     if not mine:
         await update.effective_message.edit_text("Наразі немає відмічених як відпрацьовані.")
         return
 
+    page, start = paginate(mine, cursor)
     text = "🗂 Твої відпрацьовані зміни:\n\n"
-    for r in mine[:10]:
+    for _, r in page:
         text += (f"{r.get('Дата','?')} • {r.get('Місто','?')} • ТТ {r.get('№_магазину','?')}\n"
                  f"Підтвердження прибуття: {r.get('Прибуття_підтверджено','') or '—'}\n\n")
-    await update.effective_message.edit_text(text)
+    nav = page_nav_row("mydone", page, start, len(mine))
+    await update.effective_message.edit_text(
+        text, reply_markup=InlineKeyboardMarkup([nav]) if nav else None
+    )
 
 async def complete_booking_after_data(update: Update, context: ContextTypes.DEFAULT_TYPE, row_idx: int):
-    row = requests_ws.row_values(row_idx)
-    while len(row) < COL_ARRIVED:
-        row.append("")
-
-    store       = (row[COL_STORE-1] or "").strip()
-    city_cell   = (row[COL_CITY-1] or "").strip()
-    date_s      = (row[COL_DATE-1] or "").strip()
-    t_start     = (row[COL_TIME_FROM-1] or "").strip()
-    t_end       = (row[COL_TIME_TO-1] or "").strip()
-    needed_s    = (row[COL_NEED-1] or "").strip()
-    booked_raw  = (row[COL_BOOKED-1] or "").strip()
-    manager_raw = (row[COL_CREATED_TG-1] or "").strip()
-
-    # кількість
-    s = (needed_s or "").replace(",", ".")
-    needed = int(float(s)) if s.replace(".", "", 1).isdigit() else 1
-    booked_ids = [x.strip() for x in booked_raw.split(",") if x.strip().isdigit()]
-
     tg_id = str(update.effective_user.id)
+    emp_name = context.user_data.get("emp_name")
+    worker_phone = re.sub(r"\D", "", context.user_data.get("creator_phone", ""))
 
-    if tg_id in booked_ids:
+    result, row, new_status = await commit_booking(row_idx, tg_id, emp_name, worker_phone)
+
+    if result == "already":
         await update.message.reply_text("ℹ️ Ти вже бронював(ла) цю зміну.")
         return
 
-    if len(booked_ids) >= needed:
+    if result == "full":
         await update.message.reply_text("❗ На жаль, усі місця на цю зміну вже заброньовані.")
         return
 
-    emp_name = context.user_data.get("emp_name")
-    if not emp_name:
+    if result == "need_name":
         context.user_data["pending_book_row"] = row_idx
         context.user_data["await"] = "emp_name"
         await update.message.reply_text("Вкажіть ПІБ у форматі: Прізвище Ім’я")
         return
 
-    # запис у таблицю
-    booked_ids.append(tg_id)
-    requests_ws.update_cell(row_idx, COL_BOOKED, ", ".join(booked_ids))
-    new_status = f"{STATUS_WAIT} ({len(booked_ids)}/{needed})"
-    requests_ws.update_cell(row_idx, COL_STATUS, new_status)
-
-    worker_phone = re.sub(r"\D", "", context.user_data.get("creator_phone", ""))
-    phones_raw = (row[COL_BOOKED_PH-1] or "")
-    phone_list = [x.strip() for x in phones_raw.split(",") if x.strip()]
-    if worker_phone:
-        phone_list.append(worker_phone)
-    requests_ws.update_cell(row_idx, COL_BOOKED_PH, ", ".join(phone_list))
-
-    names_raw = (row[COL_BOOKED_NAME-1] or "")
-    name_list = [x.strip() for x in names_raw.split(",") if x.strip()]
-    name_list.append(emp_name)
-    requests_ws.update_cell(row_idx, COL_BOOKED_NAME, ", ".join(name_list))
+    store       = (row[COL_STORE-1] or "").strip()
+    city_cell   = (row[COL_CITY-1] or "").strip()
+    date_s      = (row[COL_DATE-1] or "").strip()
+    t_start     = (row[COL_TIME_FROM-1] or "").strip()
+    t_end       = (row[COL_TIME_TO-1] or "").strip()
+    manager_raw = (row[COL_CREATED_TG-1] or "").strip()
 
     # повідомлення працівнику
-    meta_city, meta_obl, meta_addr, _, _ = get_store_meta(store)
+    meta_city, meta_obl, meta_addr, _, _ = await get_store_meta(store)
 
     # Якщо місто в Requests пусте – беремо з Stores
     city = city_cell if city_cell else meta_city
@@ -1120,7 +2625,14 @@ async def complete_booking_after_data(update: Update, context: ContextTypes.DEFA
     print(f"[debug] sending to manager: {manager_id}")
 
     if manager_id:
-        cb = f"mgrconfirm:{row_idx}:{tg_id}:{worker_phone}"
+        # дані рядка їдуть у токені: кнопка відсікає чужі натискання без читання рядка
+        cb = token_callback("mgrconfirm:", {
+            "row_idx": row_idx,
+            "worker_tg": str(tg_id),
+            "worker_phone": worker_phone,
+            "manager_tg": manager_id,
+            "manager_phone": (row[COL_CREATED_PH-1] or "").strip(),
+        })
         kb_mgr = InlineKeyboardMarkup(
             [[InlineKeyboardButton("✅ Підтвердити бронювання", callback_data=cb)]]
         )
@@ -1138,27 +2650,7 @@ async def complete_booking_after_data(update: Update, context: ContextTypes.DEFA
 
         await update.effective_chat.send_message("Запит надіслано керівнику на підтвердження.")
 
-        await update.get_bot().send_message(
-            chat_id=int(manager_id),
-            text=text_mgr,
-            reply_markup=kb_mgr
-        )
-
-def _write_creator_fields(row_idx, update, context):
-    """Записує TG_ID і телефон керівника (того, хто створив зміну)"""
-    try:
-        tg_id = str(context.user_data.get("creator_tg", "")).strip()
-        phone = str(context.user_data.get("creator_phone", "")).strip()
-
-        print(f"[debug] _write_creator_fields(): row={row_idx}, tg_id={tg_id}, phone={phone}")
-
-        # K = Created_By_TG, L = Created_By_Phone
-        if tg_id:
-            requests_ws.update_cell(row_idx, 11, tg_id)
-        if phone:
-            requests_ws.update_cell(row_idx, 12, phone)
-    except Exception as e:
-        print(f"[debug] _write_creator_fields error: {e}")
+        OUTBOX.send_message(int(manager_id), text_mgr, PRIO_HIGH, reply_markup=kb_mgr)
 
 from telegram import ReplyKeyboardMarkup, KeyboardButton
 
@@ -1172,18 +2664,48 @@ def stable_menu_keyboard():
 # =====================================================================
 # Автоматичне повернення кнопки "Меню" після будь-якої дії
 # =====================================================================
+# Чи показана зараз у чаті reply-клавіатура з "🏠 Меню" (chat_data)
+MENU_KB_SHOWN = "menu_kb_shown"
+
+def set_menu_keyboard_shown(context: ContextTypes.DEFAULT_TYPE, shown: bool):
+    """Викликати після кожного повідомлення, що ставить/прибирає reply-клавіатуру."""
+    if context.chat_data is not None:
+        context.chat_data[MENU_KB_SHOWN] = shown
+
+def menu_keyboard_shown(context: ContextTypes.DEFAULT_TYPE) -> bool:
+    return bool(context.chat_data and context.chat_data.get(MENU_KB_SHOWN))
+
+async def ensure_menu_keyboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Надсилає "Меню доступне внизу 👇" з кнопкою, лише якщо клавіатура зникла."""
+    if menu_keyboard_shown(context):
+        return
+    await update.effective_chat.send_message(
+        "Меню доступне внизу 👇",
+        reply_markup=stable_menu_keyboard()
+    )
+    set_menu_keyboard_shown(context, True)
+
+# Чати, куди кнопка "Меню" вже стоїть у черзі OUTBOX (щоб не слати її двічі)
+_MENU_KB_PENDING = set()
+
 async def auto_show_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    Показує стабільну кнопку "Меню", щоб вона не зникала після пауз,
-    переходів у інші боти, очистки клавіатури Telegram та інших глюків.
+    Повертає стабільну кнопку "Меню", якщо її прибрали (ReplyKeyboardRemove,
+    клавіатура "Поділитися номером"). Коли кнопка на місці — нічого не шле.
     """
-    try:
-        await update.effective_chat.send_message(
-            " ",
-            reply_markup=stable_menu_keyboard()
-        )
-    except:
-        pass
+    chat_id = update.effective_chat.id
+    if menu_keyboard_shown(context) or chat_id in _MENU_KB_PENDING:
+        return
+    _MENU_KB_PENDING.add(chat_id)
+    future = OUTBOX.send_message(chat_id, "Меню доступне внизу 👇", PRIO_LOW, reply_markup=stable_menu_keyboard())
+
+    def _delivered(fut: asyncio.Future):
+        # прапорець — лише коли Telegram справді прийняв повідомлення з клавіатурою
+        _MENU_KB_PENDING.discard(chat_id)
+        if not fut.cancelled() and fut.exception() is None and fut.result() is not None:
+            set_menu_keyboard_shown(context, True)
+
+    future.add_done_callback(_delivered)
 
 def persistent_menu():
     return ReplyKeyboardMarkup(
@@ -1191,801 +2713,985 @@ def persistent_menu():
         resize_keyboard=True
     )
 
-# ===================== Callback =====================
-async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    data = query.data
-    print(f"[debug] callback_data = {data}")    
-    
-    # --- Меню створення зміни ---
-    if data == "menu:want_trip":
-        keep_phone = context.user_data.get("creator_phone")
-        keep_name  = context.user_data.get("emp_name")
-        keep_tg    = context.user_data.get("creator_tg") or update.effective_user.id
-
-        context.user_data.clear()
-        if keep_phone:
-            context.user_data["creator_phone"] = keep_phone
-        if keep_name:
-            context.user_data["emp_name"] = keep_name
-        if keep_tg:
-            context.user_data["creator_tg"] = keep_tg
-
-        context.user_data["mode"] = "want_trip"
+# ===================== Токени callback_data =====================
+class CallbackTokenStore:
+    """
+    Короткі токени замість даних у callback_data (ліміт Telegram — 64 байти):
+    token -> payload (dict) з TTL. Працюють з пам'яті; нові токени дописуються
+    у SQLite одним executemany у фоновому потоці, тож кнопки в уже надісланих
+    повідомленнях (підтвердження керівника) переживають перезапуск.
+    Пам'ять змінюється лише з event loop, SQLite — лише з потоків.
+    """
 
-        if not keep_phone:
-            kb = ReplyKeyboardMarkup(
-                [[KeyboardButton("📞 Поділитися номером", request_contact=True)]],
-                resize_keyboard=True,
-                one_time_keyboard=True
+    def __init__(self, path: str, ttl_sec: int):
+        self.ttl_sec = ttl_sec
+        self._db_lock = threading.Lock()
+        self._dirty: Dict[str, Tuple[float, str]] = {}
+        self._flushing: Optional[asyncio.Task] = None
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cb_tokens ("
+                " token TEXT PRIMARY KEY, payload TEXT NOT NULL, expires REAL NOT NULL)"
             )
-            await update.effective_chat.send_message(
-                "📲 Щоб подати заявку «Хочу у відрядження», спочатку поділися своїм номером телефону:",
-                reply_markup=kb
+        # ще до старту event loop: живі токени одразу в пам'ять, get() в SQLite не ходить
+        self._mem: Dict[str, Tuple[float, dict]] = {
+            token: (expires, json.loads(payload))
+            for token, payload, expires in self._conn.execute(
+                "SELECT token, payload, expires FROM cb_tokens WHERE expires > ?", (time.time(),)
             )
-            context.user_data["await_want_trip_phone"] = True
-            return
+        }
+
+    def issue_many(self, payloads: List[dict], ttl_sec: Optional[int] = None, stable: bool = False) -> List[str]:
+        """
+        Токени для payloads (напр. усіх кнопок клавіатури) — один запис у SQLite на всіх.
+        stable=True — токен залежить лише від payload (однакові кнопки в кешованих
+        клавіатурах), повторна видача лише продовжує TTL.
+        """
+        expires = time.time() + (ttl_sec or self.ttl_sec)
+        tokens = []
+        for payload in payloads:
+            body = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+            token = hashlib.sha1(body.encode()).hexdigest()[:12] if stable else uuid.uuid4().hex[:12]
+            self._mem[token] = (expires, payload)
+            self._dirty[token] = (expires, body)
+            tokens.append(token)
+        self._schedule_flush()
+        return tokens
+
+    def issue(self, payload: dict, ttl_sec: Optional[int] = None, stable: bool = False) -> str:
+        return self.issue_many([payload], ttl_sec, stable)[0]
+
+    def get(self, token: str) -> Optional[dict]:
+        found = self._mem.get(token)
+        if found is None:
+            return None
+        expires, payload = found
+        return payload if expires > time.time() else None
+
+    def _schedule_flush(self):
+        if self._flushing is None or self._flushing.done():
+            self._flushing = asyncio.get_running_loop().create_task(self.flush())
+
+    async def flush(self):
+        """Дописує нові токени у SQLite (видачі за один тік loop зливаються в один запис)."""
+        while self._dirty:
+            batch, self._dirty = self._dirty, {}
+            try:
+                await asyncio.to_thread(self._write, batch)
+            except Exception as e:
+                print(f"[debug] callback tokens flush error: {e}", flush=True)
+                for token, entry in batch.items():
+                    self._dirty.setdefault(token, entry)
+                return
 
-        context.user_data["await"] = "worker_store"
-        await update.effective_message.edit_text(
-            "Вкажіть номер ТТ, де ви працюєте зараз:"
-        )
-        return
+    def _write(self, batch: Dict[str, Tuple[float, str]]):
+        with self._db_lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO cb_tokens (token, payload, expires) VALUES (?, ?, ?)",
+                [(token, body, expires) for token, (expires, body) in batch.items()],
+            )
 
-    if data == "menu:mycreated":
-        records = get_my_created_records(update.effective_user.id)
+    async def purge(self) -> int:
+        """Прибирає протерміновані токени. Повертає, скільки видалено з SQLite."""
+        now = time.time()
+        for token in [t for t, (exp, _) in self._mem.items() if exp <= now]:
+            del self._mem[token]
+        return await asyncio.to_thread(self._delete_expired, now)
 
-        if not records:
-            await update.effective_message.edit_text(
-                "У вас немає активних записів від сьогодні і далі."
-            )
-            return
+    def _delete_expired(self, now: float) -> int:
+        with self._db_lock, self._conn:
+            return self._conn.execute("DELETE FROM cb_tokens WHERE expires <= ?", (now,)).rowcount
 
-        buttons = []
-        for i, rec in enumerate(records[:20], start=1):
-            if rec["request_type"] == REQUEST_TYPE_WANT:
-                tt_part = f"ТТ працівника {rec['worker_store'] or '—'}"
-            else:
-                tt_part = f"ТТ {rec['store'] or '—'}"
+CALLBACK_TOKENS = CallbackTokenStore(CALLBACK_TOKENS_PATH, CALLBACK_TOKEN_TTL_SEC)
 
-            btn_text = (
-                f"{i}. {rec['date_str']} {rec['time_from']}-{rec['time_to']} | {tt_part}"
-            )
+def token_callback(route: str, payload: dict, stable: bool = False) -> str:
+    """callback_data виду "<route>#<token>" (напр. "pickcity:#3f2a...") — той самий маршрут, що й у старого формату."""
+    return f"{route}#{CALLBACK_TOKENS.issue(payload, stable=stable)}"
 
-            buttons.append([
-                InlineKeyboardButton(
-                    btn_text[:64],
-                    callback_data=f"myrec:{rec['row_idx']}"
-                )
-            ])
+def is_token_callback(data: str, route: str) -> bool:
+    return data.startswith(route + "#")
 
-        await update.effective_message.edit_text(
-            "📋 Оберіть запис:",
-            reply_markup=InlineKeyboardMarkup(buttons)
-        )
-        return  
-    
-    if data == "trip_comment_skip":
-        context.user_data["trip_comment"] = ""
-        context.user_data.pop("await", None)
+def callback_payload(data: str) -> Optional[dict]:
+    """Payload токена з "<route>#<token>"; None — токен невідомий або протермінований."""
+    return CALLBACK_TOKENS.get(data.split("#", 1)[1])
 
-        save_want_trip_request(update, context)
+async def job_purge_callback_tokens(context: ContextTypes.DEFAULT_TYPE):
+    removed = await CALLBACK_TOKENS.purge()
+    if removed:
+        print(f"[debug] callback tokens purged: {removed}", flush=True)
 
-        await send_hr_channel_notification(
-            context=context,
-            request_type=REQUEST_TYPE_WANT,
-            date_str=datetime.strptime(context.user_data['trip_date'], '%Y-%m-%d').strftime('%d.%m.%Y'),
-            time_from=context.user_data.get("trip_time_from", ""),
-            time_to=context.user_data.get("trip_time_to", ""),
-            worker_store=context.user_data.get("worker_store", ""),
-            note=""
-        )        
+async def expired_button(update: Update):
+    await update.effective_message.edit_text(
+        "⌛ Ця кнопка застаріла. Відкрийте меню й почніть заново."
+    )
 
-        await update.effective_message.edit_text(
-            "✅ Заявку збережено.\n"
-            f"ТТ працівника: {context.user_data.get('worker_store', '')}\n"
-            f"Дата: {datetime.strptime(context.user_data['trip_date'], '%Y-%m-%d').strftime('%d.%m.%Y')}\n"
-            f"Час: {context.user_data.get('trip_time_from', '')}–{context.user_data.get('trip_time_to', '')}\n"
-            "Коментар: —"
-        )
+def is_shift_manager(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                     manager_raw: str, manager_phone_raw: str) -> bool:
+    """Чи натиснув кнопку керівник, що створив зміну (збіг TG_ID або телефону)."""
+    manager_raw = str(manager_raw or "").strip()
+    manager_id = int(manager_raw) if manager_raw.isdigit() else None
+    manager_phone_digits = re.sub(r"\D", "", str(manager_phone_raw or ""))
+    user_phone_digits = re.sub(r"\D", "", context.user_data.get("creator_phone", ""))
+    return not ((manager_id and manager_id != update.effective_user.id) and
+                (manager_phone_digits != user_phone_digits))
 
-        await update.effective_chat.send_message(
-            "Меню доступне внизу 👇",
-            reply_markup=stable_menu_keyboard()
+# ===================== Callback =====================
+class CallbackRouter:
+    """Маршрути callback_data: точний збіг або простір імен до першої ":" — O(1) замість ланцюжка if."""
+
+    def __init__(self):
+        self.exact = {}
+        self.prefix = {}
+        self.stats = {}   # маршрут -> [викликів, сумарно сек, макс сек]
+
+    def route(self, key: str, exact: bool = False):
+        def deco(fn):
+            (self.exact if exact else self.prefix)[key] = fn
+            return fn
+        return deco
+
+    def resolve(self, data: str):
+        fn = self.exact.get(data)
+        if fn is not None:
+            return data, fn
+        head, sep, _ = data.partition(":")
+        key = head + sep
+        return key, self.prefix.get(key)
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE, data: str) -> bool:
+        """True — маршрут обробив натискання; False — показуємо меню."""
+        route, fn = self.resolve(data)
+        if fn is None:
+            return False
+        t0 = time.monotonic()
+        try:
+            return bool(await fn(update, context, data))
+        finally:
+            dt = time.monotonic() - t0
+            st = self.stats.setdefault(route, [0, 0.0, 0.0])
+            st[0] += 1
+            st[1] += dt
+            st[2] = max(st[2], dt)
+            print(f"[debug] callback route {route} took {dt * 1000:.0f}ms", flush=True)
+
+    def metrics_line(self, top: int = 10) -> str:
+        if not self.stats:
+            return "no callbacks"
+        rows = sorted(self.stats.items(), key=lambda kv: kv[1][1], reverse=True)[:top]
+        return "; ".join(
+            f"{route} n={n} avg={total / n * 1000:.0f}ms max={mx * 1000:.0f}ms"
+            for route, (n, total, mx) in rows
         )
-        return
 
-    if data.startswith("myrec:"):
-        row_idx = int(data.split(":", 1)[1])
-        records = get_my_created_records(update.effective_user.id)
-        rec = next((r for r in records if r["row_idx"] == row_idx), None)
+CALLBACKS = CallbackRouter()
 
-        if not rec:
-            await update.effective_message.edit_text(
-                "Запис не знайдено або він уже неактивний."
-            )
-            return
+async def job_log_callback_metrics(context: ContextTypes.DEFAULT_TYPE):
+    print(f"[debug] callback metrics: {CALLBACKS.metrics_line()}", flush=True)
 
-        if rec["request_type"] == REQUEST_TYPE_WANT:
-            tt_line = f"ТТ працівника: {rec['worker_store'] or '—'}"
-        else:
-            tt_line = f"ТТ: {rec['store'] or '—'}"
+# Обробник маршруту повертає True, якщо натискання оброблено;
+# None/False — on_callback покаже меню (як раніше при "провалюванні" гілки).
 
-        comment_line = rec["note"] if rec["note"] else "—"
+# --- Меню створення зміни ---
+@CALLBACKS.route("menu:want_trip", exact=True)
+async def cb_menu_want_trip(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    keep_phone = context.user_data.get("creator_phone")
+    keep_name  = context.user_data.get("emp_name")
+    keep_tg    = context.user_data.get("creator_tg") or update.effective_user.id
 
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("✏️ Редагувати запис", callback_data=f"editrec:{row_idx}")],
-            [InlineKeyboardButton("❌ Скасувати запис", callback_data=f"cancelrec:{row_idx}")],
-            [InlineKeyboardButton("⬅️ Назад до списку", callback_data="menu:mycreated")]
-        ])
+    context.user_data.clear()
+    if keep_phone:
+        context.user_data["creator_phone"] = keep_phone
+    if keep_name:
+        context.user_data["emp_name"] = keep_name
+    if keep_tg:
+        context.user_data["creator_tg"] = keep_tg
 
-        await update.effective_message.edit_text(
-            f"📌 {rec['request_type']}\n"
-            f"Дата: {rec['date_str']}\n"
-            f"Час: {rec['time_from']}–{rec['time_to']}\n"
-            f"{tt_line}\n"
-            f"Коментар: {comment_line}",
+    context.user_data["mode"] = "want_trip"
+
+    if not keep_phone:
+        kb = ReplyKeyboardMarkup(
+            [[KeyboardButton("📞 Поділитися номером", request_contact=True)]],
+            resize_keyboard=True,
+            one_time_keyboard=True
+        )
+        await update.effective_chat.send_message(
+            "📲 Щоб подати заявку «Хочу у відрядження», спочатку поділися своїм номером телефону:",
             reply_markup=kb
         )
-        return
+        set_menu_keyboard_shown(context, False)
+        context.user_data["await_want_trip_phone"] = True
+        return True
 
-    if data.startswith("editrec:"):
-        row_idx = int(data.split(":", 1)[1])
-        records = get_my_created_records(update.effective_user.id)
-        rec = next((r for r in records if r["row_idx"] == row_idx), None)
-
-        if not rec:
-            await update.effective_message.edit_text(
-                "Запис не знайдено або він уже неактивний."
-            )
-            return
-
-        buttons = [
-            [InlineKeyboardButton("🗓 Змінити дату", callback_data=f"editrec_date:{row_idx}")],
-            [InlineKeyboardButton("🕒 Змінити час", callback_data=f"editrec_time:{row_idx}")],
-            [InlineKeyboardButton("💬 Змінити коментар", callback_data=f"editrec_note:{row_idx}")]
-        ]
+    context.user_data["await"] = "worker_store"
+    await update.effective_message.edit_text(
+        "Вкажіть номер ТТ, де ви працюєте зараз:"
+    )
+    return True
 
-        if rec["request_type"] == REQUEST_TYPE_WANT:
-            buttons.insert(
-                2,
-                [InlineKeyboardButton("🏪 Змінити ТТ працівника", callback_data=f"editrec_worker_store:{row_idx}")]
-            )
+@CALLBACKS.route("menu:mycreated", exact=True)
+async def cb_menu_mycreated(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    await show_my_created_records(update, context)
+    return True
 
-        buttons.append([InlineKeyboardButton("⬅️ Назад до запису", callback_data=f"myrec:{row_idx}")])
+async def show_my_created_records(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                  cursor: Optional[Tuple[str, int]] = None):
+    records = await get_my_created_records(update.effective_user.id)
 
+    if not records:
         await update.effective_message.edit_text(
-            "Що саме хочете змінити?",
-            reply_markup=InlineKeyboardMarkup(buttons)
+            "У вас немає активних записів від сьогодні і далі."
         )
         return
 
-    if data.startswith("editrec_time:"):
-        row_idx = int(data.split(":", 1)[1])
-        records = get_my_created_records(update.effective_user.id)
-        rec = next((r for r in records if r["row_idx"] == row_idx), None)
-
-        if not rec:
-            await update.effective_message.edit_text(
-                "Запис не знайдено або він уже неактивний."
-            )
-            return
-
-        context.user_data["edit_mode"] = "time"
-        context.user_data["edit_row_idx"] = row_idx
+    keyed = [((rec["date_obj"], rec["time_from"], rec["row_idx"]), rec) for rec in records]
+    snap = await get_requests_snapshot()
 
-        try:
-            start_h, start_m = map(int, rec["time_from"].split(":"))
-        except Exception:
-            start_h, start_m = 9, 0
+    def cursor_key(row_idx):
+        r = snap.by_row.get(row_idx)
+        return (r.date_obj, r.time_from, row_idx) if r and r.date_obj else None
 
-        try:
-            end_h, end_m = map(int, rec["time_to"].split(":"))
-        except Exception:
-            end_h, end_m = 18, 0
+    page, start = paginate(keyed, cursor, cursor_key)
 
-        context.user_data["edit_time_to_default_h"] = end_h
-        context.user_data["edit_time_to_default_m"] = end_m
+    buttons = []
+    for i, (_, rec) in enumerate(page, start=start + 1):
+        if rec["request_type"] == REQUEST_TYPE_WANT:
+            tt_part = f"ТТ працівника {rec['worker_store'] or '—'}"
+        else:
+            tt_part = f"ТТ {rec['store'] or '—'}"
 
-        await update.effective_message.edit_text(
-            "Оберіть новий час з:",
-            reply_markup=build_time_picker("edit_time_from", start_h, start_m, label="Час з")
+        btn_text = (
+            f"{i}. {rec['date_str']} {rec['time_from']}-{rec['time_to']} | {tt_part}"
         )
-        return    
-
-    if data.startswith("editrec_date:"):
-        row_idx = int(data.split(":", 1)[1])
-        records = get_my_created_records(update.effective_user.id)
-        rec = next((r for r in records if r["row_idx"] == row_idx), None)
 
-        if not rec:
-            await update.effective_message.edit_text(
-                "Запис не знайдено або він уже неактивний."
+        buttons.append([
+            InlineKeyboardButton(
+                btn_text[:64],
+                callback_data=f"myrec:{rec['row_idx']}"
             )
-            return
+        ])
 
-        context.user_data["edit_mode"] = "date"
-        context.user_data["edit_row_idx"] = row_idx
+    nav = page_nav_row("mycreated", page, start, len(keyed))
+    if nav:
+        buttons.append(nav)
 
-        await update.effective_message.edit_text(
-            "Оберіть нову дату:",
-            reply_markup=build_calendar()
-        )
-        return    
+    await update.effective_message.edit_text(
+        "📋 Оберіть запис:",
+        reply_markup=InlineKeyboardMarkup(buttons)
+    )
 
-    if data.startswith("editrec_worker_store:"):
-        row_idx = int(data.split(":", 1)[1])
-        records = get_my_created_records(update.effective_user.id)
-        rec = next((r for r in records if r["row_idx"] == row_idx), None)
+@CALLBACKS.route("trip_comment_skip", exact=True)
+async def cb_trip_comment_skip(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    context.user_data["trip_comment"] = ""
+    context.user_data.pop("await", None)
+
+    await save_want_trip_request(update, context)
+
+    await send_hr_channel_notification(
+        context=context,
+        request_type=REQUEST_TYPE_WANT,
+        date_str=datetime.strptime(context.user_data['trip_date'], '%Y-%m-%d').strftime('%d.%m.%Y'),
+        time_from=context.user_data.get("trip_time_from", ""),
+        time_to=context.user_data.get("trip_time_to", ""),
+        worker_store=context.user_data.get("worker_store", ""),
+        note=""
+    )
 
-        if not rec:
-            await update.effective_message.edit_text(
-                "Запис не знайдено або він уже неактивний."
-            )
-            return
+    await update.effective_message.edit_text(
+        "✅ Заявку збережено.\n"
+        f"ТТ працівника: {context.user_data.get('worker_store', '')}\n"
+        f"Дата: {datetime.strptime(context.user_data['trip_date'], '%Y-%m-%d').strftime('%d.%m.%Y')}\n"
+        f"Час: {context.user_data.get('trip_time_from', '')}–{context.user_data.get('trip_time_to', '')}\n"
+        "Коментар: —"
+    )
 
-        if rec["request_type"] != REQUEST_TYPE_WANT:
-            await update.effective_message.edit_text(
-                "Ця зміна доступна тільки для записів «Хочу у відрядження»."
-            )
-            return
+    await ensure_menu_keyboard(update, context)
+    return True
 
-        context.user_data["await"] = "edit_worker_store"
-        context.user_data["edit_row_idx"] = row_idx
+@CALLBACKS.route("myrec:")
+async def cb_myrec(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    row_idx = int(data.split(":", 1)[1])
+    rec = await find_my_created_record(update.effective_user.id, row_idx)
 
+    if not rec:
         await update.effective_message.edit_text(
-            "Введіть новий номер ТТ працівника цифрами.\n\n"
-            "Наприклад: 054"
+            "Запис не знайдено або він уже неактивний."
         )
-        return
-    
-    if data.startswith("editrec_note:"):
-        row_idx = int(data.split(":", 1)[1])
-        records = get_my_created_records(update.effective_user.id)
-        rec = next((r for r in records if r["row_idx"] == row_idx), None)
+        return True
 
-        if not rec:
-            await update.effective_message.edit_text(
-                "Запис не знайдено або він уже неактивний."
-            )
-            return
+    if rec["request_type"] == REQUEST_TYPE_WANT:
+        tt_line = f"ТТ працівника: {rec['worker_store'] or '—'}"
+    else:
+        tt_line = f"ТТ: {rec['store'] or '—'}"
+
+    comment_line = rec["note"] if rec["note"] else "—"
+
+    kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton("✏️ Редагувати запис", callback_data=f"editrec:{row_idx}")],
+        [InlineKeyboardButton("❌ Скасувати запис", callback_data=f"cancelrec:{row_idx}")],
+        [InlineKeyboardButton("⬅️ Назад до списку", callback_data="menu:mycreated")]
+    ])
+
+    await update.effective_message.edit_text(
+        f"📌 {rec['request_type']}\n"
+        f"Дата: {rec['date_str']}\n"
+        f"Час: {rec['time_from']}–{rec['time_to']}\n"
+        f"{tt_line}\n"
+        f"Коментар: {comment_line}",
+        reply_markup=kb
+    )
+    return True
 
-        context.user_data["await"] = "edit_note"
-        context.user_data["edit_row_idx"] = row_idx
+@CALLBACKS.route("editrec:")
+async def cb_editrec(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    row_idx = int(data.split(":", 1)[1])
+    rec = await find_my_created_record(update.effective_user.id, row_idx)
 
+    if not rec:
         await update.effective_message.edit_text(
-            "Введіть новий коментар.\n\n"
-            "Якщо хочете прибрати коментар зовсім, надішліть: -"
+            "Запис не знайдено або він уже неактивний."
         )
-        return
-    
-    if data.startswith("cancelrec:"):
-        row_idx = int(data.split(":", 1)[1])
-        records = get_my_created_records(update.effective_user.id)
-        rec = next((r for r in records if r["row_idx"] == row_idx), None)
+        return True
 
-        if not rec:
-            await update.effective_message.edit_text(
-                "Запис не знайдено або він уже неактивний."
-            )
-            return
+    buttons = [
+        [InlineKeyboardButton("🗓 Змінити дату", callback_data=f"editrec_date:{row_idx}")],
+        [InlineKeyboardButton("🕒 Змінити час", callback_data=f"editrec_time:{row_idx}")],
+        [InlineKeyboardButton("💬 Змінити коментар", callback_data=f"editrec_note:{row_idx}")]
+    ]
+
+    if rec["request_type"] == REQUEST_TYPE_WANT:
+        buttons.insert(
+            2,
+            [InlineKeyboardButton("🏪 Змінити ТТ працівника", callback_data=f"editrec_worker_store:{row_idx}")]
+        )
+
+    buttons.append([InlineKeyboardButton("⬅️ Назад до запису", callback_data=f"myrec:{row_idx}")])
+
+    await update.effective_message.edit_text(
+        "Що саме хочете змінити?",
+        reply_markup=InlineKeyboardMarkup(buttons)
+    )
+    return True
 
-        requests_ws.update_cell(row_idx, COL_RECORD_STATE, RECORD_STATE_CANCELLED)
+@CALLBACKS.route("editrec_time:")
+async def cb_editrec_time(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    row_idx = int(data.split(":", 1)[1])
+    rec = await find_my_created_record(update.effective_user.id, row_idx)
 
+    if not rec:
         await update.effective_message.edit_text(
-            "✅ Запис скасовано.\n\n"
-            "Він більше не буде показуватись у списку активних записів."
-        )        
-        return
-    
-    if data == "menu:create":
-        keep_phone = context.user_data.get("creator_phone")
-        keep_name  = context.user_data.get("emp_name")
-        keep_tg    = context.user_data.get("creator_tg") or update.effective_user.id
-
-        # Якщо немає телефону керівника — просимо його одразу
-        if not keep_phone:
-            kb = ReplyKeyboardMarkup(
-                [[KeyboardButton("📞 Поділитися номером", request_contact=True)]],
-                resize_keyboard=True, one_time_keyboard=True
-            )
-            await update.effective_message.reply_text(
-                "📲 Щоб створити зміну, спочатку поділися своїм номером телефону:",
-                reply_markup=kb
-            )
-            context.user_data["await_create_phone"] = True
-            return
+            "Запис не знайдено або він уже неактивний."
+        )
+        return True
 
-        # якщо телефон уже є — продовжуємо
-        context.user_data.clear()
-        if keep_phone: context.user_data["creator_phone"] = keep_phone
-        if keep_name:  context.user_data["emp_name"] = keep_name
-        if keep_tg:    context.user_data["creator_tg"] = keep_tg
+    context.user_data["edit_mode"] = "time"
+    context.user_data["edit_row_idx"] = row_idx
 
-        context.user_data["mode"] = "create"
+    try:
+        start_h, start_m = map(int, rec["time_from"].split(":"))
+    except Exception:
+        start_h, start_m = 9, 0
+
+    try:
+        end_h, end_m = map(int, rec["time_to"].split(":"))
+    except Exception:
+        end_h, end_m = 18, 0
+
+    context.user_data["edit_time_to_default_h"] = end_h
+    context.user_data["edit_time_to_default_m"] = end_m
+
+    await update.effective_message.edit_text(
+        "Оберіть новий час з:",
+        reply_markup=build_time_picker("edit_time_from", start_h, start_m, label="Час з")
+    )
+    return True
+
+@CALLBACKS.route("editrec_date:")
+async def cb_editrec_date(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    row_idx = int(data.split(":", 1)[1])
+    rec = await find_my_created_record(update.effective_user.id, row_idx)
+
+    if not rec:
         await update.effective_message.edit_text(
-            "Оберіть регіон:",
-            reply_markup=build_region_keyboard()
+            "Запис не знайдено або він уже неактивний."
         )
-        return
+        return True
 
-    # --- Меню бронювання зміни ---
-    if data == "menu:book":
-        keep_phone = context.user_data.get("creator_phone")
-        keep_name  = context.user_data.get("emp_name")
-        keep_tg    = context.user_data.get("creator_tg") or update.effective_user.id
+    context.user_data["edit_mode"] = "date"
+    context.user_data["edit_row_idx"] = row_idx
 
-        context.user_data.clear()
-        if keep_phone: context.user_data["creator_phone"] = keep_phone
-        if keep_name:  context.user_data["emp_name"] = keep_name
-        if keep_tg:    context.user_data["creator_tg"] = keep_tg
+    await update.effective_message.edit_text(
+        "Оберіть нову дату:",
+        reply_markup=build_calendar()
+    )
+    return True
 
-        context.user_data["mode"] = "book"
-        await update.effective_message.edit_text("Оберіть регіон:", reply_markup=build_region_keyboard())
-        return
+@CALLBACKS.route("editrec_worker_store:")
+async def cb_editrec_worker_store(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    row_idx = int(data.split(":", 1)[1])
+    rec = await find_my_created_record(update.effective_user.id, row_idx)
 
-    if data == "menu:mydone":
-        if not context.user_data.get("creator_phone"):
-            kb = ReplyKeyboardMarkup([[KeyboardButton("📞 Поділитися номером", request_contact=True)]],
-                                     resize_keyboard=True, one_time_keyboard=True)
-            await update.effective_message.reply_text("Щоб знайти твої відпрацьовані, надішли номер:", reply_markup=kb)
-            context.user_data["await_mydone_phone"] = True
-            return
-        await show_my_attendance(update, context)
-        return
+    if not rec:
+        await update.effective_message.edit_text(
+            "Запис не знайдено або він уже неактивний."
+        )
+        return True
 
-    # Регіон → міста
-    if data.startswith("region:"):
-        region = data.split(":",1)[1]
-        context.user_data["region"] = region
-        kb = build_cities_keyboard_region(region)
-        if kb:
-            mode = context.user_data.get("mode")
-            prompt = "Оберіть місто для створення:" if mode == "create" else "Оберіть місто для бронювання:"
-            await update.effective_message.edit_text(prompt, reply_markup=kb)
-        else:
-            await update.effective_message.edit_text("Не знайшла довідник міст у вибраному регіоні.")
-        return
+    if rec["request_type"] != REQUEST_TYPE_WANT:
+        await update.effective_message.edit_text(
+            "Ця зміна доступна тільки для записів «Хочу у відрядження»."
+        )
+        return True
 
-    # Місто → або списки змін, або магазини
-    if data.startswith("pickcity:"):
-        city = data.split(":", 1)[1]
-        context.user_data["city"] = city
-        mode = context.user_data.get("mode") or "book"
+    context.user_data["await"] = "edit_worker_store"
+    context.user_data["edit_row_idx"] = row_idx
 
-        if mode == "book":
-            await update.effective_message.edit_text(
-                f"Місто: {city}\nОберіть дату:",
-                reply_markup=build_booking_calendar(city)
-            )
-            return
+    await update.effective_message.edit_text(
+        "Введіть новий номер ТТ працівника цифрами.\n\n"
+        "Наприклад: 054"
+    )
+    return True
 
-        # create
-        kb = build_stores_keyboard(city)
-        if kb:
-            await update.effective_message.edit_text(f"Місто: {city}\nОберіть №_магазину:", reply_markup=kb)
-        else:
-            await update.effective_message.edit_text(f"У місті {city} немає магазинів у довіднику.")
-        return
+@CALLBACKS.route("editrec_note:")
+async def cb_editrec_note(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    row_idx = int(data.split(":", 1)[1])
+    rec = await find_my_created_record(update.effective_user.id, row_idx)
 
-    # Магазин → календар дати
-    if data.startswith("pickstore:"):
-        store_num = data.split(":", 1)[1]
-        context.user_data["store_num"] = store_num
+    if not rec:
         await update.effective_message.edit_text(
-            f"✅ Магазин обрано: {store_num}\n\nОберіть дату зміни:",
-            reply_markup=build_calendar()
+            "Запис не знайдено або він уже неактивний."
         )
-        return
+        return True
 
-    # Календар навігація
-    if data.startswith("calnav:"):
-        _, y, m, dirn = data.split(":")
-        y, m = int(y), int(m)
-        if dirn == "prev":
-            m -= 1
-            if m == 0: m, y = 12, y-1
-        else:
-            m += 1
-            if m == 13: m, y = 1, y+1
-        await update.effective_message.edit_text("Оберіть дату зміни:", reply_markup=build_calendar(y,m))
-        return
+    context.user_data["await"] = "edit_note"
+    context.user_data["edit_row_idx"] = row_idx
 
-    # --- Навігація календаря для бронювання ---
-    if data.startswith("calnav2:"):
-        _, y, m, direction = data.split(":")
-        y, m = int(y), int(m)
+    await update.effective_message.edit_text(
+        "Введіть новий коментар.\n\n"
+        "Якщо хочете прибрати коментар зовсім, надішліть: -"
+    )
+    return True
 
-        if direction == "prev":
-            m -= 1
-            if m == 0:
-                m, y = 12, y - 1
-        else:
-            m += 1
-            if m == 13:
-                m, y = 1, y + 1
+@CALLBACKS.route("cancelrec:")
+async def cb_cancelrec(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    row_idx = int(data.split(":", 1)[1])
+    rec = await find_my_created_record(update.effective_user.id, row_idx)
 
-        city = context.user_data.get("city")
+    if not rec:
         await update.effective_message.edit_text(
-            "Оберіть дату:",
-            reply_markup=build_booking_calendar(city, y, m)
+            "Запис не знайдено або він уже неактивний."
         )
-        return
+        return True
 
-    # Обрана дата → вибір часу початку
+    await requests_patch_row(row_idx, {COL_RECORD_STATE: RECORD_STATE_CANCELLED})
+
+    await update.effective_message.edit_text(
+        "✅ Запис скасовано.\n\n"
+        "Він більше не буде показуватись у списку активних записів."
+    )
+    return True
 
-    if data.startswith("calpick:"):
-        d = data.split(":", 1)[1]
-        dd = datetime.strptime(d, "%Y-%m-%d").strftime("%d.%m.%Y")
+@CALLBACKS.route("menu:create", exact=True)
+async def cb_menu_create(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    keep_phone = context.user_data.get("creator_phone")
+    keep_name  = context.user_data.get("emp_name")
+    keep_tg    = context.user_data.get("creator_tg") or update.effective_user.id
+
+    # Якщо немає телефону керівника — просимо його одразу
+    if not keep_phone:
+        kb = ReplyKeyboardMarkup(
+            [[KeyboardButton("📞 Поділитися номером", request_contact=True)]],
+            resize_keyboard=True, one_time_keyboard=True
+        )
+        await update.effective_message.reply_text(
+            "📲 Щоб створити зміну, спочатку поділися своїм номером телефону:",
+            reply_markup=kb
+        )
+        set_menu_keyboard_shown(context, False)
+        context.user_data["await_create_phone"] = True
+        return True
+
+    # якщо телефон уже є — продовжуємо
+    context.user_data.clear()
+    if keep_phone: context.user_data["creator_phone"] = keep_phone
+    if keep_name:  context.user_data["emp_name"] = keep_name
+    if keep_tg:    context.user_data["creator_tg"] = keep_tg
+
+    context.user_data["mode"] = "create"
+    await update.effective_message.edit_text(
+        "Оберіть регіон:",
+        reply_markup=build_region_keyboard()
+    )
+    return True
 
-        if context.user_data.get("edit_mode") == "date":
-            row_idx = context.user_data.get("edit_row_idx")
+# --- Меню бронювання зміни ---
+@CALLBACKS.route("menu:book", exact=True)
+async def cb_menu_book(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    keep_phone = context.user_data.get("creator_phone")
+    keep_name  = context.user_data.get("emp_name")
+    keep_tg    = context.user_data.get("creator_tg") or update.effective_user.id
 
-            if not row_idx:
-                context.user_data.pop("edit_mode", None)
-                await update.effective_message.edit_text("❌ Не знайдено запис для редагування.")
-                return
+    context.user_data.clear()
+    if keep_phone: context.user_data["creator_phone"] = keep_phone
+    if keep_name:  context.user_data["emp_name"] = keep_name
+    if keep_tg:    context.user_data["creator_tg"] = keep_tg
 
-            requests_ws.update_cell(row_idx, COL_DATE, dd)
+    context.user_data["mode"] = "book"
+    await update.effective_message.edit_text("Оберіть регіон:", reply_markup=build_region_keyboard())
+    return True
 
-            context.user_data.pop("edit_mode", None)
-            context.user_data.pop("edit_row_idx", None)
+@CALLBACKS.route("menu:mydone", exact=True)
+async def cb_menu_mydone(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    if not context.user_data.get("creator_phone"):
+        kb = ReplyKeyboardMarkup([[KeyboardButton("📞 Поділитися номером", request_contact=True)]],
+                                 resize_keyboard=True, one_time_keyboard=True)
+        await update.effective_message.reply_text("Щоб знайти твої відпрацьовані, надішли номер:", reply_markup=kb)
+        set_menu_keyboard_shown(context, False)
+        context.user_data["await_mydone_phone"] = True
+        return True
+    await show_my_attendance(update, context)
+    return True
 
-            await update.effective_message.edit_text(
-                f"✅ Дату оновлено: {dd}"
-            )            
-            return
+# Регіон → міста
+@CALLBACKS.route("region:")
+async def cb_region(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    region = data.split(":",1)[1]
+    context.user_data["region"] = region
+    kb = await build_cities_keyboard_region(region)
+    if kb:
+        mode = context.user_data.get("mode")
+        prompt = "Оберіть місто для створення:" if mode == "create" else "Оберіть місто для бронювання:"
+        await update.effective_message.edit_text(prompt, reply_markup=kb)
+    else:
+        await update.effective_message.edit_text("Не знайшла довідник міст у вибраному регіоні.")
+    return True
 
-        if context.user_data.get("mode") == "want_trip":
-            context.user_data["trip_date"] = d
-            kb = build_time_picker("trip_from", 9, 0, label="Час з")
-            await update.effective_message.edit_text(
-                f"Дата: {dd}\nОберіть час з:",
-                reply_markup=kb
-            )
-            return
+# Місто → або списки змін, або магазини
+@CALLBACKS.route("pickcity:")
+async def cb_pickcity(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    if is_token_callback(data, "pickcity:"):
+        payload = callback_payload(data)
+        if payload is None:
+            await expired_button(update)
+            return True
+        city = payload["city"]
+    else:
+        # старий формат: назва міста прямо в callback_data
+        city = data.split(":", 1)[1]
+    context.user_data["city"] = city
+    mode = context.user_data.get("mode") or "book"
 
-        context.user_data["date"] = d
-        kb = build_time_picker("tstart", 9, 0, label="Початок")
+    if mode == "book":
         await update.effective_message.edit_text(
-            f"Дата: {dd}\nОберіть час початку:",
-            reply_markup=kb
+            f"Місто: {city}\nОберіть дату:",
+            reply_markup=await build_booking_calendar(city)
         )
-        return  
-       
-    if data.startswith("trip_from:"):
-        _, action, hh, mm = data.split(":")
-        h, m = _parse_hm(hh, mm)
-
-        if action == "inc":
-            h, m = _inc_time(h, m)
-            kb = build_time_picker("trip_from", h, m, label="Час з")
-            await update.effective_message.edit_text(
-                "Оберіть час з:",
-                reply_markup=kb
-            )
-            return
+        return True
 
-        if action == "dec":
-            h, m = _dec_time(h, m)
-            kb = build_time_picker("trip_from", h, m, label="Час з")
-            await update.effective_message.edit_text(
-                "Оберіть час з:",
-                reply_markup=kb
-            )
-            return
+    # create
+    kb = await build_stores_keyboard(city)
+    if kb:
+        await update.effective_message.edit_text(f"Місто: {city}\nОберіть №_магазину:", reply_markup=kb)
+    else:
+        await update.effective_message.edit_text(f"У місті {city} немає магазинів у довіднику.")
+    return True
 
-        if action == "ok":
-            context.user_data["trip_time_from"] = _time_to_str(h, m)
-            kb = build_time_picker("trip_to", 18, 0, label="Час по")
-            await update.effective_message.edit_text(
-                f"Час з: {context.user_data['trip_time_from']}\nОберіть час по:",
-                reply_markup=kb
-            )
-            return    
-    # Час початку і редагув.часу
-    if data.startswith("edit_time_from:"):
-        _, action, hh, mm = data.split(":")
-        h, m = _parse_hm(hh, mm)
-
-        if action == "inc":
-            h, m = _inc_time(h, m)
-            await update.effective_message.edit_text(
-                "Оберіть новий час з:",
-                reply_markup=build_time_picker("edit_time_from", h, m, label="Час з")
-            )
-            return
+# Магазин → календар дати
+@CALLBACKS.route("pickstore:")
+async def cb_pickstore(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    store_num = data.split(":", 1)[1]
+    context.user_data["store_num"] = store_num
+    await update.effective_message.edit_text(
+        f"✅ Магазин обрано: {store_num}\n\nОберіть дату зміни:",
+        reply_markup=build_calendar()
+    )
+    return True
 
-        if action == "dec":
-            h, m = _dec_time(h, m)
-            await update.effective_message.edit_text(
-                "Оберіть новий час з:",
-                reply_markup=build_time_picker("edit_time_from", h, m, label="Час з")
-            )
-            return
+# Календар навігація
+@CALLBACKS.route("calnav:")
+async def cb_calnav(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    _, y, m, dirn = data.split(":")
+    y, m = int(y), int(m)
+    if dirn == "prev":
+        m -= 1
+        if m == 0: m, y = 12, y-1
+    else:
+        m += 1
+        if m == 13: m, y = 1, y+1
+    await update.effective_message.edit_text("Оберіть дату зміни:", reply_markup=build_calendar(y,m))
+    return True
 
-        if action == "ok":
-            context.user_data["edit_time_from"] = _time_to_str(h, m)
+# --- Навігація календаря для бронювання ---
+@CALLBACKS.route("calnav2:")
+async def cb_calnav2(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    _, y, m, direction = data.split(":")
+    y, m = int(y), int(m)
 
-            end_h = context.user_data.get("edit_time_to_default_h", 18)
-            end_m = context.user_data.get("edit_time_to_default_m", 0)
+    if direction == "prev":
+        m -= 1
+        if m == 0:
+            m, y = 12, y - 1
+    else:
+        m += 1
+        if m == 13:
+            m, y = 1, y + 1
+
+    city = context.user_data.get("city")
+    await update.effective_message.edit_text(
+        "Оберіть дату:",
+        reply_markup=await build_booking_calendar(city, y, m)
+    )
+    return True
 
-            await update.effective_message.edit_text(
-                f"Час з: {context.user_data['edit_time_from']}\nОберіть новий час по:",
-                reply_markup=build_time_picker("edit_time_to", end_h, end_m, label="Час по")
-            )
-            return
-    
-    if data.startswith("tstart:"):
-        _, action, hh, mm = data.split(":")
-        h, m = _parse_hm(hh, mm)
-        if action == "inc":
-            h,m = _inc_time(h,m)
-            kb = build_time_picker("tstart", h, m, label="Початок")
-            await update.effective_message.edit_text("Оберіть час початку:", reply_markup=kb)
-        elif action == "dec":
-            h,m = _dec_time(h,m)
-            kb = build_time_picker("tstart", h, m, label="Початок")
-            await update.effective_message.edit_text("Оберіть час початку:", reply_markup=kb)
-        elif action == "ok":
-            context.user_data["time_start"] = _time_to_str(h,m)
-            kb = build_time_picker("tend", 18, 0, label="Кінець")
-            await update.effective_message.edit_text("Оберіть час закінчення:", reply_markup=kb)
-        return
+# Обрана дата → вибір часу початку
+@CALLBACKS.route("calpick:")
+async def cb_calpick(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    d = data.split(":", 1)[1]
+    dd = datetime.strptime(d, "%Y-%m-%d").strftime("%d.%m.%Y")
 
-    # Час кінця
-    if data.startswith("trip_to:"):
-        _, action, hh, mm = data.split(":")
-        h, m = _parse_hm(hh, mm)
+    if context.user_data.get("edit_mode") == "date":
+        row_idx = context.user_data.get("edit_row_idx")
 
-        if action == "inc":
-            h, m = _inc_time(h, m)
-            kb = build_time_picker("trip_to", h, m, label="Час по")
-            await update.effective_message.edit_text(
-                "Оберіть час по:",
-                reply_markup=kb
-            )
-            return
+        if not row_idx:
+            context.user_data.pop("edit_mode", None)
+            await update.effective_message.edit_text("❌ Не знайдено запис для редагування.")
+            return True
 
-        if action == "dec":
-            h, m = _dec_time(h, m)
-            kb = build_time_picker("trip_to", h, m, label="Час по")
-            await update.effective_message.edit_text(
-                "Оберіть час по:",
-                reply_markup=kb
-            )
-            return
+        await requests_patch_row(row_idx, {COL_DATE: dd})
 
-        if action == "ok":
-            context.user_data["trip_time_to"] = _time_to_str(h, m)
-            context.user_data["await"] = "trip_comment"
+        context.user_data.pop("edit_mode", None)
+        context.user_data.pop("edit_row_idx", None)
 
-            kb = InlineKeyboardMarkup([
-                [InlineKeyboardButton("Пропустити", callback_data="trip_comment_skip")]
-            ])
+        await update.effective_message.edit_text(
+            f"✅ Дату оновлено: {dd}"
+        )
+        return True
 
-            await update.effective_message.edit_text(
-                "✍️ Введіть коментар до заявки або натисніть «Пропустити».",
-                reply_markup=kb
-            )
-            return
+    if context.user_data.get("mode") == "want_trip":
+        context.user_data["trip_date"] = d
+        kb = build_time_picker("trip_from", 9, 0, label="Час з")
+        await update.effective_message.edit_text(
+            f"Дата: {dd}\nОберіть час з:",
+            reply_markup=kb
+        )
+        return True
 
-    if data.startswith("edit_time_to:"):
-        _, action, hh, mm = data.split(":")
-        h, m = _parse_hm(hh, mm)
+    context.user_data["date"] = d
+    kb = build_time_picker("tstart", 9, 0, label="Початок")
+    await update.effective_message.edit_text(
+        f"Дата: {dd}\nОберіть час початку:",
+        reply_markup=kb
+    )
+    return True
 
-        if action == "inc":
-            h, m = _inc_time(h, m)
-            await update.effective_message.edit_text(
-                "Оберіть новий час по:",
-                reply_markup=build_time_picker("edit_time_to", h, m, label="Час по")
-            )
-            return
+@CALLBACKS.route("trip_from:")
+async def cb_trip_from(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    _, action, hh, mm = data.split(":")
+    h, m = _parse_hm(hh, mm)
 
-        if action == "dec":
-            h, m = _dec_time(h, m)
-            await update.effective_message.edit_text(
-                "Оберіть новий час по:",
-                reply_markup=build_time_picker("edit_time_to", h, m, label="Час по")
-            )
-            return
+    if action == "inc":
+        h, m = _inc_time(h, m)
+        kb = build_time_picker("trip_from", h, m, label="Час з")
+        await update.effective_message.edit_text(
+            "Оберіть час з:",
+            reply_markup=kb
+        )
+        return True
 
-        if action == "ok":
-            row_idx = context.user_data.get("edit_row_idx")
+    if action == "dec":
+        h, m = _dec_time(h, m)
+        kb = build_time_picker("trip_from", h, m, label="Час з")
+        await update.effective_message.edit_text(
+            "Оберіть час з:",
+            reply_markup=kb
+        )
+        return True
 
-            if not row_idx:
-                context.user_data.pop("edit_mode", None)
-                await update.effective_message.edit_text("❌ Не знайдено запис для редагування.")
-                return
+    if action == "ok":
+        context.user_data["trip_time_from"] = _time_to_str(h, m)
+        kb = build_time_picker("trip_to", 18, 0, label="Час по")
+        await update.effective_message.edit_text(
+            f"Час з: {context.user_data['trip_time_from']}\nОберіть час по:",
+            reply_markup=kb
+        )
+        return True
 
-            new_time_from = context.user_data.get("edit_time_from", "")
-            new_time_to = _time_to_str(h, m)
+# Час початку і редагув.часу
+@CALLBACKS.route("edit_time_from:")
+async def cb_edit_time_from(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    _, action, hh, mm = data.split(":")
+    h, m = _parse_hm(hh, mm)
 
-            requests_ws.update_cell(row_idx, COL_TIME_FROM, new_time_from)
-            requests_ws.update_cell(row_idx, COL_TIME_TO, new_time_to)
+    if action == "inc":
+        h, m = _inc_time(h, m)
+        await update.effective_message.edit_text(
+            "Оберіть новий час з:",
+            reply_markup=build_time_picker("edit_time_from", h, m, label="Час з")
+        )
+        return True
 
-            context.user_data.pop("edit_mode", None)
-            context.user_data.pop("edit_row_idx", None)
-            context.user_data.pop("edit_time_from", None)
-            context.user_data.pop("edit_time_to_default_h", None)
-            context.user_data.pop("edit_time_to_default_m", None)
+    if action == "dec":
+        h, m = _dec_time(h, m)
+        await update.effective_message.edit_text(
+            "Оберіть новий час з:",
+            reply_markup=build_time_picker("edit_time_from", h, m, label="Час з")
+        )
+        return True
 
-            await update.effective_message.edit_text(
-                f"✅ Час оновлено: {new_time_from}–{new_time_to}"
-            )            
-            return
-           
-    if data.startswith("tend:"):
-        _, action, hh, mm = data.split(":")
-        h, m = _parse_hm(hh, mm)
-        if action in ("inc","dec"):
-            if action=="inc": h,m=_inc_time(h,m)
-            else: h,m=_dec_time(h,m)
-            kb = build_time_picker("tend", h, m, label="Кінець")
-            await update.effective_message.edit_text("Оберіть час закінчення:", reply_markup=kb)
-            return
-        if action == "ok":
-            context.user_data["time_end"] = _time_to_str(h,m)
-            context.user_data["await"] = "needed"
-            await update.effective_message.edit_text("Скільки працівників потрібно? (введи ціле число, наприклад 2)")
-            return
+    if action == "ok":
+        context.user_data["edit_time_from"] = _time_to_str(h, m)
 
-    # --- Підтвердження створення зміни (кнопкою) ---
-    if data.startswith("confirm_create:"):
-        parts = data.split(":")
-        if len(parts) < 6:
-            await update.effective_message.edit_text("❌ Дані створення неповні.")
-            return
+        end_h = context.user_data.get("edit_time_to_default_h", 18)
+        end_m = context.user_data.get("edit_time_to_default_m", 0)
 
-        city = parts[1]
-        store = parts[2]
-        date_s = parts[3]
-        t_start = parts[4]
-        t_end = parts[5]
-        needed = int(parts[6]) if len(parts) > 6 and parts[6].isdigit() else 1
+        await update.effective_message.edit_text(
+            f"Час з: {context.user_data['edit_time_from']}\nОберіть новий час по:",
+            reply_markup=build_time_picker("edit_time_to", end_h, end_m, label="Час по")
+        )
+        return True
+
+@CALLBACKS.route("tstart:")
+async def cb_tstart(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    _, action, hh, mm = data.split(":")
+    h, m = _parse_hm(hh, mm)
+    if action == "inc":
+        h,m = _inc_time(h,m)
+        kb = build_time_picker("tstart", h, m, label="Початок")
+        await update.effective_message.edit_text("Оберіть час початку:", reply_markup=kb)
+    elif action == "dec":
+        h,m = _dec_time(h,m)
+        kb = build_time_picker("tstart", h, m, label="Початок")
+        await update.effective_message.edit_text("Оберіть час початку:", reply_markup=kb)
+    elif action == "ok":
+        context.user_data["time_start"] = _time_to_str(h,m)
+        kb = build_time_picker("tend", 18, 0, label="Кінець")
+        await update.effective_message.edit_text("Оберіть час закінчення:", reply_markup=kb)
+    return True
 
-        # --- визначаємо новий рядок ---
-      
-        next_row = get_next_requests_row()
-        
-        # --- запис усіх основних даних ---
-        payload = [
-            {'range': f'B{next_row}:B{next_row}', 'values': [[store]]},
-            {'range': f'C{next_row}:C{next_row}', 'values': [[city]]},  # <– МІСТО
-            {'range': f'D{next_row}:G{next_row}', 'values': [[date_s, t_start, t_end, needed]]},
-            {'range': f'I{next_row}:I{next_row}', 'values': [[STATUS_PENDING]]},
-            {'range': f'K{next_row}:L{next_row}', 'values': [[
-                str(context.user_data.get("creator_tg") or update.effective_user.id),
-                str(context.user_data.get("creator_phone") or "")
-            ]]},
-            {'range': f'R{next_row}:T{next_row}', 'values': [[REQUEST_TYPE_NEED, RECORD_STATE_ACTIVE, ""]]},
-        ]
-        requests_ws.batch_update(payload)
-
-        # --- контрольний виклик для надійності ---
-        try:
-            _write_creator_fields(next_row, update, context)
-        except Exception as e:
-            print(f"[debug] дублюючий запис керівника не вдався: {e}")
+# Час кінця
+@CALLBACKS.route("trip_to:")
+async def cb_trip_to(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    _, action, hh, mm = data.split(":")
+    h, m = _parse_hm(hh, mm)
 
-        await update.effective_message.edit_text("✅ Зміну створено успішно.")
+    if action == "inc":
+        h, m = _inc_time(h, m)
+        kb = build_time_picker("trip_to", h, m, label="Час по")
+        await update.effective_message.edit_text(
+            "Оберіть час по:",
+            reply_markup=kb
+        )
+        return True
 
-        return
+    if action == "dec":
+        h, m = _dec_time(h, m)
+        kb = build_time_picker("trip_to", h, m, label="Час по")
+        await update.effective_message.edit_text(
+            "Оберіть час по:",
+            reply_markup=kb
+        )
+        return True
 
-    # --- Обрана дата ---
-    if data.startswith("bookdate:"):
-        _, d = data.split(":")
-        d_obj = parse_date_flexible(d)
+    if action == "ok":
+        context.user_data["trip_time_to"] = _time_to_str(h, m)
+        context.user_data["await"] = "trip_comment"
 
-        if not d_obj:
-            await update.effective_message.edit_text("Помилка читання дати.")
-            return
+        kb = InlineKeyboardMarkup([
+            [InlineKeyboardButton("Пропустити", callback_data="trip_comment_skip")]
+        ])
 
-        context.user_data["book_date"] = d
+        await update.effective_message.edit_text(
+            "✍️ Введіть коментар до заявки або натисніть «Пропустити».",
+            reply_markup=kb
+        )
+        return True
 
-        # Завантажуємо зміни на цю дату та це місто
-        city = context.user_data.get("city")
+@CALLBACKS.route("edit_time_to:")
+async def cb_edit_time_to(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    _, action, hh, mm = data.split(":")
+    h, m = _parse_hm(hh, mm)
 
-        rows, _ = get_requests_records()
-        stores, _ = safe_stores_records()
-        city_map = {str(s.get("№_магазину","")).strip(): str(s.get("Місто","")).strip() for s in stores}
+    if action == "inc":
+        h, m = _inc_time(h, m)
+        await update.effective_message.edit_text(
+            "Оберіть новий час по:",
+            reply_markup=build_time_picker("edit_time_to", h, m, label="Час по")
+        )
+        return True
 
-        # шукаємо всі зміни на обрану дату
-        avail = []
-        for idx, r in enumerate(rows, start=2):
-            if not is_active_need_request(r):
-                continue
-                
-            store = str(r.get("№_магазину","")).strip()
-            r_city = (str(r.get("Місто","")).strip() or city_map.get(store, ""))
+    if action == "dec":
+        h, m = _dec_time(h, m)
+        await update.effective_message.edit_text(
+            "Оберіть новий час по:",
+            reply_markup=build_time_picker("edit_time_to", h, m, label="Час по")
+        )
+        return True
 
-            if r_city != city:
-                continue
+    if action == "ok":
+        row_idx = context.user_data.get("edit_row_idx")
 
-            date_s = str(r.get("Дата","")).strip()
-            r_date = parse_date_flexible(date_s)
-            if not r_date or r_date != d_obj:
-                continue
+        if not row_idx:
+            context.user_data.pop("edit_mode", None)
+            await update.effective_message.edit_text("❌ Не знайдено запис для редагування.")
+            return True
 
-            needed_s = str(r.get("Потрібно","")).strip()
-            needed = int(float(needed_s)) if needed_s.replace(",",".").replace(".","",1).isdigit() else 1
+        new_time_from = context.user_data.get("edit_time_from", "")
+        new_time_to = _time_to_str(h, m)
 
-            booked_raw = str(r.get("Заброньовано","")).strip()
-            booked_ids = [x.strip() for x in booked_raw.split(",") if x.strip()]
-            free = needed - len(booked_ids)
+        await requests_patch_row(row_idx, {COL_TIME_FROM: new_time_from, COL_TIME_TO: new_time_to})
 
-            if free <= 0:
-                continue
+        context.user_data.pop("edit_mode", None)
+        context.user_data.pop("edit_row_idx", None)
+        context.user_data.pop("edit_time_from", None)
+        context.user_data.pop("edit_time_to_default_h", None)
+        context.user_data.pop("edit_time_to_default_m", None)
 
-            t_start = str(r.get("Час_початку","")).strip()
-            t_end   = str(r.get("Час_закінчення","")).strip()
+        await update.effective_message.edit_text(
+            f"✅ Час оновлено: {new_time_from}–{new_time_to}"
+        )
+        return True
+
+@CALLBACKS.route("tend:")
+async def cb_tend(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    _, action, hh, mm = data.split(":")
+    h, m = _parse_hm(hh, mm)
+    if action in ("inc","dec"):
+        if action=="inc": h,m=_inc_time(h,m)
+        else: h,m=_dec_time(h,m)
+        kb = build_time_picker("tend", h, m, label="Кінець")
+        await update.effective_message.edit_text("Оберіть час закінчення:", reply_markup=kb)
+        return True
+    if action == "ok":
+        context.user_data["time_end"] = _time_to_str(h,m)
+        context.user_data["await"] = "needed"
+        await update.effective_message.edit_text("Скільки працівників потрібно? (введи ціле число, наприклад 2)")
+        return True
+
+# --- Обрана дата ---
+@CALLBACKS.route("bookdate:")
+async def cb_bookdate(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    _, d = data.split(":")
+    d_obj = parse_date_flexible(d)
+
+    if not d_obj:
+        await update.effective_message.edit_text("Помилка читання дати.")
+        return True
+
+    context.user_data["book_date"] = d
+    await show_bookdate_shifts(update, context)
+    return True
 
-            label = f"{t_start}-{t_end} • ТТ {store}"
-            avail.append((idx, label))
+async def show_bookdate_shifts(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                               cursor: Optional[Tuple[str, int]] = None):
+    # Завантажуємо зміни на обрану дату та це місто
+    city = context.user_data.get("city")
+    d_obj = parse_date_flexible(context.user_data.get("book_date", ""))
 
-        if not avail:
-            await update.effective_message.edit_text(
-                "На цю дату немає доступних змін.\nОберіть іншу дату:",
-                reply_markup=build_booking_calendar(city)
-            )
-            return
+    snap = await get_requests_snapshot()
 
-        kb = [[InlineKeyboardButton(text, callback_data=f"book:{row_idx}")]
-              for row_idx, text in avail]
+    # вільні зміни на обрану дату (у порядку таблиці)
+    avail = [
+        ((r.row_idx,), f"{r.time_from}-{r.time_to} • ТТ {r.store}")
+        for r in (snap.need_rows(city, d_obj) if d_obj else [])
+        if r.bookable
+    ]
 
+    if not avail:
         await update.effective_message.edit_text(
-            f"Дата: {d_obj.strftime('%d.%m.%Y')}\nОберіть зміну:",
-            reply_markup=InlineKeyboardMarkup(kb)
+            "На цю дату немає доступних змін.\nОберіть іншу дату:",
+            reply_markup=await build_booking_calendar(city)
         )
         return
 
-    # --- Бронювання зміни (натискання на зміну) ---
-    if data.startswith("book:"):
-        row_idx = int(data.split(":", 1)[1])
+    page, start = paginate(avail, cursor, lambda row_idx: (row_idx,))
+    kb = [[InlineKeyboardButton(text[:64], callback_data=f"book:{key[-1]}")]
+          for key, text in page]
+    nav = page_nav_row("bookdate", page, start, len(avail))
+    if nav:
+        kb.append(nav)
 
-        if not context.user_data.get("creator_phone"):
-            context.user_data["pending_book_row"] = row_idx
-            kb = ReplyKeyboardMarkup(
-                [[KeyboardButton("📞 Поділитися номером", request_contact=True)]],
-                resize_keyboard=True, one_time_keyboard=True
-            )
-            await update.effective_chat.send_message("Щоб завершити бронювання, надішли свій номер:", reply_markup=kb)
-            return
+    await update.effective_message.edit_text(
+        f"Дата: {d_obj.strftime('%d.%m.%Y')}\nОберіть зміну:",
+        reply_markup=InlineKeyboardMarkup(kb)
+    )
 
-        if not context.user_data.get("emp_name"):
-            context.user_data["pending_book_row"] = row_idx
-            context.user_data["await"] = "emp_name"
-            await update.effective_message.edit_text("Вкажіть ПІБ у форматі: Прізвище Ім’я")
-            return
+# --- Сторінки списків (pg:<view>:<n|p>:<row_idx>) ---
+@CALLBACKS.route("pg:")
+async def cb_pg(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    view, cursor = parse_page_cursor(data)
+
+    if view == "mycreated":
+        await show_my_created_records(update, context, cursor)
+    elif view == "bookdate":
+        await show_bookdate_shifts(update, context, cursor)
+    elif view == "mydone":
+        await show_my_attendance(update, context, cursor)
+    else:
+        return False
+    return True
 
-        await complete_booking_after_data(update, context, row_idx)
-        return
+# --- Бронювання зміни (натискання на зміну) ---
+@CALLBACKS.route("book:")
+async def cb_book(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    row_idx = int(data.split(":", 1)[1])
+
+    if not context.user_data.get("creator_phone"):
+        context.user_data["pending_book_row"] = row_idx
+        kb = ReplyKeyboardMarkup(
+            [[KeyboardButton("📞 Поділитися номером", request_contact=True)]],
+            resize_keyboard=True, one_time_keyboard=True
+        )
+        await update.effective_chat.send_message("Щоб завершити бронювання, надішли свій номер:", reply_markup=kb)
+        set_menu_keyboard_shown(context, False)
+        return True
+
+    if not context.user_data.get("emp_name"):
+        context.user_data["pending_book_row"] = row_idx
+        context.user_data["await"] = "emp_name"
+        await update.effective_message.edit_text("Вкажіть ПІБ у форматі: Прізвище Ім’я")
+        return True
 
-    # --- Підтвердження керівником ---
-    if data.startswith("mgrconfirm:"):
+    await complete_booking_after_data(update, context, row_idx)
+    return True
+
+# --- Підтвердження керівником ---
+@CALLBACKS.route("mgrconfirm:")
+async def cb_mgrconfirm(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    if is_token_callback(data, "mgrconfirm:"):
+        payload = callback_payload(data)
+        if payload is None:
+            await expired_button(update)
+            return True
+        row_idx = int(payload["row_idx"])
+        worker_tg = payload["worker_tg"]
+        worker_phone = payload["worker_phone"]
+
+        if not is_shift_manager(update, context, payload["manager_tg"], payload["manager_phone"]):
+            await update.effective_message.edit_text(
+                "❗ Підтвердження доступне лише керівнику, який створив зміну."
+            )
+            return True
+    else:
+        # старий формат: mgrconfirm:{row_idx}:{tg_id}:{worker_phone}
         parts = data.split(":")
         row_idx = int(parts[1])
         worker_tg = parts[2]
         worker_phone = parts[3]
 
-        row = requests_ws.row_values(row_idx)
-        while len(row) < COL_ARRIVED:
-            row.append("")
+    # статус рахується від поточних бронювань — під локом рядка
+    async with requests_row_lock(row_idx):
+        row = await read_request_row(row_idx)
 
         manager_raw = (row[COL_CREATED_TG-1] or "").strip()
         manager_phone_raw = (row[COL_CREATED_PH-1] or "").strip()
-
-        manager_id = int(manager_raw) if manager_raw.isdigit() else None
         manager_phone_digits = re.sub(r"\D", "", manager_phone_raw)
-        user_phone_digits = re.sub(r"\D", "", context.user_data.get("creator_phone", ""))
 
-        if (manager_id and manager_id != update.effective_user.id) and \
-           (manager_phone_digits != user_phone_digits):
+        # автор міг змінитися в таблиці після надсилання кнопки — перевіряємо і живий рядок
+        if not is_shift_manager(update, context, manager_raw, manager_phone_raw):
             await update.effective_message.edit_text(
                 "❗ Підтвердження доступне лише керівнику, який створив зміну."
             )
-            return
+            return True
 
         store      = (row[COL_STORE-1] or "").strip()
         city       = (row[COL_CITY-1] or "").strip()
@@ -1999,180 +3705,147 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         booked_ids = [x.strip() for x in booked_raw.split(",") if x.strip()]
 
         new_status = f"{STATUS_CONFIRMED} ({len(booked_ids)}/{needed})"
-        requests_ws.update_cell(row_idx, COL_STATUS, new_status)
+        await requests_patch_row(row_idx, {COL_STATUS: new_status})
 
-        meta_city, meta_obl, meta_addr, _, _ = get_store_meta(store)
-        address = meta_addr
-        city = city or meta_city
+    meta_city, meta_obl, meta_addr, _, _ = await get_store_meta(store)
+    address = meta_addr
+    city = city or meta_city
 
-        phone_view = "+" + worker_phone if worker_phone else "—"
+    phone_view = "+" + worker_phone if worker_phone else "—"
 
-        await update.effective_message.edit_text(
-            "✅ Ви підтвердили бронювання\n"
+    await update.effective_message.edit_text(
+        "✅ Ви підтвердили бронювання\n"
+        f"Місто: {city}\n"
+        f"Адреса: {address}\n"
+        f"ТТ: {store}\n"
+        f"Дата: {date_s}\n"
+        f"Час: {t_start}–{t_end}\n"
+        f"Працівник: {phone_view}\n"
+        f"Статус: {new_status}"
+    )
+
+    # Повідомлення працівнику
+    OUTBOX.send_message(
+        int(worker_tg),
+        (
+            "✅ Ваше бронювання підтверджено керівником.\n"
             f"Місто: {city}\n"
             f"Адреса: {address}\n"
             f"ТТ: {store}\n"
             f"Дата: {date_s}\n"
             f"Час: {t_start}–{t_end}\n"
-            f"Працівник: {phone_view}\n"
-            f"Статус: {new_status}"
-        )
+            f"Телефон керівника: +{manager_phone_digits}"
+        ),
+        PRIO_HIGH
+    )
 
-        # Повідомлення працівнику
-        await update.get_bot().send_message(
-            chat_id=int(worker_tg),
-            text=(
-                "✅ Ваше бронювання підтверджено керівником.\n"
-                f"Місто: {city}\n"
-                f"Адреса: {address}\n"
-                f"ТТ: {store}\n"
-                f"Дата: {date_s}\n"
-                f"Час: {t_start}–{t_end}\n"
-                f"Телефон керівника: +{manager_phone_digits}"
-            )
-        )
-        
-        # --- PERSISTENT JobQueue ---
-        try:
-            # --- Парсимо дату ---
-            d = None
-            for fmt in ("%d.%m.%Y", "%Y-%m-%d"):
-                try:
-                    d = datetime.strptime(date_s, fmt).date()
-                    break
-                except:
-                    pass
+    # --- PERSISTENT JobQueue ---
+    try:
+        # --- Парсимо дату ---
+        d = None
+        for fmt in ("%d.%m.%Y", "%Y-%m-%d"):
+            try:
+                d = datetime.strptime(date_s, fmt).date()
+                break
+            except:
+                pass
 
-            if d:
-                now = now_kyiv()
-
-                # ---------- 1) Нагадування за день (18:00) ----------
-                day_before_dt = datetime(
-                    d.year, d.month, d.day, REMIND_HOUR_BEFORE, 0, tzinfo=KYIV_TZ
-                ) - timedelta(days=1)
-
-                if day_before_dt > now:
-                    job_id = jobqueue_add(
-                        job_type="remind",
-                        chat_id=int(worker_tg),
-                        row_idx=row_idx,
-                        when_dt=day_before_dt,
-                        text=(
-                            f"🔔 Нагадування: завтра зміна\n"
-                            f"{city}, ТТ {store}\n"
-                            f"{date_s} {t_start}–{t_end}\n"
-                            f"Адреса: {address}"
-                        )
+        if d:
+            now = now_kyiv()
+
+            # ---------- 1) Нагадування за день (18:00) ----------
+            day_before_dt = datetime(
+                d.year, d.month, d.day, REMIND_HOUR_BEFORE, 0, tzinfo=KYIV_TZ
+            ) - timedelta(days=1)
+
+            if day_before_dt > now:
+                await schedule_reminder(
+                    job_type="remind",
+                    chat_id=int(worker_tg),
+                    row_idx=row_idx,
+                    when_dt=day_before_dt,
+                    text=(
+                        f"🔔 Нагадування: завтра зміна\n"
+                        f"{city}, ТТ {store}\n"
+                        f"{date_s} {t_start}–{t_end}\n"
+                        f"Адреса: {address}"
                     )
+                )
 
-                    delay = (day_before_dt - now).total_seconds()
-
-                    context.application.job_queue.run_once(
-                        jobqueue_runner,
-                        when=delay,
-                        data={
-                            "job_id": job_id,
-                            "type": "remind",
-                            "chat_id": int(worker_tg),
-                            "row_idx": row_idx,
-                            "text": (
-                                f"🔔 Нагадування: завтра зміна\n"
-                                f"{city}, ТТ {store}\n"
-                                f"{date_s} {t_start}–{t_end}\n"
-                                f"Адреса: {address}"
-                            ),
-                        }
-                    )
+            # ---------- 2) Підтвердження прибуття ----------
+            try:
+                sh, sm = map(int, t_start.split(":"))
+            except:
+                sh, sm = 9, 0
+
+            start_dt = datetime(d.year, d.month, d.day, sh, sm, tzinfo=KYIV_TZ)
+
+            if start_dt > now:
+                await schedule_reminder(
+                    job_type="arrival",
+                    chat_id=int(worker_tg),
+                    row_idx=row_idx,
+                    when_dt=start_dt,
+                    text=""
+                )
 
-                # ---------- 2) Підтвердження прибуття ----------
-                try:
-                    sh, sm = map(int, t_start.split(":"))
-                except:
-                    sh, sm = 9, 0
-
-                start_dt = datetime(d.year, d.month, d.day, sh, sm, tzinfo=KYIV_TZ)
-
-                if start_dt > now:
-                    job_id = jobqueue_add(
-                        job_type="arrival",
-                        chat_id=int(worker_tg),
-                        row_idx=row_idx,
-                        when_dt=start_dt,
-                        text=""
-                    )
+    except Exception as e:
+        print("[debug] error persistent scheduling:", e)
 
-                    delay = (start_dt - now).total_seconds()
-
-                    context.application.job_queue.run_once(
-                        jobqueue_runner,
-                        when=delay,
-                        data={
-                            "job_id": job_id,
-                            "type": "arrival",
-                            "chat_id": int(worker_tg),
-                            "row_idx": row_idx,
-                            "text": ""
-                        }
-                    )
+    return True
 
-        except Exception as e:
-            print("[debug] error persistent scheduling:", e)
+# --- Підтвердження прибуття користувачем ---
+@CALLBACKS.route("arrived:")
+async def cb_arrived(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    row_idx = int(data.split(":",1)[1])
+    try:
+        row = await read_request_row(row_idx)
+    except Exception:
+        await update.effective_message.edit_text("❌ Не вдалося прочитати рядок для відмітки.")
+        return True
 
-        return
+    store     = (row[COL_STORE-1] or "").strip()
+    city_cell = (row[COL_CITY-1] or "").strip()
+    date_s    = (row[COL_DATE-1] or "").strip()
 
-    # --- Підтвердження прибуття користувачем ---
-    if data.startswith("arrived:"):
-        row_idx = int(data.split(":",1)[1])
-        try:
-            row = requests_ws.row_values(row_idx)
-            while len(row) < COL_ARRIVED:
-                row.append("")
-        except Exception:
-            await update.effective_message.edit_text("❌ Не вдалося прочитати рядок для відмітки.")
-            return
+    meta_city, meta_obl, meta_addr, _, _ = await get_store_meta(store)
+    city = city_cell or meta_city
 
-        store     = (row[COL_STORE-1] or "").strip()
-        city_cell = (row[COL_CITY-1] or "").strip()
-        date_s    = (row[COL_DATE-1] or "").strip()
+    await get_attendance_ws(create=True)
 
-        meta_city, meta_obl, meta_addr, _, _ = get_store_meta(store)
-        city = city_cell or meta_city
+    phone = context.user_data.get("creator_phone","")
+    phone_digits = re.sub(r"\D","", phone)
+    emp_name = context.user_data.get("emp_name","")
 
-        try:
-            att = ss.worksheet("Attendance")
-        except gspread.WorksheetNotFound:
-            att = ss.add_worksheet("Attendance", rows=1000, cols=10)
-
-        phone = context.user_data.get("creator_phone","")
-        phone_digits = re.sub(r"\D","", phone)
-        emp_name = context.user_data.get("emp_name","")
-
-        next_row = len(att.col_values(1)) + 1
-        payload = [
-            {'range': f'A{next_row}:A{next_row}', 'values': [[city]]},
-            {'range': f'B{next_row}:B{next_row}', 'values': [[store]]},
-            {'range': f'C{next_row}:C{next_row}', 'values': [[""]]},
-            {'range': f'D{next_row}:D{next_row}', 'values': [[date_s]]},
-            {'range': f'E{next_row}:E{next_row}', 'values': [[emp_name]]},
-            {'range': f'F{next_row}:F{next_row}', 'values': [[phone_digits]]},
-            {'range': f'G{next_row}:G{next_row}', 'values': [["Так"]]},
-        ]
-        att.batch_update(payload)
+    next_row = await ATTENDANCE_ROWS.allocate()
+    await mirror_call(MIRROR.write, "Attendance", next_row, {
+        1: city, 2: store, 3: "", 4: date_s, 5: emp_name, 6: phone_digits, 7: "Так",
+    }, True)
 
-        try:
-            requests_ws.update_cell(row_idx, COL_ARRIVED, "Так")
-        except Exception:
-            pass
+    try:
+        await requests_patch_row(row_idx, {COL_ARRIVED: "Так"})
+    except Exception:
+        pass
 
-        await update.effective_message.edit_text("✅ Дякуємо! Прибуття відмічено.")
+    await update.effective_message.edit_text("✅ Дякуємо! Прибуття відмічено.")
 
-        await update.effective_chat.send_message(
-            "Оберіть дію:",
-            reply_markup=persistent_menu()
-        )
+    await update.effective_chat.send_message(
+        "Оберіть дію:",
+        reply_markup=persistent_menu()
+    )
+    set_menu_keyboard_shown(context, True)
+    return True
+
+async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    data = query.data
+    print(f"[debug] callback_data = {data}")
+
+    if await CALLBACKS.dispatch(update, context, data):
         return
 
-    # В самому кінці on_callback
+    # Усе, що маршрут не обробив, — показуємо меню
     try:
         await auto_show_menu(update, context)
     except:
@@ -2184,10 +3857,7 @@ async def job_remind_tomorrow(context: ContextTypes.DEFAULT_TYPE):
     chat_id = data.get("chat_id")
     txt = data.get("text","Нагадування про зміну завтра.")
     if chat_id:
-        try:
-            await context.bot.send_message(chat_id=chat_id, text=txt)
-        except Exception:
-            pass
+        OUTBOX.send_message(chat_id, txt, PRIO_HIGH)
 
 async def job_ask_arrival(context: ContextTypes.DEFAULT_TYPE):
     data = context.job.data or {}
@@ -2197,10 +3867,7 @@ async def job_ask_arrival(context: ContextTypes.DEFAULT_TYPE):
         kb = InlineKeyboardMarkup([
             [InlineKeyboardButton("✅ Я прибув(ла)", callback_data=f"arrived:{row_idx}")]
         ])
-        try:
-            await context.bot.send_message(chat_id=chat_id, text="Будь ласка, підтвердіть прибуття на зміну:", reply_markup=kb)
-        except Exception:
-            pass
+        OUTBOX.send_message(chat_id, "Будь ласка, підтвердіть прибуття на зміну:", PRIO_HIGH, reply_markup=kb)
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     import traceback
@@ -2224,8 +3891,224 @@ async def debug_channel_post(update: Update, context: ContextTypes.DEFAULT_TYPE)
         print(f"[debug] channel_chat_id = {update.channel_post.chat.id}", flush=True)
         print(f"[debug] channel_title = {update.channel_post.chat.title}", flush=True)
     
+async def post_init(app: Application):
+    OUTBOX.start(app.bot)
+    await mirror_warm_start()
+    precompute_time_pickers()
+
+    # прогріваємо кеші, щоб перший користувач не чекав на Sheets
+    try:
+        await get_requests_snapshot()
+    except Exception as e:
+        print(f"[debug] cache warm-up error: {e}", flush=True)
+
+    # Persistent JobQueue: спершу прибираємо відпрацьоване, потім читаємо лише живі задачі
+    try:
+        await jobqueue_compact()
+    except Exception as e:
+        print(f"[debug] JobQueue compaction error: {e}", flush=True)
+    await jobqueue_load_all()
+    print(f">>> Persistent JobQueue loaded: {len(REMINDERS)} pending reminders")
+
+async def post_stop(app: Application):
+    # бот ще ініціалізований — досилаємо дайджест і чергу
+    try:
+        await hr_digest_flush()
+    except Exception as e:
+        print(f"[debug] HR digest error: {e}", flush=True)
+    await OUTBOX.stop()
+    print(f">>> Outbox: {OUTBOX.metrics_line()}", flush=True)
+
+async def post_shutdown(app: Application):
+    # не губимо зміни, що ще не дійшли до таблиці (вони й так лишаються в дзеркалі)
+    await mirror_push()
+    await CALLBACK_TOKENS.flush()
+    _SHEETS_POOL.shutdown(wait=False)
+
+# ===================== Збереження user_data / chat_data =====================
+class SqlitePersistence(BasePersistence):
+    """
+    user_data і chat_data у локальному SQLite. Читання — з пам'яті Application
+    (SQLite читається лише при старті), зміни збираються і пишуться однією
+    транзакцією на цикл update_persistence (раз на PERSISTENCE_FLUSH_SEC).
+    """
+
+    _KINDS = ("user", "chat")
+
+    def __init__(self, path: str, update_interval: float = 60):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS ptb_data ("
+            " kind TEXT NOT NULL, id INTEGER NOT NULL, data BLOB NOT NULL,"
+            " PRIMARY KEY (kind, id))"
+        )
+        self._conn.commit()
+        self._dirty: Dict[Tuple[str, int], Optional[bytes]] = {}  # None — видалити
+        self._writer: Optional[asyncio.Task] = None
+
+    def _load(self, kind: str) -> Dict[int, dict]:
+        result = {}
+        for obj_id, blob in self._conn.execute("SELECT id, data FROM ptb_data WHERE kind = ?", (kind,)):
+            try:
+                result[obj_id] = pickle.loads(blob)
+            except Exception as e:
+                print(f"[debug] persistence: bad {kind} {obj_id}: {e}", flush=True)
+        return result
+
+    def _write(self, batch: Dict[Tuple[str, int], Optional[bytes]]):
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO ptb_data (kind, id, data) VALUES (?, ?, ?)",
+                [(kind, obj_id, blob) for (kind, obj_id), blob in batch.items() if blob is not None],
+            )
+            self._conn.executemany(
+                "DELETE FROM ptb_data WHERE kind = ? AND id = ?",
+                [key for key, blob in batch.items() if blob is None],
+            )
+
+    async def _write_dirty(self):
+        try:
+            # даємо решті update_* цього циклу потрапити в ту саму транзакцію
+            await asyncio.sleep(0.05)
+            while self._dirty:
+                batch, self._dirty = self._dirty, {}
+                await asyncio.to_thread(self._write, batch)
+        finally:
+            self._writer = None
+
+    def _mark(self, kind: str, obj_id: int, data: Optional[dict]):
+        self._dirty[(kind, obj_id)] = None if data is None else pickle.dumps(dict(data))
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._write_dirty())
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        return self._load("user")
+
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return self._load("chat")
+
+    async def update_user_data(self, user_id: int, data: dict):
+        self._mark("user", user_id, data)
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        self._mark("chat", chat_id, data)
+
+    async def drop_user_data(self, user_id: int):
+        self._mark("user", user_id, None)
+
+    async def drop_chat_data(self, chat_id: int):
+        self._mark("chat", chat_id, None)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        pass  # актуальна копія завжди в пам'яті
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
+
+    async def flush(self):
+        writer = self._writer
+        if writer is not None:
+            await writer
+        batch, self._dirty = self._dirty, {}
+        if batch:
+            self._write(batch)
+        self._conn.close()
+
+    # bot_data, callback_data і ConversationHandler бот не використовує
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def update_bot_data(self, data: dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict):
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state):
+        pass
+
+# ===================== Паралельна обробка апдейтів =====================
+def _update_order_key(update: object):
+    """Ключ, у межах якого апдейти мають оброблятися строго по черзі."""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return ("user", update.effective_user.id)
+    if update.effective_chat:
+        return ("chat", update.effective_chat.id)
+    return None
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Апдейти різних користувачів обробляються паралельно (до max_concurrent_updates),
+    а апдейти одного користувача/чату — строго по черзі, щоб стан у
+    context.user_data ("await", "pending_book_row", "mode") не перемішувався.
+
+    Якщо в користувача вже йде обробка, новий апдейт стає в його чергу, а слот
+    семафора одразу звільняється; чергу по порядку доробляє задача, що вже
+    тримає слот. Так один користувач займає не більше одного слота, і швидкі
+    натискання не блокують решту.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._backlogs: Dict[object, deque] = {}
+
+    async def do_process_update(self, update, coroutine):
+        key = _update_order_key(update)
+        if key is None:
+            await coroutine
+            return
+        backlog = self._backlogs.get(key)
+        if backlog is not None:
+            backlog.append(coroutine)
+            return
+
+        backlog = self._backlogs[key] = deque([coroutine])
+        try:
+            while backlog:
+                try:
+                    await backlog.popleft()
+                except Exception as e:
+                    print(f"[debug] update processing error for {key}: {e}", flush=True)
+        finally:
+            self._backlogs.pop(key, None)
+            for pending in backlog:  # скасування (зупинка бота) — не лишаємо неочікуваних корутин
+                pending.close()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
 def main():
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .persistence(SqlitePersistence(PERSISTENCE_PATH, update_interval=PERSISTENCE_FLUSH_SEC))
+    )
+    if CONCURRENT_UPDATES > 1:
+        builder = builder.concurrent_updates(PerChatUpdateProcessor(CONCURRENT_UPDATES))
+        print(f">>> Concurrent updates: {CONCURRENT_UPDATES} (per-chat ordering)")
+    app = builder.build()
 
     # Handlers
     app.add_handler(CommandHandler("start", start))
@@ -2239,9 +4122,77 @@ def main():
     app.add_handler(TypeHandler(Update, debug_channel_post), group=99)
     app.add_error_handler(error_handler)
 
-    # Persistent JobQueue
-    jobqueue_load_all(app)
-    print(">>> Persistent JobQueue loaded")
+    # Фонове оновлення кешів Requests/Stores
+    app.job_queue.run_repeating(
+        job_refresh_caches,
+        interval=min(REQ_CACHE_STALE_SEC, STORE_CACHE_STALE_SEC),
+        first=min(REQ_CACHE_STALE_SEC, STORE_CACHE_STALE_SEC),
+        name="refresh_caches"
+    )
+
+    # Пакетний запис змін з локального дзеркала в Google Sheets
+    app.job_queue.run_repeating(
+        job_mirror_push,
+        interval=MIRROR_PUSH_SEC,
+        first=MIRROR_PUSH_SEC,
+        name="mirror_push"
+    )
+
+    # Розсилка нагадувань: один тік на кошик
+    app.job_queue.run_repeating(
+        job_dispatch_reminders,
+        interval=REMINDER_BUCKET_SEC,
+        first=REMINDER_BUCKET_SEC,
+        name="dispatch_reminders"
+    )
+
+    # HR-дайджест
+    if HR_DIGEST_MODE:
+        app.job_queue.run_repeating(
+            job_hr_digest,
+            interval=min(30, HR_DIGEST_WINDOW_SEC),
+            first=min(30, HR_DIGEST_WINDOW_SEC),
+            name="hr_digest"
+        )
+        print(f">>> HR digest: every {HR_DIGEST_WINDOW_SEC}s or {HR_DIGEST_MAX} records")
+
+    # Метрики черги вихідних повідомлень
+    app.job_queue.run_repeating(
+        job_log_outbox_metrics,
+        interval=OUTBOX_METRICS_SEC,
+        first=OUTBOX_METRICS_SEC,
+        name="outbox_metrics"
+    )
+
+    # Метрики callback-маршрутів
+    app.job_queue.run_repeating(
+        job_log_callback_metrics,
+        interval=CALLBACK_METRICS_SEC,
+        first=CALLBACK_METRICS_SEC,
+        name="callback_metrics"
+    )
+
+    # Опівночі зсуваємо активне вікно Requests
+    app.job_queue.run_daily(
+        job_roll_active_window,
+        time=dtime(0, 0, tzinfo=KYIV_TZ),
+        name="roll_active_window"
+    )
+
+    # Прибирання протермінованих токенів callback_data
+    app.job_queue.run_repeating(
+        job_purge_callback_tokens,
+        interval=3600,
+        first=60,
+        name="purge_callback_tokens"
+    )
+
+    # Нічне прибирання JobQueue (архів виконаних задач)
+    app.job_queue.run_daily(
+        job_compact_jobqueue,
+        time=dtime(JOBQUEUE_COMPACT_HOUR, 0, tzinfo=KYIV_TZ),
+        name="compact_jobqueue"
+    )
 
     # ---------- WEBHOOK ----------
     port = int(os.getenv("PORT", "8000"))
@@ -0,0 +1,103 @@
+"""
+Часткова синхронізація Requests, коли дані доходять рівно до краю сітки аркуша.
+
+Запуск: python -m unittest discover -s tests
+bot.py підключається до Google Sheets ще під час імпорту, тож gspread і
+облікові дані підміняються заглушками, а аркуш Requests — FakeWorksheet.
+"""
+import asyncio
+import os
+import re
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_TMP = tempfile.mkdtemp()
+os.environ.update(
+    TELEGRAM_TOKEN="1:test", WEBHOOK_HOST="https://example.test", HR_CHANNEL_CHAT_ID="-100",
+    BOT_USERNAME="test_bot", GOOGLE_SERVICE_ACCOUNT_JSON="{}",
+    PERSISTENCE_PATH=os.path.join(_TMP, "state.sqlite3"),
+    LOCAL_DB_PATH=os.path.join(_TMP, "mirror.sqlite3"),
+    CALLBACK_TOKENS_PATH=os.path.join(_TMP, "tokens.sqlite3"),
+)
+
+with mock.patch("gspread.authorize"), \
+        mock.patch("google.oauth2.service_account.Credentials.from_service_account_info"):
+    import bot
+
+
+class FakeWorksheet:
+    """Аркуш з фіксованою сіткою: batch_get за її межі падає, як у Sheets API."""
+
+    def __init__(self, rows, row_count):
+        self.rows = rows
+        self.row_count = row_count
+        self.requested = []
+
+    def batch_get(self, ranges, **kwargs):
+        self.requested.append(list(ranges))
+        out = []
+        for rng in ranges:
+            start, end = re.fullmatch(r"A(\d+):[A-Z]+(\d*)", rng).groups()
+            start, end = int(start), int(end or self.row_count)
+            if start > self.row_count or end > self.row_count:
+                raise bot.gspread.exceptions.APIError(mock.Mock(
+                    json=lambda: {"error": {"code": 400, "message": f"Range ('Requests'!{rng}) exceeds grid limits"}}
+                ))
+            values = self.rows[start - 1:end]
+            while values and not values[-1]:
+                values = values[:-1]
+            out.append(values)
+        return out
+
+
+def _request_row(store: str, day) -> list:
+    cells = [""] * bot.COL_WORKER_STORE
+    cells[bot.COL_STORE - 1] = store
+    cells[bot.COL_DATE - 1] = day.strftime("%d.%m.%Y")
+    cells[bot.COL_NEED - 1] = "1"
+    cells[bot.COL_STATUS - 1] = bot.STATUS_PENDING
+    cells[bot.COL_CREATED_TG - 1] = "555"
+    cells[bot.COL_REQUEST_TYPE - 1] = bot.REQUEST_TYPE_NEED
+    cells[bot.COL_RECORD_STATE - 1] = bot.RECORD_STATE_ACTIVE
+    return cells
+
+
+class RequestsSyncSpansTest(unittest.TestCase):
+    def test_no_tail_when_data_ends_at_grid_edge(self):
+        self.assertEqual(bot._requests_sync_spans([(3, 5)], 6, 5), [(3, 5)])
+
+    def test_runs_are_clipped_to_grid(self):
+        self.assertEqual(bot._requests_sync_spans([(2, 3), (8, 12), (20, 21)], 22, 10), [(2, 3), (8, 10)])
+
+    def test_open_tail_inside_grid(self):
+        self.assertEqual(bot._requests_sync_spans([(2, 3)], 4, 10), [(2, 3), (4, None)])
+
+
+class IncrementalPullAtGridEdgeTest(unittest.TestCase):
+    def test_pull_reads_window_without_out_of_grid_tail(self):
+        today = bot.today_kyiv()
+        header = [""] * bot.COL_WORKER_STORE
+        rows = [header] + [_request_row(str(100 + i), today) for i in range(4)]
+        ws = FakeWorksheet(rows, row_count=len(rows))  # дані рівно до краю сітки
+
+        bot.MIRROR.merge("Requests", dict(enumerate(rows, start=1)), True)
+        bot._REQ_CACHE["value"] = bot._build_requests_snapshot(bot.MIRROR.values("Requests"), bot.StoreDirectory([]))
+        bot._MIRROR_PULLED["Requests"] = time.time()
+        rows[2] = _request_row("999", today)  # правка в таблиці
+
+        with mock.patch.object(bot, "requests_ws", ws), mock.patch.object(bot, "REQ_INCREMENTAL_SYNC", True):
+            fresh = asyncio.run(bot.mirror_pull_requests())
+
+        self.assertEqual(ws.requested, [["A2:T5"]])
+        self.assertEqual(sorted(fresh), [2, 3, 4, 5])
+        self.assertEqual(fresh[3][bot.COL_STORE - 1], "999")
+
+
+if __name__ == "__main__":
+    unittest.main()